@@ -0,0 +1,278 @@
+"""
+local connection agent: keeps authenticated SSH connections open between
+poni invocations and runs remote operations over them on behalf of clients
+
+Copyright (c) 2010-2012 Mika Eloranta
+See LICENSE for details.
+
+"""
+
+from __future__ import with_statement
+
+import base64
+import logging
+import os
+import socket
+import SocketServer
+import threading
+import time
+from path import path
+from .util import json
+from . import errors
+from . import rcontrol
+from . import rcontrol_paramiko
+
+SOCKET_ENV = "PONI_AGENT_SOCKET"
+
+
+def get_socket_path(socket_path=None):
+    """return the agent unix socket path: argument, $PONI_AGENT_SOCKET or
+    the default location in the user's home directory"""
+    return path(socket_path or os.environ.get(SOCKET_ENV)
+                or (path(os.environ.get("HOME", "/")) / ".poni" / "agent.sock"))
+
+
+def send_message(out_file, **kwargs):
+    out_file.write(json.dumps(kwargs) + "\n")
+    out_file.flush()
+
+
+def read_message(in_file):
+    line = in_file.readline()
+    if not line:
+        raise errors.RemoteError("agent connection closed unexpectedly")
+
+    return json.loads(line)
+
+
+def encode(data):
+    return base64.b64encode(data)
+
+
+def decode(data):
+    return base64.b64decode(data)
+
+
+class AgentNode(dict):
+    """minimal stand-in for a core.Node built from the properties the client
+    sent, enough for ParamikoRemoteControl"""
+    def __init__(self, name, props):
+        dict.__init__(self, props)
+        self.name = name
+
+    def get_tree_property(self, name, default=None):
+        value = self.get(name)
+        return default if value is None else value
+
+
+class PoolEntry:
+    def __init__(self, remote):
+        self.remote = remote
+        self.lock = threading.Lock() # serializes connection setup and sftp
+        self.last_used = time.time()
+        self.users = 0
+
+
+class ConnectionPool:
+    """authenticated connections keyed by (host, port, user, key)"""
+    def __init__(self, max_size=256, idle_timeout=300.0,
+                 remote_class=rcontrol_paramiko.ParamikoRemoteControl):
+        self.log = logging.getLogger("agent")
+        self.remote_class = remote_class
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, props):
+        return (props.get("host"),
+                int(props.get("ssh-port") or
+                    os.environ.get("PONI_SSH_PORT", 22)),
+                props.get("user"), props.get("ssh-key"))
+
+    def acquire(self, name, props):
+        key = self.get_key(props)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not entry.remote.is_alive():
+                self.log.debug("connection lost: %r", key)
+                del self.entries[key]
+                if not entry.users:
+                    entry.remote.close()
+
+                entry = None
+
+            if not entry:
+                self.make_room()
+                node = AgentNode(name, props)
+                remote = self.remote_class(node)
+                entry = PoolEntry(remote)
+                self.entries[key] = entry
+                self.log.debug("new connection: %r (pool size %d)", key,
+                               len(self.entries))
+
+            entry.users += 1
+            entry.last_used = time.time()
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+            if (not entry.users) and \
+                    (entry not in self.entries.itervalues()):
+                # replaced after the connection was lost
+                entry.remote.close()
+
+    def make_room(self):
+        """drop least recently used idle connections to stay within
+        max_size, must be called with self.lock held"""
+        idle = sorted((entry.last_used, key)
+                      for key, entry in self.entries.iteritems()
+                      if not entry.users)
+        while idle and (len(self.entries) >= self.max_size):
+            last_used, key = idle.pop(0)
+            self.log.debug("pool full, closing: %r", key)
+            self.entries.pop(key).remote.close()
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry.users:
+                    continue
+                elif now - entry.last_used > self.idle_timeout:
+                    self.log.debug("idle, closing: %r", key)
+                elif not entry.remote.is_alive():
+                    self.log.debug("connection lost, closing: %r", key)
+                else:
+                    continue
+
+                del self.entries[key]
+                entry.remote.close()
+
+    def close(self):
+        with self.lock:
+            for entry in self.entries.values():
+                entry.remote.close()
+
+            self.entries = {}
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        pool = self.server.pool
+        try:
+            request = read_message(self.rfile)
+        except (errors.RemoteError, ValueError):
+            return
+
+        entry = pool.acquire(request["name"], request["props"])
+        try:
+            self.dispatch(entry, request["op"], request.get("args", {}))
+        except errors.RemoteError, error:
+            send_message(self.wfile, error=error.__class__.__name__,
+                         message=str(error))
+        except socket.error:
+            # client went away
+            pass
+        except Exception, error:
+            # keep serving, the client gets the error instead of a closed
+            # connection
+            self.server.log.exception("%s: %s failed", request["name"],
+                                      request["op"])
+            try:
+                send_message(self.wfile, error=error.__class__.__name__,
+                             message="%s: %s" % (error.__class__.__name__,
+                                                 error))
+            except socket.error:
+                pass
+        finally:
+            pool.release(entry)
+
+    def dispatch(self, entry, op, args):
+        remote = entry.remote
+        if op == "exec":
+            # only the connection setup is serialized, commands run
+            # concurrently in channels of their own
+            with entry.lock:
+                remote.connect()
+
+            for code, output in remote.execute_command(
+                    args["command"], pseudo_tty=args.get("pseudo_tty")):
+                if code == rcontrol.DONE:
+                    send_message(self.wfile, code=code, exit=output)
+                else:
+                    send_message(self.wfile, code=code, data=encode(output))
+
+            return
+
+        with entry.lock:
+            if op == "read_file":
+                result = encode(remote.read_file(args["file_path"]))
+            elif op == "write_file":
+                result = remote.write_file(args["file_path"],
+                                           decode(args["contents"]),
+                                           mode=args.get("mode"),
+                                           owner=args.get("owner"),
+                                           group=args.get("group"))
+            elif op == "put_file":
+                result = remote.put_file(args["source_path"],
+                                         args["dest_path"])
+            elif op == "stat":
+                st = remote.stat(args["file_path"])
+                result = dict((name, getattr(st, name, None)) for name in (
+                        "st_mode", "st_size", "st_uid", "st_gid",
+                        "st_atime", "st_mtime"))
+            elif op == "connect":
+                result = remote.connect()
+            elif op == "makedirs":
+                result = remote.makedirs(args["dir_path"])
+            elif op == "utime":
+                result = remote.utime(args["file_path"], args["times"])
+            else:
+                raise errors.RemoteError("unknown agent operation %r" % op)
+
+        send_message(self.wfile, result=result)
+
+
+class AgentServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.log = logging.getLogger("agent")
+        self.pool = pool
+        socket_path = get_socket_path(socket_path)
+        if not socket_path.dirname().exists():
+            socket_path.dirname().makedirs(0700)
+
+        if socket_path.exists():
+            socket_path.remove()
+
+        # the socket is private from the start, there is no window between
+        # bind() and a chmod() for others to connect
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, str(socket_path),
+                                                   RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+        self.socket_path = socket_path
+
+    def run(self, check_interval=10.0):
+        def evict_loop():
+            while True:
+                time.sleep(check_interval)
+                self.pool.evict_idle()
+
+        evictor = threading.Thread(target=evict_loop)
+        evictor.daemon = True
+        evictor.start()
+        self.log.info("agent listening at %s", self.socket_path)
+        try:
+            self.serve_forever()
+        finally:
+            self.pool.close()
+            self.socket_path.remove()
@@ -9,18 +9,24 @@ See LICENSE for details.
 from path import path
 import argh
 import argparse
+import collections
 import datetime
 import difflib
+import hashlib
 import itertools
 import logging
+import os
 import random
 import re
 import sys
+import threading
 import time
 
 from . import errors
 from . import util
 from . import colors
+from . import rcontrol
+from .util import json
 
 import Cheetah.Template
 from Cheetah.Template import Template as CheetahTemplate
@@ -49,6 +55,8 @@ try:
 except ImportError:
     genshi = None
 
+ERROR_TAIL_LINES = 20 # output lines shown when a remote command fails
+
 
 class Manager:
     def __init__(self, confman):
@@ -60,46 +68,68 @@ class Manager:
         self.files = []
         self.error_count = 0
         self.buckets = {}
+        self.bucket_readers = {}
+        self.bucket_writers = {}
 
     def reset(self):
         self.files = []
         self.error_count = 0
         self.buckets = {}
+        self.bucket_readers = {} # bucket name: names of nodes reading it
+        self.bucket_writers = {} # bucket name: names of nodes adding to it
 
-    def get_bucket(self, name):
+    def get_bucket(self, name, reader=None):
+        """
+        return a bucket, recording 'reader' as one of the nodes reading it,
+        None if the reader is not known
+        """
+        self.bucket_readers.setdefault(name, set()).add(reader)
         return self.buckets.setdefault(name, freezingset())
 
+    def add_record(self, name, writer, record):
+        self.bucket_writers.setdefault(name, set()).add(writer)
+        self.buckets.setdefault(name, freezingset()).add(record)
+
     def emit_error(self, node, source_path, error):
         self.log.warning("node %s: %s: %s: %s", node.name, source_path,
                          error.__class__.__name__, error)
         self.error_count += 1
 
-    def copy_tree(self, entry, remote, path_prefix="", verbose=False):
+    def copy_tree(self, entry, remote, path_prefix="", verbose=False,
+                  plan=None):
         def progress(copied, total, ctx={}):
             ctx.setdefault("last", time.time())
             if (copied == total) or (time.time() - ctx["last"]) > 1.0:
                 sys.stderr.write("\r%s/%s bytes copied" % (copied, total))
                 ctx["last"] = time.time()
 
+        node = entry["node"]
         dest_dir = path(path_prefix + entry["dest_path"])
-        try:
-            remote.stat(dest_dir)
-        except errors.RemoteError:
-            remote.makedirs(dest_dir)
+        file_paths = path(entry["source_path"]).files()
+        # all remote stats in one go, batched if the remote supports it
+        rstats = remote.stat_many([dest_dir] + [dest_dir / file_path.basename()
+                                                for file_path in file_paths])
+        if not rstats[dest_dir]:
+            if plan:
+                plan.add_dir(node, dest_dir)
+            else:
+                remote.makedirs(dest_dir)
 
-        for file_path in path(entry["source_path"]).files():
+        for file_path in file_paths:
             dest_path = dest_dir / file_path.basename()
             lstat = file_path.stat()
-            try:
-                rstat = remote.stat(dest_path)
+            rstat = rstats[dest_path]
+            if rstat:
                 # copy if mtime or size differs
                 # TODO: optional full contents comparison
                 copy = ((lstat.st_size != rstat.st_size)
                         or (int(lstat.st_mtime) != int(rstat.st_mtime)))
-            except errors.RemoteError:
+            else:
                 copy = True
 
-            if copy:
+            if copy and plan:
+                plan.add_file(node, dest_path, lstat.st_size)
+            elif copy:
                 self.log.info("copying: %s", dest_path)
                 remote.put_file(file_path, dest_path, callback=progress)
                 remote.utime(dest_path, (int(lstat.st_mtime),
@@ -108,19 +138,13 @@ class Manager:
             elif verbose:
                 self.log.info("already copied: %s", dest_path)
 
-    def verify(self, show=False, deploy=False, audit=False, show_diff=False,
-               verbose=False, callback=None, path_prefix="", raw=False,
-               access_method=None, color="auto", config_patterns=None, tag=None):
-        self.log.debug("verify: %s", dict(show=show, deploy=deploy,
-                                          audit=audit, show_diff=show_diff,
-                                          verbose=verbose, callback=callback))
-        files = [f for f in self.files if not f.get("report")]
-        reports = [f for f in self.files if f.get("report")]
-        color = colors.Output(sys.stdout, color=color).color
-        stats = util.PropDict(dict(error_count=0, file_count=0))
-        config_patterns = [re.compile(p) for p in (config_patterns or [])]
-        tag = tag or ""  # empty string indicates untagged files
-        for entry in itertools.chain(files, reports):
+    def iter_selected(self, entries, callback=None, config_patterns=None,
+                      tag="", path_prefix=""):
+        """
+        yield (entry, filtered_out, item_path_prefix) for the entries that
+        verify() handles, 'filtered_out' entries are rendered only
+        """
+        for entry in entries:
             if not entry["node"].verify_enabled():
                 self.log.debug("filtered: verify disabled: %r", entry)
                 continue
@@ -141,6 +165,61 @@ class Manager:
             else:
                 item_path_prefix = ""
 
+            yield entry, filtered_out, item_path_prefix
+
+    def prefetch_active(self, selected, access_method=None):
+        """
+        read the active files of the 'selected' entries with one batched
+        request per node where the access method supports it, entries with
+        a templated 'dest_path' are read one at a time later
+        """
+        nodes = {}
+        node_paths = {}
+        for entry, filtered_out, item_path_prefix in selected:
+            dest_path = entry.get("dest_path")
+            if (filtered_out or (entry["type"] == "dir") or (not dest_path)
+                or ("$" in dest_path) or ("#" in dest_path)):
+                continue
+
+            if dest_path[-1:] == "/":
+                dest_path = path(dest_path) / \
+                    path(entry["source_path"]).basename()
+
+            node = entry["node"]
+            nodes[node.name] = node
+            node_paths.setdefault(node.name, []).append(
+                path(item_path_prefix + dest_path).normpath())
+
+        for node_name, paths in node_paths.iteritems():
+            node = nodes[node_name]
+            try:
+                node.get_remote(override=access_method).prefetch(paths)
+            except errors.RemoteError, error:
+                # not fatal, the files are read one at a time instead
+                self.log.debug("%s: prefetch failed: %s", node_name, error)
+
+    def verify(self, show=False, deploy=False, audit=False, show_diff=False,
+               verbose=False, callback=None, path_prefix="", raw=False,
+               access_method=None, color="auto", config_patterns=None, tag=None,
+               plan=None):
+        self.log.debug("verify: %s", dict(show=show, deploy=deploy,
+                                          audit=audit, show_diff=show_diff,
+                                          verbose=verbose, callback=callback,
+                                          plan=bool(plan)))
+        files = [f for f in self.files if not f.get("report")]
+        reports = [f for f in self.files if f.get("report")]
+        color = colors.Output(sys.stdout, color=color).color
+        stats = util.PropDict(dict(error_count=0, file_count=0))
+        config_patterns = [re.compile(p) for p in (config_patterns or [])]
+        tag = tag or ""  # empty string indicates untagged files
+        selected = list(self.iter_selected(
+                itertools.chain(files, reports), callback=callback,
+                config_patterns=config_patterns, tag=tag,
+                path_prefix=path_prefix))
+        if audit or deploy or plan:
+            self.prefetch_active(selected, access_method=access_method)
+
+        for entry, filtered_out, item_path_prefix in selected:
             self.log.debug("verify: %r", entry)
             render = entry["render"]
             failed = False
@@ -150,11 +229,11 @@ class Manager:
                 if filtered_out:
                     # ignore
                     pass
-                elif deploy:
+                elif deploy or plan:
                     # copy a directory recursively
                     remote = entry["node"].get_remote(override=access_method)
                     self.copy_tree(entry, remote, path_prefix=item_path_prefix,
-                                   verbose=verbose)
+                                   verbose=verbose, plan=plan)
                 else:
                     # verify
                     try:
@@ -248,12 +327,13 @@ class Manager:
 
             remote = None
 
-            if (audit or deploy) and dest_path and (not failed) and (not filtered_out):
+            if ((audit or deploy or plan) and dest_path and (not failed)
+                and (not filtered_out)):
                 # read existing file
+                op_start = time.time()
                 try:
                     remote = entry["node"].get_remote(override=access_method)
-                    active_text = remote.read_file(dest_path)
-                    stat = remote.stat(dest_path)
+                    active_text, stat = remote.read_with_stat(dest_path)
                     if stat:
                         active_time = datetime.datetime.fromtimestamp(
                             stat.st_mtime)
@@ -273,6 +353,11 @@ class Manager:
                         stats["error_count"] += 1
 
                     active_text = None
+
+                if plan:
+                    # read + stat
+                    plan.add_latency(entry["node"], time.time() - op_start,
+                                     op_count=2)
             else:
                 active_text = None
 
@@ -297,6 +382,13 @@ class Manager:
                     stats["error_count"] += 1
                     self.log.error("%s: %s: %s", node_name, dest_path, error)
                     # NOTE: continuing
+            elif plan and dest_path and (not failed) and (not filtered_out):
+                try:
+                    self.plan_file(plan, remote, entry, dest_path, output,
+                                   active_text, verbose=verbose)
+                except errors.RemoteError, error:
+                    stats["error_count"] += 1
+                    self.log.error("%s: %s: %s", node_name, dest_path, error)
 
         if stats["error_count"]:
             raise errors.VerifyError(
@@ -329,6 +421,33 @@ class Manager:
             # TODO: remote support
             post_process(dest_path)
 
+    def plan_file(self, plan, remote, entry, dest_path, output, active_text,
+                  verbose=False):
+        """record what deploy_file() would do without changing anything"""
+        node = entry["node"]
+        if output == active_text:
+            if verbose:
+                self.log.info(self.audit_format, "OK", node.name, dest_path)
+        else:
+            dest_dir = dest_path.dirname()
+            if not plan.dir_checked(node, dest_dir):
+                op_start = time.time()
+                try:
+                    remote.stat(dest_dir)
+                except errors.RemoteError:
+                    plan.add_dir(node, dest_dir)
+
+                plan.add_latency(node, time.time() - op_start)
+
+            plan.add_file(node, dest_path, len(output or ""))
+            if verbose:
+                self.log.info(self.audit_format, "CHANGE", node.name,
+                              dest_path)
+
+        if entry.get("post_process"):
+            # post-processing is done always even if file is unchanged
+            plan.add_hook(node, dest_path)
+
     def audit_output(self, entry, dest_path, active_text, active_time,
                      output, show_diff=False, color="auto",
                      verbose=False):
@@ -364,19 +483,206 @@ class Manager:
         self.files.append(kw)
 
 
-def control(provides=None, requires=None, optional_requires=None):
-    """decorate a PlugIn method as a 'poni control' command"""
+def control(provides=None, requires=None, optional_requires=None,
+            limits=None, inputs=None):
+    """
+    decorate a PlugIn method as a 'poni control' command
+
+    'limits' is a dict of concurrency limits: "host" is the max number of
+    tasks running on the node's host when this one starts (default: 1),
+    "global" the max concurrent runs of this command over all nodes and any
+    other key a limit shared by all commands naming the same key.
+
+    'inputs' is a list of the things the command's result depends on:
+    "file:NAME" (a config file), "template:NAME" (a config file rendered
+    with Cheetah), "settings" or "settings:KEY.SUBKEY" (config settings) and
+    "prop:NAME" (a node property). A command with inputs is skipped if it
+    has succeeded before with the same inputs, unless '--force' is given.
+    """
     def wrap(method):
         assert isinstance(provides, (list, tuple, type(None)))
         assert isinstance(requires, (list, tuple, type(None)))
         assert isinstance(optional_requires, (list, tuple, type(None)))
+        assert isinstance(limits, (dict, type(None)))
+        assert isinstance(inputs, (list, tuple, type(None)))
         method.poni_control = dict(provides=provides, requires=requires,
-                                   optional_requires=optional_requires)
+                                   optional_requires=optional_requires,
+                                   limits=limits, inputs=inputs)
         return method
 
     return wrap
 
 
+def control_key(node, config, op_name):
+    return "%s/%s:%s" % (node.name, config.name, op_name)
+
+
+class ControlDigests:
+    """
+    input digests of the control operations that have succeeded, stored
+    as {"NODE/CONFIG:OPERATION": digest} in a JSON file
+    """
+    def __init__(self, file_path):
+        self.file_path = path(file_path)
+        try:
+            self.digests = json.load(file(self.file_path))
+        except (IOError, ValueError):
+            self.digests = {}
+
+    def get(self, node, config, op_name):
+        return self.digests.get(control_key(node, config, op_name))
+
+    def set(self, node, config, op_name, digest):
+        key = control_key(node, config, op_name)
+        if digest:
+            self.digests[key] = digest
+        else:
+            self.digests.pop(key, None)
+
+    def save(self):
+        if not self.file_path.dirname().exists():
+            self.file_path.dirname().makedirs()
+
+        util.json_dump(self.digests, self.file_path)
+
+
+class ControlJournal:
+    """
+    append-only journal of a control run, one JSON record per line: "run"
+    with the run's arguments, then "start" and "finish" for each task
+
+    Records are synced to disk as they are written. A partial last line left
+    behind by an interrupted write is ignored when reading and cut off
+    before the journal is appended to again.
+    """
+    def __init__(self, file_path):
+        self.file_path = path(file_path)
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def read(self):
+        """return (list of complete records, byte length of them)"""
+        records = []
+        length = 0
+        with file(self.file_path, "rb") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+
+                length += len(line)
+
+        return records, length
+
+    def open(self, resume=False):
+        """open for writing, truncated unless resuming, returns the records
+        of the earlier run when resuming"""
+        if not self.file_path.dirname().exists():
+            self.file_path.dirname().makedirs()
+
+        records = []
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if resume:
+            records, length = self.read()
+            self.fd = os.open(self.file_path, flags)
+            os.ftruncate(self.fd, length)
+        else:
+            self.fd = os.open(self.file_path, flags | os.O_TRUNC)
+
+        return records
+
+    def write(self, **record):
+        # control results are not necessarily JSON serializable
+        line = json.dumps(record, sort_keys=True, default=repr) + "\n"
+        with self.lock:
+            os.write(self.fd, line)
+            os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def completed(records):
+        """return the set of task keys whose latest run succeeded"""
+        done = set()
+        for record in records:
+            if record.get("event") != "finish":
+                continue
+            elif record.get("result"):
+                done.discard(record["task"])
+            else:
+                done.add(record["task"])
+
+        return done
+
+
+class BucketGraph:
+    """
+    the nodes reading and adding to each bucket, recorded from a verify of
+    all nodes and valid as long as the repository 'fingerprint' is the same
+    """
+    def __init__(self, file_path):
+        self.file_path = path(file_path)
+        try:
+            data = json.load(file(self.file_path))
+        except (IOError, ValueError):
+            data = {}
+
+        self.fingerprint = data.get("fingerprint")
+        self.reads = data.get("reads", {}) # node name: bucket names
+        self.writers = data.get("writers", {}) # bucket name: node names
+        self.shared = data.get("shared", []) # buckets read by unknown nodes
+
+    def scope(self, node_names):
+        """
+        return the names of 'node_names' and the nodes adding to the buckets
+        they read, recursively, the writers of buckets read without a known
+        reader are always included
+        """
+        scope = set(node_names)
+        for bucket_name in self.shared:
+            scope.update(self.writers.get(bucket_name, []))
+
+        pending = list(scope)
+        while pending:
+            for bucket_name in self.reads.get(pending.pop(), []):
+                for writer in self.writers.get(bucket_name, []):
+                    if writer not in scope:
+                        scope.add(writer)
+                        pending.append(writer)
+
+        return scope
+
+    def save(self, fingerprint, manager):
+        reads = {}
+        shared = set()
+        for bucket_name, readers in manager.bucket_readers.iteritems():
+            for reader in readers:
+                if reader is None:
+                    shared.add(bucket_name)
+                else:
+                    reads.setdefault(reader, []).append(bucket_name)
+
+        self.fingerprint = fingerprint
+        self.reads = dict((name, sorted(buckets))
+                          for name, buckets in reads.iteritems())
+        self.writers = dict((name, sorted(writers)) for name, writers
+                            in manager.bucket_writers.iteritems())
+        self.shared = sorted(shared)
+        if not self.file_path.dirname().exists():
+            self.file_path.dirname().makedirs()
+
+        util.json_dump(dict(fingerprint=self.fingerprint, reads=self.reads,
+                            writers=self.writers, shared=self.shared),
+                       self.file_path)
+
+
 class hashabledict(dict):
     def __hash__(self):
         return hash(frozenset(self.iteritems()))
@@ -400,19 +706,53 @@ class PlugIn:
         self.config = config
         self.top_config = top_config
         self.node = node
-        self.controls = {}
+        self._controls = None
+
+    @property
+    def controls(self):
+        """the control commands by name, added on first use"""
+        if self._controls is None:
+            self._controls = {}
+            self.add_all_controls()
+
+        return self._controls
+
+    @classmethod
+    def get_control_table(cls):
+        """
+        return [(method name, 'control' decorator arguments)] of the class,
+        collected once per class and shared by all of its instances
+        """
+        table = cls.__dict__.get("_poni_control_table")
+        if table is None:
+            table = [(prop.__name__, prop.poni_control)
+                     for prop in cls.__dict__.itervalues()
+                     if hasattr(prop, "poni_control")]
+            cls._poni_control_table = table
+
+        return table
 
     def add_actions(self):
         pass
 
-    def remote_execute(self, arg, script_path):
-        for line in self.remote_gen_execute(arg, script_path):
+    def remote_execute(self, arg, script_path, new_session=False):
+        for line in self.remote_gen_execute(arg, script_path,
+                                            new_session=new_session):
             pass
 
-    def remote_gen_execute(self, arg, script_path, yield_stdout=False):
+    def remote_gen_execute(self, arg, script_path, yield_stdout=False,
+                           spill_path=None, new_session=False):
         """
         run a single remote shell-script, raise ControlError on non-zero
-        exit-code, optionally yields stdout line-per-line
+        exit-code, optionally yields stdout line-per-line as the lines arrive
+
+        If 'spill_path' is given, the complete stdout is also written to that
+        local file. Only the last few output lines are kept in memory for
+        the error message.
+
+        Successive commands run in a persistent shell session if the node's
+        'persistent_shell' property is set, 'new_session' runs the command
+        in a session of its own instead.
         """
         names = self.get_names()
         if isinstance(script_path, (list, tuple)):
@@ -420,21 +760,47 @@ class PlugIn:
 
         rendered_path = self._render_cheetah(script_path)
         remote = arg.node.get_remote(override=arg.method)
-        lines = [] if yield_stdout else None
         color = colors.Output(sys.stdout, color=arg.color).color
-        exit_code = remote.execute(rendered_path, verbose=arg.verbose,
-                                   output_lines=lines, quiet=arg.quiet,
-                                   output_file=arg.output_file,
-                                   color=color)
-        if exit_code:
-            raise errors.ControlError("%r failed with exit code %r" % (
-                    rendered_path, exit_code))
+        tail = collections.deque(maxlen=ERROR_TAIL_LINES)
+        spill_file = file(spill_path, "wb") if spill_path else None
+        # stdout is always captured for the error message, it is shown here
+        # unless it is yielded or spilled
+        if yield_stdout or spill_file or arg.quiet:
+            echo_file = None
+        else:
+            echo_file = arg.output_file or sys.stdout
 
-        for line in (lines or []):
-            yield line
+        exit_code = None
+        try:
+            for code, output in remote.iter_execute(
+                rendered_path, verbose=arg.verbose, quiet=arg.quiet,
+                output_file=arg.output_file, color=color, capture=True,
+                session=(not new_session)):
+                if code == rcontrol.DONE:
+                    exit_code = output
+                    continue
+
+                tail.append(output)
+                if code == rcontrol.STDOUT:
+                    if spill_file:
+                        spill_file.write(output + "\n")
+
+                    if yield_stdout:
+                        yield output
+                    elif echo_file:
+                        echo_file.write(output + "\n")
+                        echo_file.flush()
+        finally:
+            if spill_file:
+                spill_file.close()
+
+        if exit_code:
+            raise errors.ControlError("%r failed with exit code %r%s" % (
+                    rendered_path, exit_code,
+                    "".join("\n    %s" % line for line in tail)))
 
     def add_argh_control(self, handler, provides=None, requires=None,
-                         optional_requires=None):
+                         optional_requires=None, limits=None, inputs=None):
         try:
             name = handler.argh_alias
         except AttributeError:
@@ -452,17 +818,17 @@ class PlugIn:
             config = self.config,
             provides = provides or [],
             requires = requires or [],
-            optional_requires = optional_requires or []
+            optional_requires = optional_requires or [],
+            limits = limits or {},
+            inputs = inputs or []
             )
 
     def add_all_controls(self):
         self.add_controls()
 
         # add controls defined using the 'control' decorator
-        for name, prop in self.__class__.__dict__.iteritems():
-            if hasattr(prop, "poni_control"):
-                self.add_argh_control(getattr(self, prop.__name__),
-                                      **prop.poni_control)
+        for method_name, options in self.get_control_table():
+            self.add_argh_control(getattr(self, method_name), **options)
 
     def add_controls(self):
         # overridden in subclass
@@ -506,6 +872,35 @@ class PlugIn:
         raise errors.VerifyError("no %r found for config %r" % (
                 filename, self.top_config.name))
 
+    def control_digest(self, inputs):
+        """return a SHA-1 hex digest of the control operation 'inputs'"""
+        digest = hashlib.sha1()
+        for spec in inputs:
+            kind, _, name = spec.partition(":")
+            if kind == "file":
+                data = self.get_override_config_path(name).bytes()
+            elif kind == "template":
+                data = self._render_cheetah(
+                    file=str(self.get_override_config_path(name)))
+            elif kind == "settings":
+                data = self.top_config.settings
+                for key in (name.split(".") if name else []):
+                    data = data.get(key) if isinstance(data, dict) else None
+
+                data = json.dumps(data, sort_keys=True, default=repr)
+            elif kind == "prop":
+                data = json.dumps(self.node.get_tree_property(name),
+                                  sort_keys=True, default=repr)
+            else:
+                raise errors.ControlError(
+                    "%s/%s: invalid control input %r" % (
+                        self.node.name, self.config.name, spec))
+
+            digest.update("%s\0%d\0" % (spec, len(data)))
+            digest.update(data)
+
+        return digest.hexdigest()
+
     def add_file(self, source_path, dest_path=None, source_text=None,
                  dest_bucket=None, owner=None, group=None,
                  render=None, report=False, post_process=None, mode=None,
@@ -560,10 +955,14 @@ class PlugIn:
         self.add_record(bucket_name, dest_node=dest_node, dest_config=dest_config,
                         **kwargs)
 
+    def get_bucket(self, bucket_name):
+        """return a bucket, recording this node as one of its readers"""
+        return self.manager.get_bucket(bucket_name, reader=self.node.name)
+
     def add_record(self, bucket_name, **kwargs):
-        self.manager.get_bucket(bucket_name).add(
-            hashabledict(source_node=self.node, source_config=self.top_config,
-                 **kwargs))
+        self.manager.add_record(bucket_name, self.node.name, hashabledict(
+                source_node=self.node, source_config=self.top_config,
+                **kwargs))
 
     def get_names(self):
         names = dict(node=self.node,
@@ -576,7 +975,7 @@ class PlugIn:
                      get_system=self.get_system,
                      get_config=self.manager.confman.get_config,
                      config=self.top_config,
-                     bucket=self.manager.get_bucket,
+                     bucket=self.get_bucket,
                      edge=self.add_edge,
                      record=self.add_record,
                      plugin=self)
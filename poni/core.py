@@ -9,8 +9,12 @@ See LICENSE for details.
 import os
 import re
 import sys
+import hashlib
 import imp
+import itertools
+import marshal
 import shutil
+import stat
 from path import path
 from .util import json
 from . import newconfig
@@ -26,6 +30,8 @@ REPO_CONF_FILE = "repo.json"
 CONFIG_DIR = "config"
 PLUGIN_FILE = "plugin.py"
 SETTINGS_DIR = "settings"
+STATE_DIR_ENV = "PONI_STATE_DIR"
+PLUGIN_CACHE_DIR = "plugin-cache"
 
 DONT_SHOW = set(["cloud"])
 DONT_SAVE = set(["index", "sub_count", "depth"])
@@ -33,6 +39,19 @@ DONT_SAVE = set(["index", "sub_count", "depth"])
 g_plugin_module_cache = {}
 g_plugin_cache = {}
 
+def get_state_dir(root_dir):
+    """
+    return the directory for the local run state of the repository at
+    'root_dir', kept outside of the repository so that it is never
+    committed: one directory per repository path under $PONI_STATE_DIR
+    (default: $HOME/.poni/state)
+    """
+    state_root = path(os.environ.get(STATE_DIR_ENV) or
+                      (path(os.environ.get("HOME", "/")) / ".poni" / "state"))
+    repo_id = hashlib.sha1(str(path(root_dir).abspath())).hexdigest()[:16]
+    return state_root / repo_id
+
+
 def ensure_dir(typename, root, name, must_exist):
     """validate dir 'name' under 'root': dir either 'must_exist' or not"""
     target_dir = path(root) / name
@@ -264,21 +283,10 @@ class Config(Item):
         if plugin:
             return plugin
 
-        cache_key = (plugin_path, os.stat(plugin_path).st_mtime)
-        module = g_plugin_module_cache.get(cache_key)
-        if not module:
-            # reload the plugin module only if it is not in cache or it has
-            # been modified
-            # use a unique module name when importing the plugin
-            module = imp.load_source(
-                "_poni_plugin_%r" % len(g_plugin_module_cache),
-                plugin_path)
-
-            g_plugin_module_cache[cache_key] = module
-
+        module = self.node.confman.load_plugin_module(plugin_path)
+        # controls are added when first used, see PlugIn.controls
         plugin = module.PlugIn(manager, self, node, top_config)
         plugin.add_actions()
-        plugin.add_all_controls()
         top_config.plugin = plugin # TODO
         g_plugin_cache[plugin_key] = plugin
 
@@ -325,17 +333,7 @@ class Node(Item):
         addr_prop_list = addr_map.get(network, default)
 
         for addr_prop_name in addr_prop_list:
-            item = self
-            for part in addr_prop_name.split("."):
-                item = item.get(part)
-                if not isinstance(item, (dict, str, unicode, type(None))):
-                    raise errors.InvalidProperty(
-                        "node %s: wrong data type %s found looking for network address at property %r" % (
-                            self.name, type(item), addr_prop_name))
-
-                elif item is None:
-                    break
-
+            item = self.get_addr_prop(addr_prop_name)
             if item is not None:
                 return item
 
@@ -344,6 +342,37 @@ class Node(Item):
                 self.name, network,
                 ", ".join(repr(a) for a in addr_prop_list)))
 
+    def get_addr_prop(self, addr_prop_name):
+        """return the address in dotted property 'addr_prop_name' or None"""
+        item = self
+        for part in addr_prop_name.split("."):
+            item = item.get(part)
+            if not isinstance(item, (dict, str, unicode, type(None))):
+                raise errors.InvalidProperty(
+                    "node %s: wrong data type %s found looking for network address at property %r" % (
+                        self.name, type(item), addr_prop_name))
+
+            elif item is None:
+                break
+
+        return item
+
+    def addr_candidates(self):
+        """
+        return all the addresses the node may be reachable at: 'host' first,
+        then the 'private', 'public' and other 'addr_map' network addresses
+        """
+        addr_map = self.get_tree_property("addr_map", {})
+        prop_lists = [["host"],
+                      addr_map.get("private", ["private.dns", "private.ip"]),
+                      addr_map.get("public", ["public.dns", "public.ip"])]
+        prop_lists.extend(addr_map[network] for network in sorted(addr_map)
+                          if network not in ("private", "public"))
+        addrs = [self.get_addr_prop(addr_prop_name)
+                 for addr_prop_name in itertools.chain(*prop_lists)]
+        return util.unique_items(addr for addr in addrs
+                                 if isinstance(addr, basestring) and addr)
+
     def cleanup(self):
         for remote in self._remotes.values():
             remote.close()
@@ -447,6 +476,7 @@ class ConfigMan:
         # TODO: check repo.json from dir, option to start verification
         self.root_dir = path(root_dir)
         self.system_root = self.root_dir / "system"
+        self.state_dir = get_state_dir(self.root_dir)
         self.config_path = self.root_dir / REPO_CONF_FILE
         self.node_cache = {}
         self.find_cache = {}
@@ -469,6 +499,91 @@ class ConfigMan:
         self.find_cache = {}
         self.find_config_cache = {}
 
+    def fingerprint(self):
+        """
+        return a digest of the names, sizes and modification times of the
+        files in the repository and its library paths, it changes whenever
+        any of them changes
+        """
+        digest = hashlib.sha1()
+        top_dirs = [self.root_dir]
+        for lib_path in self.load_config().get("libpath", {}).values():
+            lib_path = path(lib_path)
+            if lib_path.isabs() and not \
+                    lib_path.startswith(self.root_dir + os.sep):
+                top_dirs.append(lib_path)
+
+        # a single lstat() per entry, os.walk() would stat every file twice
+        pending = [str(top_dir) for top_dir in reversed(top_dirs)]
+        git_dir = os.path.join(self.root_dir, ".git")
+        while pending:
+            dir_path = pending.pop()
+            try:
+                names = sorted(os.listdir(dir_path), reverse=True)
+            except OSError:
+                continue
+
+            for name in names:
+                if name.endswith((".pyc", ".pyo")):
+                    continue
+
+                file_path = os.path.join(dir_path, name)
+                try:
+                    st = os.lstat(file_path)
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(st.st_mode):
+                    if file_path != git_dir:
+                        pending.append(file_path)
+                else:
+                    digest.update("%s\0%d\0%r\0" % (
+                            file_path, st.st_size, st.st_mtime))
+
+        return digest.hexdigest()
+
+    def load_plugin_module(self, plugin_path):
+        """
+        import a plugin module, once per path and modification time
+
+        The compiled code is cached on disk in the state directory by a
+        digest of the path and the source, so plugins are compiled again
+        only when they change.
+        """
+        cache_key = (plugin_path, os.stat(plugin_path).st_mtime)
+        module = g_plugin_module_cache.get(cache_key)
+        if module:
+            return module
+
+        source = file(plugin_path, "rU").read()
+        digest = hashlib.sha1(imp.get_magic())
+        digest.update(str(plugin_path) + "\0")
+        digest.update(source)
+        code_path = self.state_dir / PLUGIN_CACHE_DIR / (
+            "%s.code" % digest.hexdigest())
+        try:
+            code = marshal.loads(code_path.bytes())
+        except (IOError, EOFError, ValueError, TypeError):
+            code = compile(source, str(plugin_path), "exec")
+            try:
+                if not code_path.dirname().exists():
+                    code_path.dirname().makedirs()
+
+                temp_path = "%s.%d.tmp" % (code_path, os.getpid())
+                path(temp_path).write_bytes(marshal.dumps(code))
+                os.rename(temp_path, code_path)
+            except (OSError, IOError):
+                pass # not cached, compiled again next time
+
+        # use a unique module name when importing the plugin
+        name = "_poni_plugin_%r" % len(g_plugin_module_cache)
+        module = imp.new_module(name)
+        module.__file__ = str(plugin_path)
+        sys.modules[name] = module
+        exec code in module.__dict__
+        g_plugin_module_cache[cache_key] = module
+        return module
+
     def apply_library_paths(self, path_dict):
         """add repo's custom library include paths to sys.path"""
         for lib_path in path_dict.values():
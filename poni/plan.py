@@ -0,0 +1,352 @@
+"""
+execution plans: what would be done without doing it
+
+Copyright (c) 2010-2012 Mika Eloranta
+See LICENSE for details.
+
+"""
+
+import heapq
+import itertools
+from . import errors
+from . import util
+from .util import json
+
+
+class DeployPlan:
+    """collects the remote changes a deploy would make, per node"""
+    def __init__(self):
+        self.nodes = {}
+
+    def get_node(self, node):
+        node_plan = self.nodes.get(node.name)
+        if node_plan is None:
+            node_plan = util.PropDict(name=node.name, host=node.get("host"),
+                                      files=[], bytes=0, dirs=set(),
+                                      checked_dirs=set(), hooks=0,
+                                      remote_ops=0, remote_time=0.0)
+            self.nodes[node.name] = node_plan
+
+        return node_plan
+
+    def add_file(self, node, dest_path, size):
+        node_plan = self.get_node(node)
+        node_plan.files.append(dest_path)
+        node_plan["bytes"] += size
+
+    def add_dir(self, node, dir_path):
+        self.get_node(node).dirs.add(dir_path)
+
+    def dir_checked(self, node, dir_path):
+        """return True if 'dir_path' existence was already checked"""
+        node_plan = self.get_node(node)
+        if dir_path in node_plan.checked_dirs:
+            return True
+
+        node_plan.checked_dirs.add(dir_path)
+        return False
+
+    def add_hook(self, node, dest_path):
+        self.get_node(node)["hooks"] += 1
+
+    def add_latency(self, node, elapsed, op_count=1):
+        """record time spent on 'op_count' remote operations"""
+        node_plan = self.get_node(node)
+        node_plan["remote_ops"] += op_count
+        node_plan["remote_time"] += elapsed
+
+    def latency(self, node_plan):
+        """average measured remote operation latency of a node"""
+        if not node_plan.remote_ops:
+            return 0.0
+
+        return node_plan.remote_time / node_plan.remote_ops
+
+    def estimate(self, node_plan):
+        """
+        estimated deploy time for a node in seconds: the file checks a
+        deploy repeats, the writes, directories and post-process hooks,
+        each at the measured remote operation latency
+        """
+        ops = (node_plan.remote_ops + len(node_plan.files)
+               + len(node_plan.dirs) + node_plan.hooks)
+        return ops * self.latency(node_plan)
+
+    def totals(self):
+        out = util.PropDict(nodes=0, files=0, bytes=0, dirs=0, hooks=0,
+                            serial_time=0.0, parallel_time=0.0)
+        for node_plan in self.nodes.itervalues():
+            estimate = self.estimate(node_plan)
+            out["nodes"] += 1
+            out["files"] += len(node_plan.files)
+            out["bytes"] += node_plan.bytes
+            out["dirs"] += len(node_plan.dirs)
+            out["hooks"] += node_plan.hooks
+            out["serial_time"] += estimate
+            out["parallel_time"] = max(out["parallel_time"], estimate)
+
+        return out
+
+    def iter_report(self, verbose=False):
+        if not self.nodes:
+            yield "nothing to deploy\n"
+            return
+
+        names = sorted(self.nodes)
+        longest = max(len(name) for name in names)
+        row = "%%-%ds %%7s %%12s %%6s %%6s %%9s %%9s\n" % longest
+        yield row % ("node", "files", "bytes", "dirs", "hooks", "latency",
+                     "estimate")
+        for name in names:
+            node_plan = self.nodes[name]
+            yield row % (name, len(node_plan.files), node_plan.bytes,
+                         len(node_plan.dirs), node_plan.hooks,
+                         "%.3fs" % self.latency(node_plan),
+                         "%.1fs" % self.estimate(node_plan))
+            if verbose:
+                for dir_path in sorted(node_plan.dirs):
+                    yield "    mkdir %s\n" % dir_path
+
+                for file_path in node_plan.files:
+                    yield "    write %s\n" % file_path
+
+        totals = self.totals()
+        yield row % ("TOTAL (%d nodes)" % totals.nodes, totals.files,
+                     totals.bytes, totals.dirs, totals.hooks, "", "")
+        yield ("estimated wall time: %.1fs one node at a time, "
+               "%.1fs all nodes in parallel\n" % (totals.serial_time,
+                                                   totals.parallel_time))
+
+
+class ControlPlan:
+    """
+    analysis of control tasks without running them: the depth and width of
+    the dependency graph, its critical path and a simulated schedule under
+    the job and concurrency limits that work.Runner applies
+
+    'duration(task)' returns the expected seconds of a task, without it
+    every task counts as one time unit and there is no time estimate.
+    """
+    def __init__(self, tasks, duration=None, max_jobs=1, skipped=0):
+        self.tasks = list(tasks)
+        self.timed = duration is not None
+        self.durations = dict((task, (duration(task) if duration else 1.0))
+                              for task in self.tasks)
+        self.max_jobs = max_jobs
+        self.skipped = skipped
+        self.depends = dict((task, set(dep for dep in task.depends
+                                       if dep in self.durations))
+                            for task in self.tasks)
+        self.dependents = dict((task, []) for task in self.tasks)
+        for task in self.tasks:
+            for dep in self.depends[task]:
+                self.dependents[dep].append(task)
+
+        self.order = self.get_order()
+        self.levels = {} # task: number of tasks on the longest chain to it
+        for task in self.order:
+            self.levels[task] = 1 + max([self.levels[dep] for dep
+                                         in self.depends[task]] or [0])
+
+        self.critical_path = self.get_critical_path()
+        self.schedule, self.max_running, self.waits = self.simulate()
+
+    def get_order(self):
+        """return the tasks in dependency order"""
+        pending = dict((task, len(self.depends[task])) for task in self.tasks)
+        order = [task for task in self.tasks if not pending[task]]
+        for task in order:
+            for dependent in self.dependents[task]:
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    order.append(dependent)
+
+        if len(order) < len(self.tasks):
+            raise errors.ControlError("dependency cycle: %s" % ", ".join(
+                    sorted(repr(task) for task in self.tasks
+                           if pending[task])))
+
+        return order
+
+    def get_critical_path(self):
+        """return the chain of dependent tasks with the longest duration"""
+        rest = {} # task: duration of the longest chain starting from it
+        for task in reversed(self.order):
+            rest[task] = self.durations[task] + max(
+                [rest[dependent] for dependent in self.dependents[task]]
+                or [0])
+
+        path = []
+        candidates = [task for task in self.order if not self.depends[task]]
+        while candidates:
+            task = max(candidates, key=lambda t: rest[t])
+            path.append(task)
+            candidates = self.dependents[task]
+
+        return path
+
+    def get_limits(self, task):
+        limits = dict(task.get_limits())
+        host = task.get_host()
+        if host is not None:
+            limits[("host", host)] = task.host_jobs
+
+        return limits
+
+    def simulate(self):
+        """
+        schedule the tasks like work.Runner does, highest priority first
+        within the limits, return ({task: (start, stop)}, max tasks running
+        at a time, {limit key: set of tasks that had to wait for it})
+        """
+        waiting = dict((task, len(self.depends[task])) for task in self.tasks)
+        seq = itertools.count()
+        ready = [(-task.priority, seq.next(), task) for task in self.order
+                 if not waiting[task]]
+        heapq.heapify(ready)
+        running = [] # heap of (stop, seq, task)
+        busy = {} # limit key: running tasks
+        schedule = {}
+        waits = {}
+        most = 0
+        now = 0.0
+        while ready or running:
+            blocked = []
+            while ready and (len(running) < self.max_jobs):
+                item = heapq.heappop(ready)
+                task = item[2]
+                limits = self.get_limits(task)
+                full = [key for key, limit in limits.iteritems()
+                        if busy.get(key, 0) >= limit]
+                if full:
+                    for key in full:
+                        waits.setdefault(key, set()).add(task)
+
+                    blocked.append(item)
+                    continue
+
+                for key in limits:
+                    busy[key] = busy.get(key, 0) + 1
+
+                stop = now + self.durations[task]
+                schedule[task] = (now, stop)
+                heapq.heappush(running, (stop, seq.next(), task))
+
+            for item in blocked:
+                heapq.heappush(ready, item)
+
+            most = max(most, len(running))
+            if not running:
+                break
+
+            now, _, task = heapq.heappop(running)
+            for key in self.get_limits(task):
+                busy[key] -= 1
+
+            for dependent in self.dependents[task]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    heapq.heappush(ready, (-dependent.priority, seq.next(),
+                                           dependent))
+
+        return schedule, most, waits
+
+    def totals(self):
+        widths = {}
+        for level in self.levels.itervalues():
+            widths[level] = widths.get(level, 0) + 1
+
+        hosts = set(task.get_host() for task in self.tasks)
+        hosts.discard(None)
+        hosts.discard("") # nodes without a host
+        return util.PropDict(
+            tasks=len(self.tasks), skipped=self.skipped, hosts=len(hosts),
+            depth=max(self.levels.values() or [0]),
+            width=max(widths.values() or [0]),
+            max_running=self.max_running, max_jobs=self.max_jobs,
+            critical_time=sum(self.durations[task]
+                              for task in self.critical_path),
+            serial_time=sum(self.durations.itervalues()),
+            estimate=max([stop for start, stop
+                          in self.schedule.itervalues()] or [0.0]))
+
+    def iter_report(self, verbose=False):
+        totals = self.totals()
+        seconds = lambda value: ("%.1fs" % value) if self.timed else "-"
+        yield "tasks:          %d on %d hosts (%d skipped)\n" % (
+            totals.tasks, totals.hosts, totals.skipped)
+        yield "depth:          %d\n" % totals.depth
+        yield "widest level:   %d\n" % totals.width
+        yield "max concurrent: %d (max jobs: %d)\n" % (totals.max_running,
+                                                        totals.max_jobs)
+        yield "critical path:  %d tasks, %s\n" % (len(self.critical_path),
+                                                   seconds(
+                totals.critical_time))
+        for task in self.critical_path:
+            yield "    %-60s %9s\n" % (repr(task),
+                                        seconds(self.durations[task]))
+
+        waits = sorted(((len(tasks), key) for key, tasks
+                        in self.waits.iteritems()), reverse=True)
+        if waits:
+            yield "limit waits:\n"
+            for count, key in waits[:None if verbose else 5]:
+                yield "    %-60s %9d\n" % (":".join(str(k) for k in key),
+                                            count)
+
+        if self.timed:
+            yield ("estimated wall time: %.1fs (%.1fs one task at a "
+                   "time)\n" % (totals.estimate, totals.serial_time))
+        else:
+            yield ("estimated wall time: unknown, no durations recorded "
+                   "(run with 'poni -L FILE' to record them)\n")
+
+        if verbose:
+            yield "schedule:\n"
+            for task in sorted(self.tasks, key=lambda t: (self.schedule[t],
+                                                          repr(t))):
+                start, stop = self.schedule[task]
+                yield "    %-60s %9s %9s\n" % (repr(task), seconds(start),
+                                              seconds(stop))
+
+    def as_json(self):
+        names = dict((task, repr(task)) for task in self.tasks)
+        critical = set(self.critical_path)
+        out = dict(self.totals())
+        for key in ("critical_time", "serial_time", "estimate"):
+            if not self.timed:
+                out[key] = None
+
+        out["critical_path"] = [names[task] for task in self.critical_path]
+        out["waits"] = dict((":".join(str(k) for k in key), len(tasks))
+                            for key, tasks in self.waits.iteritems())
+        out["task_list"] = [dict(name=names[task], host=task.get_host(),
+                                 depends=sorted(names[dep] for dep
+                                                in self.depends[task]),
+                                 level=self.levels[task],
+                                 duration=(self.durations[task] if self.timed
+                                           else None),
+                                 start=self.schedule[task][0],
+                                 stop=self.schedule[task][1],
+                                 critical=(task in critical))
+                            for task in self.order]
+        return json.dumps(out, indent=4, sort_keys=True) + "\n"
+
+    def iter_dot(self):
+        names = dict((task, json.dumps(repr(task))) for task in self.tasks)
+        critical = set(self.critical_path)
+        critical_edges = set(zip(self.critical_path, self.critical_path[1:]))
+        yield "digraph control {\n"
+        yield "    rankdir=LR;\n"
+        for task in self.order:
+            yield "    %s%s;\n" % (names[task], (" [color=red]"
+                                               if task in critical else ""))
+
+        for task in self.order:
+            for dep in sorted(self.depends[task], key=repr):
+                yield "    %s -> %s%s;\n" % (
+                    names[dep], names[task],
+                    (" [color=red]" if (dep, task) in critical_edges
+                     else ""))
+
+        yield "}\n"
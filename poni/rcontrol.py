@@ -9,25 +9,393 @@ See LICENSE for details.
 from __future__ import with_statement
 
 import errno
+import hashlib
 import logging
 import os
+import pipes
+import random
 import select
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from path import path
+from .util import json
 from . import errors
 from . import colors
+from . import util
 
 
 DONE = 0
 STDOUT = 1
 STDERR = 2
 
+MAX_LINE = 2**16 # longest partial line kept when prefixing output lines
+HELPER_BATCH = 500 # max operations per remote helper request
+HELPER_CHUNK = 2**15 # rate limited remote helper requests are sent in pieces
+
+
+class LineSplitter:
+    """
+    splits output chunks to lines (without the line terminator) as they
+    arrive, with 'max_line' set an unterminated line longer than that is
+    returned in 'max_line' sized pieces
+    """
+    def __init__(self, max_line=None):
+        self.max_line = max_line
+        self.pending = ""
+
+    def feed(self, data):
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        while self.max_line and (len(self.pending) >= self.max_line):
+            lines.append(self.pending[:self.max_line])
+            self.pending = self.pending[self.max_line:]
+
+        return [line[:-1] if line.endswith("\r") else line for line in lines]
+
+    def flush(self):
+        """return the last unterminated line, if any"""
+        lines = [self.pending] if self.pending else []
+        self.pending = ""
+        return lines
+
+
+def backoff_delay(attempt, base=0.5, cap=10.0):
+    """
+    seconds to wait before connect retry number 'attempt' (starting from
+    zero): doubles every time up to 'cap', randomized so that retries to many
+    hosts do not happen in lock-step
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class HostHealth:
+    """
+    connect failure book-keeping shared by all remotes of a run: a host that
+    has failed 'max_failures' connects in a row is not connected to again,
+    later operations on it fail immediately
+
+    Also remembers which of a node's addresses was reachable.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.tripped = {} # host: last error
+        self.preferred = {} # node name: address
+
+    def reset(self):
+        with self.lock:
+            self.failures = {}
+            self.tripped = {}
+            self.preferred = {}
+
+    def check(self, host):
+        """raise RemoteError if 'host' has failed too many times"""
+        with self.lock:
+            error = self.tripped.get(host)
+            count = self.failures.get(host)
+
+        if error:
+            raise errors.RemoteError(
+                "%s: not connecting after %d failed attempts: %s" % (
+                    host, count, error))
+
+    def failed(self, host, error, max_failures):
+        with self.lock:
+            count = self.failures.get(host, 0) + 1
+            self.failures[host] = count
+            if count >= max_failures:
+                self.tripped[host] = error
+
+    def succeeded(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+
+
+class TokenBucket:
+    """
+    limits the combined rate of all transfers sharing the bucket to 'rate'
+    bytes per second, allowing bursts of up to 'burst' bytes (default: one
+    second worth of data)
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """take 'amount' bytes from the bucket, sleep if the bucket runs dry"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # going into debt makes later callers wait their turn, too
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def helper_script():
+    """return (remote path, source) of the remote helper script, the path
+    is relative to the remote user's home directory"""
+    source = (path(__file__).dirname() / "remote_helper.py").bytes()
+    return (".poni/helper-%s.py" % hashlib.sha1(source).hexdigest()[:12],
+            source)
+
+
+def helper_command(script_path):
+    quoted = pipes.quote(str(script_path))
+    return ("if command -v python3 >/dev/null; then exec python3 %s; "
+            "else exec python %s; fi" % (quoted, quoted))
+
+
+def helper_stat(values):
+    size, mtime, atime, mode, uid, gid = values
+    return util.PropDict(st_size=size, st_mtime=mtime, st_atime=atime,
+                         st_mode=mode, st_uid=uid, st_gid=gid)
+
+
+class HelperClient:
+    """
+    talks to remote_helper.py running on the remote host, 'in_file' is the
+    helper's stdout and 'out_file' its stdin, requests are sent at the rate
+    allowed by 'limiter' (a TokenBucket) if it is set
+    """
+    def __init__(self, name, in_file, out_file, channel=None):
+        self.name = name
+        self.in_file = in_file
+        self.out_file = out_file
+        self.channel = channel
+        self.limiter = None
+        self.lock = threading.Lock() # one request in flight at a time
+
+    def close(self):
+        self.out_file.close()
+        self.in_file.close()
+        if self.channel:
+            self.channel.close()
+
+    def request(self, ops):
+        """run a list of operations, returns a list of result dicts"""
+        results = []
+        for pos in xrange(0, len(ops), HELPER_BATCH):
+            data = json.dumps(ops[pos:pos + HELPER_BATCH])
+            frame = "%d\n%s" % (len(data), data)
+            with self.lock:
+                if self.limiter:
+                    for start in xrange(0, len(frame), HELPER_CHUNK):
+                        chunk = frame[start:start + HELPER_CHUNK]
+                        self.limiter.consume(len(chunk))
+                        self.out_file.write(chunk)
+                else:
+                    self.out_file.write(frame)
+
+                self.out_file.flush()
+                length = self.in_file.readline()
+                if not length:
+                    raise errors.RemoteError("%s: remote helper exited" % (
+                            self.name))
+
+                response = self.in_file.read(int(length))
+
+            results.extend(json.loads(response))
+
+        return results
+
+    def check(self, result, file_path):
+        """return the value of a single result, raise an error for errors"""
+        if "error" not in result:
+            return result["ok"]
+        elif result["errno"] == errno.ENOENT:
+            raise errors.RemoteFileDoesNotExist("%s: %s: %s" % (
+                    self.name, file_path, result["error"]))
+
+        raise errors.RemoteError("%s: %s: %s" % (self.name, file_path,
+                                                 result["error"]))
+
+    def call(self, op, file_path, *args):
+        return self.check(self.request([[op, str(file_path)] +
+                                        list(args)])[0], file_path)
+
+
+class ShellSession:
+    """
+    a shell on the node that runs successive commands, saving the channel or
+    process setup of a separate execution per command
+
+    Each command is run with '$SHELL -c' like sshd runs commands, stdin is
+    /dev/null. A random sentinel written to stdout followed by the exit code,
+    and to stderr, marks the end of the command's output. Subclasses
+    implement send(), receive() and close().
+    """
+    def __init__(self, name):
+        self.log = logging.getLogger("shell")
+        self.name = name
+        self.token = "__poni_%s__" % os.urandom(8).encode("hex")
+        self.closed = False
+        self.commands = 0
+
+    def send(self, data):
+        assert 0, "must implement in sub-class"
+
+    def receive(self, timeout):
+        """
+        wait up to 'timeout' seconds for output, return a list of (code,
+        chunk) tuples, an empty list on timeout and an empty chunk at EOF
+        """
+        assert 0, "must implement in sub-class"
+
+    def close(self):
+        self.closed = True
+
+    def wrap(self, cmd):
+        return ('"${SHELL:-/bin/sh}" -c %s </dev/null; __poni_rc=$?; '
+                "printf '%%s %%d\\n' %s \"$__poni_rc\"; "
+                "printf '%%s\\n' %s >&2\n" % (pipes.quote(cmd), self.token,
+                                              self.token))
+
+    def run(self, cmd, terminate_timeout, warn_timeout):
+        """
+        run a command, yields (STDOUT/STDERR, chunk) as output arrives and
+        finally (DONE, exit_code), the session is closed if the command does
+        not complete
+        """
+        log_name = "%s: %r" % (self.name, cmd)
+        buffers = {STDOUT: "", STDERR: ""}
+        finished = set()
+        keep = len(self.token) # a sentinel may be split between chunks
+        exit_code = None
+        complete = False
+        self.send(self.wrap(cmd))
+        self.commands += 1
+        try:
+            rx_time = time.time()
+            while len(finished) < 2:
+                now = time.time()
+                output = self.receive(max(0.0, min(
+                            rx_time + terminate_timeout, now + warn_timeout)
+                                          - now))
+                if not output:
+                    elapsed = time.time() - rx_time
+                    if elapsed >= terminate_timeout:
+                        raise errors.RemoteError(
+                            "%s: no output in %.1f seconds, terminating" % (
+                                log_name, terminate_timeout))
+
+                    self.log.warning("%s: no output in %.1fs", log_name,
+                                     elapsed)
+                    continue
+
+                rx_time = time.time()
+                for code, chunk in output:
+                    if not chunk:
+                        raise errors.RemoteError(
+                            "%s: shell session closed unexpectedly" % (
+                                log_name))
+                    elif code in finished:
+                        continue
+
+                    data = buffers[code] + chunk
+                    pos = data.find(self.token)
+                    if pos < 0:
+                        cut = max(0, len(data) - keep)
+                        if cut:
+                            yield code, data[:cut]
+
+                        buffers[code] = data[cut:]
+                        continue
+
+                    if pos:
+                        yield code, data[:pos]
+
+                    buffers[code] = data[pos:]
+                    if code == STDOUT:
+                        end = data.find("\n", pos)
+                        if end < 0:
+                            continue # exit code not received yet
+
+                        exit_code = int(data[pos + len(self.token):end])
+
+                    finished.add(code)
+
+            complete = True
+            yield DONE, exit_code
+        finally:
+            if not complete:
+                # the shell is in an unknown state
+                self.close()
+
+
+class ProcessShellSession(ShellSession):
+    """shell session over the stdio of a local process, e.g. 'sh' or 'ssh'"""
+    def __init__(self, name, argv):
+        ShellSession.__init__(self, name)
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True)
+        self.streams = {self.process.stdout.fileno(): STDOUT,
+                        self.process.stderr.fileno(): STDERR}
+
+    def send(self, data):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except IOError, error:
+            raise errors.RemoteError("%s: shell session: %s: %s" % (
+                    self.name, error.__class__.__name__, error))
+
+    def receive(self, timeout):
+        try:
+            ready = select.select(list(self.streams), [], [], timeout)[0]
+        except select.error, error:
+            if error.args[0] == errno.EINTR:
+                return []
+            raise
+
+        return [(self.streams[fd], os.read(fd, 2**16)) for fd in ready]
+
+    def close(self):
+        ShellSession.close(self)
+        if self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                self.process.kill()
+            except OSError:
+                pass # already exited
+
+            self.process.wait()
+
+        self.process.stdout.close()
+        self.process.stderr.close()
+
 
 class RemoteControl:
     def __init__(self, node):
         self.node = node
+        self.lock = threading.RLock() # guards connection and session setup
+        self._sessions = [] # all open ShellSessions
+        self._idle_sessions = [] # sessions not running a command
+        self._sessions_available = True
+        self.persistent_shell = bool(node.get_tree_property(
+                "persistent_shell", False))
+        self.sessions_opened = 0
+        self.session_commands = 0
+        self.health = None # HostHealth, set by the remote manager
+        self.limiter = None # TokenBucket, set by the remote manager
+        self.prefetched = {} # path: (contents, stat) read by prefetch()
+        transfer = node.get_tree_property("transfer", None) or {}
+        self.compress = bool(transfer.get("compress"))
+        self.rate_limit = util.parse_size(transfer["rate_limit"]) \
+            if transfer.get("rate_limit") else None
         self.warn_timeout = 30.0 # seconds to wait before warning user after receiving any output
         self.terminate_timeout = node.get_tree_property("control_timeout", 300.0) # seconds to wait before disconnecting after receiving any output
 
@@ -63,8 +431,54 @@ class RemoteControl:
         else:
             return colors.Output(out_file, color="no").color
 
+    def write_prefixed(self, out_file, tag, pending, output, final=False):
+        """
+        write 'output' to 'out_file' one line at a time, each line prefixed
+        with 'tag', an incomplete last line is kept in 'pending' until more
+        output arrives
+        """
+        lines = (pending.pop() + output).splitlines(True) if pending else \
+            output.splitlines(True)
+        if (lines and not final and not lines[-1].endswith("\n")
+            and len(lines[-1]) < MAX_LINE):
+            pending.append(lines.pop())
+
+        for line in lines:
+            if not line.endswith("\n"):
+                line += "\n"
+
+            out_file.write(tag + line)
+
     def execute(self, command, verbose=False, color=None, output_lines=None,
-        output_file=None, quiet=False, exec_options=None):
+        output_file=None, quiet=False, exec_options=None, prefix=False):
+        """
+        execute a command, 'prefix' labels every output line with the node
+        name so that output from concurrent commands can be told apart
+        """
+        for code, output in self.iter_execute(
+            command, verbose=verbose, color=color, output_file=output_file,
+            quiet=quiet, exec_options=exec_options, prefix=prefix,
+            capture=(output_lines is not None)):
+            if code == STDOUT:
+                output_lines.append(output)
+            elif code == DONE:
+                return output
+
+    def iter_execute(self, command, verbose=False, color=None,
+                     output_file=None, quiet=False, exec_options=None,
+                     prefix=False, capture=False, session=False):
+        """
+        execute a command, yields (STDOUT, line) for every stdout line as
+        soon as it arrives if 'capture' is set (the captured lines are not
+        shown), stderr lines are shown and also yielded as (STDERR, line),
+        the last item is (DONE, exit_code)
+
+        With 'session' set the command runs in a persistent shell
+        session if the access method supports them.
+
+        Nothing is buffered beyond a single line, a slow consumer slows
+        down reading the remote output.
+        """
         exec_options = exec_options or {}
         if output_file is not None:
             stdout_file = output_file
@@ -77,19 +491,34 @@ class RemoteControl:
             stderr_file = None
 
         result = None
-        output_chunks = []
+        splitters = {STDOUT: LineSplitter(), STDERR: LineSplitter()}
+        pending = {STDOUT: [], STDERR: []}
         color = self.get_color(color, out_file=stdout_file)
+        prefix_tags = {
+            STDOUT: "[%s] " % color(self.node.name, "node"),
+            STDERR: "{%s} " % color(self.node.name, "node"),
+            }
         self.tag_line(color("BEGIN", "header"), command, verbose=verbose,
                       color=color, out_file=stdout_file)
 
         start = time.time()
         try:
+            if session and not exec_options:
+                source = self.execute_session_command(command)
+            else:
+                source = self.execute_command(command, **exec_options)
+
             while True:
-                for code, output in self.execute_command(command,
-                        **exec_options):
+                for code, output in source:
                     if code == STDOUT:
-                        if output_lines is not None:
-                            output_chunks.append(output)
+                        if capture:
+                            for line in splitters[STDOUT].feed(output):
+                                yield STDOUT, line
+                        elif stdout_file and prefix:
+                            self.write_prefixed(stdout_file,
+                                                prefix_tags[STDOUT],
+                                                pending[STDOUT], output)
+                            stdout_file.flush()
                         elif stdout_file:
                             if not verbose or stdout_file:
                                 stdout_file.write(output)
@@ -100,24 +529,49 @@ class RemoteControl:
                                                            "node"), line))
                             stdout_file.flush()
                     elif code == STDERR:
-                        if not verbose or stdout_file:
+                        if not stderr_file:
+                            # quiet
+                            pass
+                        elif prefix:
+                            self.write_prefixed(stderr_file,
+                                                prefix_tags[STDERR],
+                                                pending[STDERR], output)
+                        elif not verbose or stdout_file:
                             stderr_file.write(output)
-                        elif stderr_file:
+                        else:
                             for line in output.splitlines(True):
                                 stderr_file.write(
                                     "{%s} %s" % (color(self.node.name,
                                                        "node"), line))
-                        stderr_file.flush()
+
+                        if stderr_file:
+                            stderr_file.flush()
+
+                        if capture:
+                            for line in splitters[STDERR].feed(output):
+                                yield STDERR, line
                     else: # DONE
-                        if output_lines is not None:
-                            output_lines.extend(
-                                ("".join(output_chunks)).splitlines())
+                        if prefix and stdout_file:
+                            for code, out_file in ((STDOUT, stdout_file),
+                                                   (STDERR, stderr_file)):
+                                if pending[code]:
+                                    self.write_prefixed(
+                                        out_file, prefix_tags[code],
+                                        pending[code], "", final=True)
+                                    out_file.flush()
+
+                        if capture:
+                            for code in (STDOUT, STDERR):
+                                for line in splitters[code].flush():
+                                    yield code, line
 
                         if not output:
                             result = color("OK", "op_ok")
                         else:
                             result = color(output, "op_error")
-                        return output
+
+                        yield DONE, output
+                        return
         except Exception, error:
             result = color("%s: %s" % (error.__class__.__name__, error),
                            "op_error")
@@ -136,8 +590,126 @@ class RemoteControl:
             self.tag_line("END", "shell", verbose=verbose, color=color)
 
     def close(self):
+        self.close_session()
+
+    def open_session(self):
+        """start a ShellSession, None if the method does not support them"""
+        return None
+
+    def get_session(self):
+        """
+        return an idle ShellSession for running a single command, a new one
+        is opened if all sessions are busy with concurrent commands, None if
+        sessions are disabled or not supported
+        """
+        with self.lock:
+            while self._idle_sessions:
+                session = self._idle_sessions.pop()
+                if not session.closed:
+                    return session
+
+            if not (self.persistent_shell and self._sessions_available):
+                return None
+
+            session = self.open_session()
+            if not session:
+                self._sessions_available = False
+                return None
+
+            self._sessions = [s for s in self._sessions if not s.closed]
+            self._sessions.append(session)
+            self.sessions_opened += 1
+            return session
+
+    def release_session(self, session):
+        """return a session to the idle sessions after its command"""
+        with self.lock:
+            if not session.closed:
+                self._idle_sessions.append(session)
+
+    def close_session(self):
+        with self.lock:
+            sessions = self._sessions
+            self._sessions = []
+            self._idle_sessions = []
+
+        for session in sessions:
+            session.close()
+
+    def execute_session_command(self, command):
+        """
+        run a command in a persistent shell session, falls back to a
+        separate execute_command() if there is no session
+        """
+        session = self.get_session()
+        if not session:
+            return self.execute_command(command)
+
+        with self.lock:
+            self.session_commands += 1
+
+        return self.run_in_session(session, command)
+
+    def run_in_session(self, session, command):
+        complete = False
+        try:
+            for code, output in session.run(command, self.terminate_timeout,
+                                            self.warn_timeout):
+                if code == DONE:
+                    complete = True
+
+                yield code, output
+        finally:
+            if complete:
+                self.release_session(session)
+            else:
+                # the shell is in an unknown state
+                session.close()
+
+    def connect(self):
+        """
+        open and authenticate the connection ahead of the first operation,
+        nothing to do for methods that do not keep a connection
+        """
+        pass
+
+    def is_alive(self):
+        """False if the connection has been lost"""
+        return True
+
+    def stat_many(self, file_paths):
+        """return {path: stat or None if it cannot be stat'd} for many
+        paths, sub-classes may batch the operations"""
+        stats = {}
+        for file_path in file_paths:
+            try:
+                stats[file_path] = self.stat(file_path)
+            except errors.RemoteError:
+                stats[file_path] = None
+
+        return stats
+
+    def prefetch(self, file_paths):
+        """
+        read many files in advance for read_with_stat(), nothing to do for
+        methods that cannot batch reads
+        """
         pass
 
+    def read_with_stat(self, file_path):
+        """return (contents, stat) of a file, prefetched if possible"""
+        cached = self.prefetched.pop(str(file_path), None)
+        if not cached:
+            return self.read_file(file_path), self.stat(file_path)
+
+        contents, stat = cached
+        if contents is None:
+            raise errors.RemoteFileDoesNotExist(
+                "%s: %s: no such file or directory" % (self.node.name,
+                                                       file_path))
+
+        return contents, stat
+
     def stat(self, file_path):
         assert 0, "must implement in sub-class"
 
@@ -220,17 +792,25 @@ class LocalControl(RemoteControl):
     def execute_command(self, cmd, pseudo_tty=False):
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
-        fds = [process.stdout, process.stderr]
+        streams = {process.stdout.fileno(): STDOUT,
+                   process.stderr.fileno(): STDERR}
         CHUNK = 2**20
-        while process.poll() is None:
-            r, w, e = select.select(fds, [], fds)
-            if process.stdout in r:
-                yield STDOUT, process.stdout.read(CHUNK)
-
-            if process.stderr in r:
-                yield STDERR, process.stderr.read(CHUNK)
-
-        yield DONE, process.returncode
+        try:
+            # read until both streams are closed, the process may exit
+            # before all of its output has been read
+            while streams:
+                r, w, e = select.select(list(streams), [], [])
+                for fd in r:
+                    chunk = os.read(fd, CHUNK)
+                    if chunk:
+                        yield streams[fd], chunk
+                    else:
+                        del streams[fd]
+
+            yield DONE, process.wait()
+        finally:
+            process.stdout.close()
+            process.stderr.close()
 
     @convert_local_errors
     def execute_shell(self):
@@ -265,5 +845,6 @@ class SshRemoteControl(RemoteControl):
             self.key_filename = node.get_tree_property("ssh-key")
 
         self.connect_timeout = node.get_tree_property("ssh-timeout", 60.0)
+        self.max_failures = int(node.get_tree_property("ssh-max-failures", 1))
 
 
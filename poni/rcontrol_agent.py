@@ -0,0 +1,120 @@
+"""
+Node remote control through a local 'poni agent' connection pool
+
+Copyright (c) 2010-2012 Mika Eloranta
+See LICENSE for details.
+
+"""
+
+import socket
+from . import agent
+from . import errors
+from . import rcontrol
+from . import rcontrol_paramiko
+from . import util
+
+
+class AgentRemoteControl(rcontrol.SshRemoteControl):
+    """
+    Runs remote operations via a 'poni agent' process that keeps the
+    authenticated SSH connections open between poni invocations
+    """
+    def __init__(self, node, socket_path=None):
+        rcontrol.SshRemoteControl.__init__(self, node)
+        self.socket_path = agent.get_socket_path(socket_path)
+
+    def connect_props(self):
+        return {
+            "host": self.node.get("host"),
+            "user": self.node.get("user"),
+            "password": self.node.get("password"),
+            "ssh-port": self.node.get("ssh-port"),
+            "ssh-key": self.key_filename,
+            "ssh-timeout": self.connect_timeout,
+            "control_timeout": self.terminate_timeout,
+            "jump_host": self.node.get_tree_property("jump_host", None),
+            "jump_host_channels": self.node.get_tree_property(
+                "jump_host_channels", None),
+            "transfer": self.node.get_tree_property("transfer", None),
+            }
+
+    def open_request(self, op, **kwargs):
+        """send a request to the agent, returns the response file"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.socket_path))
+        except socket.error, error:
+            sock.close()
+            raise errors.RemoteError("cannot connect to poni agent at %s: "
+                                     "%s: %s" % (self.socket_path,
+                                                 error.__class__.__name__,
+                                                 error))
+
+        conn = sock.makefile("rwb")
+        sock.close() # conn keeps its own reference to the socket
+        agent.send_message(conn, op=op, name=self.node.name,
+                           props=self.connect_props(), args=kwargs)
+        return conn
+
+    def read_response(self, conn):
+        response = agent.read_message(conn)
+        if "error" in response:
+            if response["error"] == "RemoteFileDoesNotExist":
+                raise errors.RemoteFileDoesNotExist(response["message"])
+
+            raise errors.RemoteError(response["message"])
+
+        return response
+
+    def request(self, op, **kwargs):
+        conn = self.open_request(op, **kwargs)
+        try:
+            return self.read_response(conn).get("result")
+        finally:
+            conn.close()
+
+    def connect(self):
+        self.request("connect")
+
+    def read_file(self, file_path):
+        return agent.decode(self.request("read_file", file_path=file_path))
+
+    def write_file(self, file_path, contents, mode=None, owner=None,
+                   group=None):
+        self.request("write_file", file_path=file_path,
+                     contents=agent.encode(contents), mode=mode, owner=owner,
+                     group=group)
+
+    def put_file(self, source_path, dest_path, callback=None):
+        self.request("put_file", source_path=source_path,
+                     dest_path=dest_path)
+
+    def stat(self, file_path):
+        return util.PropDict(self.request("stat", file_path=file_path))
+
+    def makedirs(self, dir_path):
+        self.request("makedirs", dir_path=dir_path)
+
+    def utime(self, file_path, times):
+        self.request("utime", file_path=file_path, times=times)
+
+    def execute_command(self, cmd, pseudo_tty=False):
+        conn = self.open_request("exec", command=cmd, pseudo_tty=pseudo_tty)
+        try:
+            while True:
+                response = self.read_response(conn)
+                if response["code"] == rcontrol.DONE:
+                    yield rcontrol.DONE, response["exit"]
+                    break
+
+                yield response["code"], agent.decode(response["data"])
+        finally:
+            conn.close()
+
+    def execute_shell(self):
+        # interactive sessions need a terminal, connect directly
+        direct = rcontrol_paramiko.ParamikoRemoteControl(self.node)
+        try:
+            return direct.execute_shell()
+        finally:
+            direct.close()
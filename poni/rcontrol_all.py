@@ -6,35 +6,74 @@ See LICENSE for details.
 
 """
 
+import logging
+import os
+from . import agent
 from . import rcontrol
 from . import rcontrol_paramiko
-#from . import rcontrol_openssh
+from . import rcontrol_agent
+from . import rcontrol_async
+from . import rcontrol_openssh
 from . import errors
 
 METHODS = {
     "ssh": rcontrol_paramiko.ParamikoRemoteControl,
     "local": rcontrol.LocalControl,
+    "agent": rcontrol_agent.AgentRemoteControl,
+    "assh": rcontrol_async.AsyncSshRemoteControl,
+    "openssh": rcontrol_openssh.OpenSshRemoteControl,
     }
 
 class RemoteManager:
     def __init__(self):
         self.remotes = {}
+        self.health = rcontrol.HostHealth()
+        self.limiters = {} # rate: TokenBucket shared by all nodes
+
+    def get_limiter(self, rate):
+        limiter = self.limiters.get(rate)
+        if not limiter:
+            limiter = rcontrol.TokenBucket(rate)
+            self.limiters[rate] = limiter
+
+        return limiter
 
     def cleanup(self):
+        commands = sum(remote.session_commands
+                       for remote in self.remotes.values())
+        if commands:
+            logging.getLogger("rcontrol").debug(
+                "persistent shell sessions: %d commands over %d channels",
+                commands, sum(remote.sessions_opened
+                              for remote in self.remotes.values()))
+
         for remote in self.remotes.values():
             remote.close()
 
+        rcontrol_paramiko.bastions.close()
+
+        # host failures are remembered for a single run only
+        self.health.reset()
+
     def get_remote(self, node, method):
         key = (node.name, method)
         remote = self.remotes.get(key)
         if not remote:
+            method = method or "ssh"
+            if (method == "ssh") and os.environ.get(agent.SOCKET_ENV):
+                # route plain ssh access through the running 'poni agent'
+                method = "agent"
+
             try:
-                control_class = METHODS[method or "ssh"]
+                control_class = METHODS[method]
             except KeyError:
                 raise errors.RemoteError(
                     "unknown remote control method %r" % method)
 
             remote = control_class(node)
+            remote.health = self.health
+            if remote.rate_limit:
+                remote.limiter = self.get_limiter(remote.rate_limit)
             self.remotes[key] = remote
 
         return remote
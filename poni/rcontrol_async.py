@@ -0,0 +1,281 @@
+"""
+Node remote control using OpenSSH client processes driven by a single
+event-loop thread
+
+Copyright (c) 2010-2012 Mika Eloranta
+See LICENSE for details.
+
+"""
+
+from __future__ import with_statement
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import subprocess
+import threading
+import Queue as queue
+from . import errors
+from . import rcontrol
+from . import rcontrol_openssh
+
+FAILED = -1 # session could not be started
+BS = 2**16
+REAP_INTERVAL = 0.05 # seconds between checks for exited processes
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Session:
+    """
+    one ssh client process, its output is delivered to the 'output' queue as
+    (code, data) tuples ending with (rcontrol.DONE, exit_code)
+    """
+    def __init__(self, argv, stdin=None):
+        self.argv = argv
+        self.stdin = stdin # None, a string or a file object
+        self.stdin_buf = ""
+        self.output = queue.Queue()
+        self.process = None
+        self.pipes = {} # fd: pipe file object
+        self.cancelled = False
+
+    def start(self):
+        self.process = subprocess.Popen(self.argv, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True)
+        if isinstance(self.stdin, basestring):
+            self.stdin_buf = self.stdin
+            self.stdin = None
+
+        for pipe in (self.process.stdin, self.process.stdout,
+                     self.process.stderr):
+            set_nonblocking(pipe.fileno())
+            self.pipes[pipe.fileno()] = pipe
+
+    def next_stdin_chunk(self):
+        if not self.stdin_buf and self.stdin is not None:
+            self.stdin_buf = self.stdin.read(BS)
+            if not self.stdin_buf:
+                self.stdin = None
+
+        return self.stdin_buf
+
+    def kill(self):
+        self.cancelled = True # not started if still waiting in the queue
+        if self.process and (self.process.returncode is None):
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+
+class EventLoop(threading.Thread):
+    """
+    runs up to 'max_sessions' ssh sessions concurrently from a single thread,
+    further sessions wait in a queue until there is room
+    """
+    def __init__(self, max_sessions=1024):
+        threading.Thread.__init__(self)
+        self.log = logging.getLogger("assh")
+        self.daemon = True
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.fd_map = {}
+        self.running = 0
+        self.exiting = [] # sessions with all pipes closed, not reaped yet
+        self.poll = select.poll()
+        self.wake_read, self.wake_write = os.pipe()
+        set_nonblocking(self.wake_read)
+        self.poll.register(self.wake_read, select.POLLIN)
+
+    def submit(self, session):
+        with self.lock:
+            self.pending.append(session)
+
+        os.write(self.wake_write, "x")
+
+    def start_pending(self):
+        while self.running < self.max_sessions:
+            with self.lock:
+                if not self.pending:
+                    return
+
+                session = self.pending.popleft()
+
+            if session.cancelled:
+                continue
+
+            try:
+                session.start()
+            except OSError, error:
+                session.output.put((FAILED, "%s: %s" % (
+                            error.__class__.__name__, error)))
+                continue
+
+            self.running += 1
+            process = session.process
+            self.fd_map[process.stdout.fileno()] = (session, rcontrol.STDOUT)
+            self.fd_map[process.stderr.fileno()] = (session, rcontrol.STDERR)
+            self.poll.register(process.stdout, select.POLLIN)
+            self.poll.register(process.stderr, select.POLLIN)
+            self.fd_map[process.stdin.fileno()] = (session, None)
+            self.poll.register(process.stdin, select.POLLOUT)
+
+    def close_fd(self, session, fd):
+        self.poll.unregister(fd)
+        del self.fd_map[fd]
+        session.pipes.pop(fd).close()
+        if not session.pipes:
+            # stdin closed and both output streams at EOF: the process is
+            # done or very nearly, it is reaped without blocking the loop
+            self.exiting.append(session)
+            self.reap()
+
+    def reap(self):
+        for session in list(self.exiting):
+            exit_code = session.process.poll()
+            if exit_code is not None:
+                self.exiting.remove(session)
+                self.running -= 1
+                session.output.put((rcontrol.DONE, exit_code))
+
+    def write_stdin(self, session, fd):
+        chunk = session.next_stdin_chunk()
+        if not chunk:
+            self.close_fd(session, fd)
+            return
+
+        try:
+            written = os.write(fd, chunk)
+        except OSError, error:
+            if error.errno == errno.EAGAIN:
+                return
+
+            # remote end is not reading anymore
+            self.close_fd(session, fd)
+            return
+
+        session.stdin_buf = chunk[written:]
+
+    def read_output(self, session, code, fd):
+        try:
+            data = os.read(fd, BS)
+        except OSError, error:
+            if error.errno == errno.EAGAIN:
+                return
+
+            data = ""
+
+        if data:
+            session.output.put((code, data))
+        else:
+            self.close_fd(session, fd)
+
+    def run(self):
+        while True:
+            self.start_pending()
+            timeout = (REAP_INTERVAL * 1000) if self.exiting else None
+            events = self.poll.poll(timeout)
+            self.reap()
+            for fd, event in events:
+                if fd == self.wake_read:
+                    try:
+                        os.read(self.wake_read, BS)
+                    except OSError:
+                        pass
+
+                    continue
+
+                session, code = self.fd_map.get(fd, (None, None))
+                if not session:
+                    continue
+                elif code is None:
+                    self.write_stdin(session, fd)
+                else:
+                    self.read_output(session, code, fd)
+
+
+def get_loop():
+    """return the shared event loop, start it on first use"""
+    global _loop
+    with _loop_lock:
+        if not _loop:
+            max_sessions = int(os.environ.get("PONI_ASSH_MAX_SESSIONS", 1024))
+            _loop = EventLoop(max_sessions=max_sessions)
+            _loop.start()
+
+    return _loop
+
+
+class AsyncSshRemoteControl(rcontrol_openssh.OpenSshRemoteControl):
+    """
+    OpenSSH remote control where the ssh client processes of all nodes are
+    driven by one event-loop thread instead of one thread per connection
+
+    The blocking methods are a thin bridge to the event loop so that
+    synchronous callers work unchanged.
+    """
+    def start_session(self, remote_args, stdin=None, pseudo_tty=False):
+        session = Session(self.ssh_command(remote_args, pseudo_tty=pseudo_tty),
+                          stdin=stdin)
+        get_loop().submit(session)
+        return session
+
+    def iter_output(self, session, desc):
+        done = False
+        try:
+            while True:
+                try:
+                    code, data = session.output.get(
+                        timeout=self.terminate_timeout)
+                except queue.Empty:
+                    raise errors.RemoteError(
+                        "%s: %s: no output in %.1f seconds, terminating" % (
+                            self.node.name, desc, self.terminate_timeout))
+
+                if code == FAILED:
+                    done = True
+                    raise errors.RemoteError("%s: %s: %s" % (
+                            self.node.name, desc, data))
+
+                if code == rcontrol.DONE:
+                    done = True
+
+                yield code, data
+                if done:
+                    break
+        finally:
+            if not done:
+                # timed out or abandoned by the caller
+                session.kill()
+
+    def run_script(self, script, file_path, stdin=None):
+        stdout = []
+        stderr = []
+        session = self.start_session([script], stdin=stdin)
+        for code, data in self.iter_output(session, script):
+            if code == rcontrol.STDOUT:
+                stdout.append(data)
+            elif code == rcontrol.STDERR:
+                stderr.append(data)
+            else:
+                exit_code = data
+
+        return self.check_result(file_path, exit_code, "".join(stdout),
+                                 "".join(stderr))
+
+    def execute_command(self, cmd, pseudo_tty=False):
+        session = self.start_session([cmd], pseudo_tty=pseudo_tty)
+        return self.iter_output(session, repr(cmd))
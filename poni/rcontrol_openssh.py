@@ -6,82 +6,258 @@ See LICENSE for details.
 
 """
 
+from __future__ import with_statement
+
+import errno
 import os
+import pipes
+import select
 import subprocess
+from path import path
+from . import errors
 from . import rcontrol
+from . import util
+
+MISSING_EXIT = 111 # remote helper exit code for "file does not exist"
+SSH_ERROR_EXIT = 255 # ssh client exit code for connection errors
+BS = 2**16
+
+
+def get_control_dir():
+    """directory for the ControlMaster sockets managed by poni"""
+    control_dir = path(os.environ.get("PONI_SSH_CONTROL_DIR") or
+                       (path(os.environ.get("HOME", "/")) / ".poni" / "ssh"))
+    if not control_dir.exists():
+        control_dir.makedirs()
+        control_dir.chmod(0700)
+
+    return control_dir
 
 
 class OpenSshRemoteControl(rcontrol.SshRemoteControl):
     """
     OpenSSH remote control connection
 
-    Maintains a shell connection that can be piggy-backed by further ssh or
-    scp operations if OpenSSH is configured for shared connections,
-    for example:
-
-    .ssh/config:
-    ---clip---
-       Host *
-         ControlPath ~/.ssh/master-%l-%r@%h:%p
-         ControlMaster auto
-    ---clip---
+    Every operation runs an 'ssh' client process. The first one to a host
+    starts a ControlMaster connection whose socket is kept under
+    $HOME/.poni/ssh (or $PONI_SSH_CONTROL_DIR), all further operations
+    multiplex over it instead of connecting and authenticating again. The
+    master stays up for 'ssh-persist' seconds (default: 600) after the last
+    operation, so it is reused by later poni invocations, too.
 
+    File operations run small shell snippets on the remote host, so key-based
+    authentication and a POSIX shell with 'stat' and 'touch' are required.
     """
 
     def __init__(self, node):
         rcontrol.SshRemoteControl.__init__(self, node)
-        self.node = node
-        self._shared_conn = None
-
-    def close(self):
-        if self._shared_conn:
-            self._shared_conn.stdin.close()
-            self._shared_conn.stderr.close()
-            self._shared_conn.stdout.close()
-
-    def open_shared_connection(self):
-        if not self._shared_conn:
-            cmd = self.cmd([])
-            self._shared_conn = subprocess.Popen(
-                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-
-    def cmd(self, args):
-        assert isinstance(args, list)
-        full_key_path = "%s/.ssh/%s" % (os.environ["HOME"], self.key_filename)
-        command = [
-            "ssh",
-            "-i", full_key_path,
-            "-l", self.node["user"],
-            self.node["host"]
-            ]
-        command.extend(args)
+        self.persist = int(node.get_tree_property("ssh-persist", 600))
+
+    def ssh_command(self, remote_args, pseudo_tty=False):
+        host = self.node.get("host")
+        user = self.node.get("user")
+        port = int(self.node.get("ssh-port",
+                                 os.environ.get("PONI_SSH_PORT", 22)))
+        if not host:
+            raise errors.RemoteError("%s: 'host' property not defined" % (
+                    self.node.name))
+        elif not user:
+            raise errors.RemoteError("%s: 'user' property not defined" % (
+                    self.node.name))
+
+        if self.health:
+            self.health.check(host)
+
+        command = ["ssh", "-o", "BatchMode=yes",
+                   "-o", "StrictHostKeyChecking=accept-new",
+                   "-o", "ConnectTimeout=%d" % int(self.connect_timeout),
+                   "-o", "ControlMaster=auto",
+                   "-o", "ControlPath=%s/%%C" % get_control_dir(),
+                   "-o", "ControlPersist=%d" % self.persist,
+                   "-p", str(port), "-l", user]
+        if self.compress:
+            command.extend(["-o", "Compression=yes"])
+
+        jump_host = self.node.get_tree_property("jump_host", None)
+        if jump_host:
+            command.extend(["-o", "ProxyJump=%s" % jump_host])
+
+        if self.key_filename:
+            key_file = self.key_filename
+            if not os.path.isabs(key_file):
+                key_file = "%s/.ssh/%s" % (os.environ.get("HOME"), key_file)
+
+            command.extend(["-i", key_file])
+
+        command.append("-tt" if pseudo_tty else "-T")
+        command.append(host)
+        command.extend(remote_args)
         return command
 
-    def stat(self, file_path):
-        # TODO: implementation
-        return None
+    def check_result(self, file_path, exit_code, stdout, stderr):
+        """convert the exit code of a file operation snippet to errors"""
+        if self.health:
+            host = self.node.get("host")
+            if exit_code == SSH_ERROR_EXIT:
+                self.health.failed(host, stderr.strip(), self.max_failures)
+            else:
+                self.health.succeeded(host)
 
-    def read_file(self, file_path):
-        self.open_shared_connection()
-        process = subprocess.Popen(self.cmd(["cat", file_path]),
-                                   stdout=subprocess.PIPE)
-        return process.stdout.read()
+        if exit_code == MISSING_EXIT:
+            raise errors.RemoteFileDoesNotExist(
+                "%s: %s: no such file or directory" % (self.node.name,
+                                                       file_path))
+        elif exit_code == SSH_ERROR_EXIT:
+            raise errors.RemoteError("%s: ssh connect failed: %s" % (
+                    self.node.name, stderr.strip()))
+        elif exit_code:
+            raise errors.RemoteError("%s: %s: exit code %r: %s" % (
+                    self.node.name, file_path, exit_code, stderr.strip()))
+
+        return stdout
+
+    def run_script(self, script, file_path, stdin=None):
+        """
+        run a shell snippet for a file operation, 'stdin' is a string or a
+        file object, returns stdout
+        """
+        try:
+            process = subprocess.Popen(
+                self.ssh_command([script]),
+                stdin=(subprocess.PIPE if not hasattr(stdin, "fileno")
+                       else stdin),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True)
+            stdout, stderr = process.communicate(
+                stdin if isinstance(stdin, basestring) else None)
+        except (OSError, IOError), error:
+            raise errors.RemoteError("%s: %s: %s: %s" % (
+                    self.node.name, file_path, error.__class__.__name__,
+                    error))
+
+        return self.check_result(file_path, process.returncode, stdout,
+                                 stderr)
+
+    def read_script(self, file_path):
+        quoted = pipes.quote(str(file_path))
+        return "[ -e %s ] || exit %d; exec cat -- %s" % (quoted, MISSING_EXIT,
+                                                         quoted)
+
+    def write_script(self, file_path, mode=None, owner=None, group=None):
+        quoted = pipes.quote(str(file_path))
+        script = ["cat > %s" % quoted]
+        if mode is not None:
+            script.append("chmod %o %s" % (mode, quoted))
 
+        if owner is not None:
+            script.append("chown %d %s" % (owner, quoted))
+
+        if group is not None:
+            script.append("chgrp %d %s" % (group, quoted))
+
+        return " && ".join(script)
+
+    def stat_script(self, file_path):
+        quoted = pipes.quote(str(file_path))
+        return ("[ -e %s ] || exit %d; "
+                "exec stat -c '%%s %%Y %%X %%f %%u %%g' -- %s" % (
+                quoted, MISSING_EXIT, quoted))
+
+    def parse_stat(self, file_path, output):
+        try:
+            size, mtime, atime, mode, uid, gid = output.split()
+            return util.PropDict(st_size=int(size), st_mtime=int(mtime),
+                                 st_atime=int(atime), st_mode=int(mode, 16),
+                                 st_uid=int(uid), st_gid=int(gid))
+        except ValueError:
+            raise errors.RemoteError("%s: %s: unexpected stat output: %r" % (
+                    self.node.name, file_path, output))
+
+    def connect(self):
+        # starts the ControlMaster connection
+        self.run_script("true", "connect")
+
+    def read_file(self, file_path):
+        return self.run_script(self.read_script(file_path), file_path)
 
     def write_file(self, file_path, contents, mode=None, owner=None,
                    group=None):
-        self.open_shared_connection()
-        process = subprocess.Popen(self.cmd(["cat", ">", file_path]),
-                                   stdin=subprocess.PIPE)
-        process.stdin.write(contents)
+        self.run_script(self.write_script(file_path, mode, owner, group),
+                        file_path, stdin=contents)
 
-    def execute_command(self, command, pseudo_tty=False):
-        self.open_shared_connection()
-        return subprocess.call(self.cmd([command]))
+    def put_file(self, source_path, dest_path, callback=None):
+        with file(source_path, "rb") as source:
+            self.run_script(self.write_script(dest_path), dest_path,
+                            stdin=source)
 
-    def execute_shell(self):
-        self.open_shared_connection()
-        return subprocess.call(self.cmd([]))
+    def stat(self, file_path):
+        return self.parse_stat(file_path, self.run_script(
+                self.stat_script(file_path), file_path))
+
+    def makedirs(self, dir_path):
+        self.run_script("mkdir -p -- %s" % pipes.quote(str(dir_path)),
+                        dir_path)
 
+    def utime(self, file_path, times):
+        quoted = pipes.quote(str(file_path))
+        atime, mtime = times
+        self.run_script("touch -a -d @%d -- %s && touch -m -d @%d -- %s" % (
+                atime, quoted, mtime, quoted), file_path)
 
+    def open_session(self):
+        try:
+            return rcontrol.ProcessShellSession(
+                self.node.name, self.ssh_command(["exec /bin/sh"]))
+        except OSError, error:
+            raise errors.RemoteError("%s: %s: %s" % (
+                    self.node.name, error.__class__.__name__, error))
+
+    def execute_command(self, cmd, pseudo_tty=False):
+        try:
+            process = subprocess.Popen(self.ssh_command([cmd],
+                                                        pseudo_tty=pseudo_tty),
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       close_fds=True)
+        except OSError, error:
+            raise errors.RemoteError("%s: %s: %s" % (
+                    self.node.name, error.__class__.__name__, error))
+
+        process.stdin.close()
+
+        streams = {process.stdout.fileno(): rcontrol.STDOUT,
+                   process.stderr.fileno(): rcontrol.STDERR}
+        try:
+            while streams:
+                try:
+                    ready = select.select(list(streams), [], [],
+                                          self.terminate_timeout)[0]
+                except select.error, error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if not ready:
+                    raise errors.RemoteError(
+                        "%s: %r: no output in %.1f seconds, terminating" % (
+                            self.node.name, cmd, self.terminate_timeout))
+
+                for fd in ready:
+                    chunk = os.read(fd, BS)
+                    if chunk:
+                        yield streams[fd], chunk
+                    else:
+                        del streams[fd]
+
+            yield rcontrol.DONE, process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+
+            process.stdout.close()
+            process.stderr.close()
+
+    def execute_shell(self):
+        return subprocess.call(self.ssh_command([], pseudo_tty=True))
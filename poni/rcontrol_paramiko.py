@@ -6,18 +6,30 @@ See LICENSE for details.
 
 """
 
+from __future__ import with_statement
+
+import logging
+import base64
 import os
 import sys
 import socket
+import threading
 import time
 from . import errors
 from . import rcontrol
+from . import util
 import select
 import termios
 import tty
 import errno
+import Queue as queue
 from path import path
 
+WRITE_CHUNK = 2**15 # SFTP write size
+STATUS_POLL_MIN = 0.01 # first wait for the exit status without output
+STATUS_POLL_MAX = 0.5 # longest wait between exit status checks
+EOF_GRACE = 1.0 # longest wait for EOF without output after the exit status
+
 import warnings
 try:
     with warnings.catch_warnings():
@@ -84,30 +96,360 @@ def interactive_shell(chan):
         termios.tcsetattr(sys.stdin, termios.TCSADRAIN, oldtty)
 
 
+def race_connect(addrs, port, timeout, stagger=0.25):
+    """
+    connect to the first reachable address, happy eyeballs style: the
+    attempts are started 'stagger' seconds apart or as soon as the previous
+    one fails, returns (address, socket) of the first successful connect
+
+    Sockets of attempts that complete after the race is over, won or timed
+    out, are closed by the attempt itself.
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    state = {"over": False}
+
+    def attempt(addr):
+        try:
+            sock = socket.create_connection((addr, port), timeout)
+        except socket.error, error:
+            results.put((addr, None, error))
+            return
+
+        with lock:
+            if not state["over"]:
+                results.put((addr, sock, None))
+                return
+
+        sock.close()
+
+    pending = list(addrs)
+    running = 0
+    error = None
+    end_time = time.time() + timeout
+    try:
+        while pending or running:
+            if pending:
+                thread = threading.Thread(target=attempt,
+                                          args=(pending.pop(0),))
+                thread.daemon = True
+                thread.start()
+                running += 1
+                wait = stagger
+            else:
+                wait = end_time - time.time()
+
+            try:
+                addr, sock, error = results.get(timeout=max(0, wait))
+            except queue.Empty:
+                if pending or (time.time() < end_time):
+                    continue
+
+                break
+
+            running -= 1
+            if sock:
+                return addr, sock
+    finally:
+        with lock:
+            state["over"] = True
+
+        # connected while the winner was being picked
+        while True:
+            try:
+                late_sock = results.get_nowait()[1]
+            except queue.Empty:
+                break
+
+            if late_sock:
+                late_sock.close()
+
+    raise error or socket.timeout("connect timed out: %s" % ", ".join(addrs))
+
+
+def parse_jump_host(spec, default_user):
+    """parse a '[user@]host[:port]' jump host spec to (host, port, user)"""
+    user, sep, host_port = spec.rpartition("@")
+    host, sep, port = host_port.partition(":")
+    try:
+        return host, int(port or 22), (user or default_user)
+    except ValueError:
+        raise errors.RemoteError("invalid jump_host %r" % spec)
+
+
+class Bastion:
+    """
+    one authenticated connection to a jump host, connections to the nodes
+    behind it are tunneled as 'direct-tcpip' channels over it
+    """
+    def __init__(self, host, port, user, max_channels):
+        self.log = logging.getLogger("ssh")
+        self.host = host
+        self.port = port
+        self.user = user
+        self.max_channels = max_channels
+        self.channels = 0
+        self.cond = threading.Condition()
+        self.lock = threading.Lock() # serializes connecting
+        self.ssh = None
+
+    def get_transport(self, key_file, password, compress):
+        with self.lock:
+            if self.ssh and self.ssh.get_transport() and \
+                    self.ssh.get_transport().is_active():
+                return self.ssh.get_transport()
+
+            self.log.debug("jump host connect: host=%s, port=%r, user=%s",
+                           self.host, self.port, self.user)
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(self.host, port=self.port, username=self.user,
+                        key_filename=key_file, password=password,
+                        compress=compress)
+            self.ssh = ssh
+            return ssh.get_transport()
+
+    def open_channel(self, transport, dest_host, dest_port, timeout):
+        """open a tunnel to 'dest_host', waits up to 'timeout' seconds for
+        a free channel slot"""
+        with self.cond:
+            end_time = time.time() + timeout
+            while self.channels >= self.max_channels:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    raise errors.RemoteError(
+                        "jump host %s: all %d channels in use" % (
+                            self.host, self.max_channels))
+
+                self.cond.wait(remaining)
+
+            self.channels += 1
+
+        try:
+            return transport.open_channel("direct-tcpip",
+                                          (dest_host, dest_port),
+                                          ("127.0.0.1", 0))
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        with self.cond:
+            self.channels -= 1
+            self.cond.notify()
+
+    def close(self):
+        with self.lock:
+            if self.ssh:
+                self.ssh.close()
+                self.ssh = None
+
+
+class BastionPool:
+    """jump host connections shared by all nodes of a run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bastions = {}
+
+    def get(self, host, port, user, max_channels):
+        with self.lock:
+            key = (host, port, user)
+            bastion = self.bastions.get(key)
+            if not bastion:
+                bastion = Bastion(host, port, user, max_channels)
+                self.bastions[key] = bastion
+
+            return bastion
+
+    def close(self):
+        with self.lock:
+            for bastion in self.bastions.values():
+                bastion.close()
+
+            self.bastions = {}
+
+
+bastions = BastionPool()
+
+
+class ParamikoShellSession(rcontrol.ShellSession):
+    """shell session over an SSH channel"""
+    def __init__(self, name, channel, ping_interval):
+        rcontrol.ShellSession.__init__(self, name)
+        self.channel = channel
+        self.ping_interval = ping_interval
+
+    @convert_paramiko_errors
+    def send(self, data):
+        self.channel.sendall(data)
+
+    @convert_paramiko_errors
+    def receive(self, timeout):
+        deadline = time.time() + timeout
+        BS = 2**16
+        while True:
+            output = []
+            while self.channel.recv_stderr_ready():
+                output.append((rcontrol.STDERR, self.channel.recv_stderr(BS)))
+
+            while self.channel.recv_ready():
+                output.append((rcontrol.STDOUT, self.channel.recv(BS)))
+
+            if output:
+                return output
+            elif self.channel.eof_received or self.channel.closed:
+                return [(rcontrol.STDOUT, "")]
+
+            wait_time = min(deadline, time.time() + self.ping_interval) \
+                - time.time()
+            if wait_time <= 0:
+                return []
+
+            if not select.select([self.channel], [], [], wait_time)[0]:
+                # keep the connection alive during long silent commands
+                self.channel.transport.send_ignore()
+
+    def close(self):
+        rcontrol.ShellSession.close(self)
+        self.channel.close()
+
+
 class ParamikoRemoteControl(rcontrol.SshRemoteControl):
     def __init__(self, node):
         rcontrol.SshRemoteControl.__init__(self, node)
         self._ssh = None
         self._sftp = None
+        self._bastion = None
+        self._tunnel = None
+        self._helper = None # None: not started, False: not available
         self.ping_interval = 10
+        self.jump_host = node.get_tree_property("jump_host", None)
+        self.jump_host_channels = int(node.get_tree_property(
+                "jump_host_channels", 64))
+        transfer = node.get_tree_property("transfer", None) or {}
+        self.sftp_window = util.parse_size(transfer.get("sftp_window", "16M"))
+        self.sftp_packet = util.parse_size(transfer.get("sftp_packet", "32k"))
 
     def get_sftp(self):
-        if not self._sftp:
-            self._sftp = self.get_ssh(lambda ssh: ssh.open_sftp())
-        return self._sftp
+        with self.lock:
+            if not self._sftp:
+                # a large window keeps pipelined reads flowing on
+                # high-latency links, the paramiko default (2 MB) stalls them
+                self._sftp = self.get_ssh(
+                    lambda ssh: paramiko.SFTPClient.from_transport(
+                        ssh.get_transport(), window_size=self.sftp_window,
+                        max_packet_size=self.sftp_packet))
+            return self._sftp
+
+    def get_helper(self):
+        """return a HelperClient or None if the remote helper cannot be run
+        on the host or is disabled with the 'remote_helper' property"""
+        with self.lock:
+            if self._helper is None:
+                self._helper = False
+                if self.node.get_tree_property("remote_helper", False):
+                    try:
+                        self._helper = self.start_helper()
+                    except errors.RemoteError, error:
+                        self.log.debug("%s: remote helper not available, "
+                                       "using SFTP: %s", self.node.name, error)
+
+            return self._helper or None
+
+    @convert_paramiko_errors
+    def start_helper(self):
+        script_path, source = rcontrol.helper_script()
+        sftp = self.get_sftp()
+        try:
+            sftp.stat(script_path)
+        except IOError:
+            # not cached on the host yet
+            try:
+                sftp.mkdir(path(script_path).dirname())
+            except IOError:
+                pass # exists
+
+            temp_path = "%s.%d.tmp" % (script_path, os.getpid())
+            f = sftp.file(temp_path, mode="wb")
+            f.set_pipelined(True)
+            f.write(source)
+            f.close()
+            try:
+                sftp.rename(temp_path, script_path)
+            except IOError:
+                # uploaded by someone else meanwhile
+                sftp.remove(temp_path)
+
+        channel = self.get_ssh(lambda ssh: ssh.get_transport().open_session())
+        channel.exec_command(rcontrol.helper_command(script_path))
+        helper = rcontrol.HelperClient(self.node.name, channel.makefile("rb"),
+                                       channel.makefile("wb"), channel)
+        try:
+            helper.request([["ping"]])
+        except (errors.RemoteError, ValueError), error:
+            helper.close()
+            raise errors.RemoteError("%s: remote helper failed: %s" % (
+                    self.node.name, error))
+
+        return helper
+
+    @convert_paramiko_errors
+    def stat_many(self, file_paths):
+        helper = self.get_helper()
+        if not helper:
+            return rcontrol.RemoteControl.stat_many(self, file_paths)
+
+        results = helper.request([["stat", str(file_path)]
+                                  for file_path in file_paths])
+        return dict((file_path, rcontrol.helper_stat(result["ok"])
+                     if ("ok" in result) else None)
+                    for file_path, result in zip(file_paths, results))
+
+    @convert_paramiko_errors
+    def prefetch(self, file_paths):
+        helper = self.get_helper()
+        if not helper:
+            return
+
+        results = helper.request([["read", str(file_path)]
+                                  for file_path in file_paths])
+        for file_path, result in zip(file_paths, results):
+            if "ok" in result:
+                self.prefetched[str(file_path)] = (
+                    base64.b64decode(result["ok"]["data"]),
+                    rcontrol.helper_stat(result["ok"]["stat"]))
+            elif result["errno"] == errno.ENOENT:
+                self.prefetched[str(file_path)] = (None, None)
 
     @convert_paramiko_errors
     def read_file(self, file_path):
         file_path = str(file_path)
         sftp = self.get_sftp()
-        return sftp.file(file_path, mode="rb").read()
+        f = sftp.file(file_path, mode="rb")
+        try:
+            # request all blocks up front instead of one round-trip each
+            f.prefetch()
+            return f.read()
+        finally:
+            f.close()
 
     @convert_paramiko_errors
     def write_file(self, file_path, contents, mode=None, owner=None,
                    group=None):
         file_path = str(file_path)
+        helper = self.get_helper()
+        if helper:
+            # one round-trip and the file is replaced atomically
+            helper.limiter = self.limiter
+            helper.call("write", file_path, base64.b64encode(contents), mode,
+                        owner, group)
+            return
+
         sftp = self.get_sftp()
         f = sftp.file(file_path, mode="wb")
+        # do not wait for the status of each write, errors are reported by
+        # close()
+        f.set_pipelined(True)
         if mode is not None:
             sftp.chmod(file_path, mode)
 
@@ -118,10 +460,23 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
                        owner if (owner is not None) else file_stat.st_uid,
                        group if (group is not None) else file_stat.st_gid)
 
-        f.write(contents)
+        # paramiko copies the rest of the data for every request written,
+        # large strings are passed to it in chunks
+        for pos in xrange(0, len(contents), WRITE_CHUNK):
+            chunk = contents[pos:pos + WRITE_CHUNK]
+            if self.limiter:
+                self.limiter.consume(len(chunk))
+
+            f.write(chunk)
+
         f.close()
 
     def close(self):
+        self.close_session()
+        if self._helper:
+            self._helper.close()
+
+        self._helper = None
         if self._sftp:
             self._sftp.close()
             self._sftp = None
@@ -130,6 +485,76 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
             self._ssh.close()
             self._ssh = None
 
+        self.close_tunnel()
+
+    def close_tunnel(self):
+        if self._tunnel:
+            self._tunnel.close()
+            self._tunnel = None
+
+        if self._bastion:
+            self._bastion.release()
+            self._bastion = None
+
+    def open_tunnel(self, host, port, key_file, password):
+        """return a channel to host:port through the jump host"""
+        jump_host, jump_port, jump_user = parse_jump_host(
+            self.jump_host, self.node.get("user"))
+        bastion = bastions.get(jump_host, jump_port, jump_user,
+                               self.jump_host_channels)
+        transport = bastion.get_transport(key_file, password, self.compress)
+        self._tunnel = bastion.open_channel(transport, host, port,
+                                            self.connect_timeout)
+        self._bastion = bastion
+        return self._tunnel
+
+    def connect_addr(self, host, port):
+        """
+        return (address, socket) for the node: with multiple known
+        addresses all of them are raced, the winner is used for the rest
+        of the run, with a single address the socket is None
+        """
+        preferred = self.health.preferred if self.health else {}
+        addr = preferred.get(self.node.name)
+        if addr:
+            return addr, None
+
+        addrs = self.get_addrs(host)
+        if len(addrs) < 2:
+            return host, None
+
+        addr, sock = race_connect(addrs, port, self.connect_timeout)
+        self.log.debug("%s: connected via %s (candidates: %s)",
+                       self.node.name, addr, ", ".join(addrs))
+        preferred[self.node.name] = addr
+        return addr, sock
+
+    def get_addrs(self, host):
+        if hasattr(self.node, "addr_candidates"):
+            return self.node.addr_candidates() or [host]
+
+        return [host]
+
+    @convert_paramiko_errors
+    def connect(self):
+        host = self.node.get("host")
+        if host and not self.jump_host and (len(self.get_addrs(host)) < 2):
+            # name resolution failures are not worth retrying
+            try:
+                socket.getaddrinfo(host, None)
+            except socket.gaierror, error:
+                raise errors.RemoteError("%s: cannot resolve %r: %s" % (
+                        self.node.name, host, error.args[-1]))
+
+        self.get_ssh()
+
+    def is_alive(self):
+        if not self._ssh:
+            return True # connects on first use
+
+        transport = self._ssh.get_transport()
+        return bool(transport and transport.is_active())
+
     def get_ssh(self, action=None):
         host = self.node.get("host")
         user = self.node.get("user")
@@ -151,17 +576,37 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
         else:
             key_file = None
 
-        self.log.debug("ssh connect: host=%s, port=%r, user=%s, key=%s",
-                       host, port, user, key_file)
+        self.log.debug("ssh connect: host=%s, port=%r, user=%s, key=%s, "
+                       "jump_host=%s", host, port, user, key_file,
+                       self.jump_host)
+
+        if self.health and not self._ssh:
+            self.health.check(host)
 
+        attempt = 0
         end_time = time.time() + self.connect_timeout
         while time.time() < end_time:
             try:
-                if not self._ssh:
-                    ssh = paramiko.SSHClient()
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(host, port=port, username=user, key_filename=key_file, password=password)
-                    self._ssh = ssh
+                with self.lock:
+                    # concurrent tasks on the node share one connection
+                    if not self._ssh:
+                        self.close_tunnel() # left over from a failed attempt
+                        if self.jump_host:
+                            addr = host
+                            sock = self.open_tunnel(host, port, key_file,
+                                                    password)
+                        else:
+                            addr, sock = self.connect_addr(host, port)
+
+                        ssh = paramiko.SSHClient()
+                        ssh.set_missing_host_key_policy(
+                            paramiko.AutoAddPolicy())
+                        ssh.connect(addr, port=port, username=user,
+                                    key_filename=key_file, password=password,
+                                    compress=self.compress, sock=sock)
+                        self._ssh = ssh
+                        if self.health:
+                            self.health.succeeded(host)
                 return action(self._ssh) if action else self._ssh
             except (socket.error, paramiko.SSHException), error:
                 remaining = max(0, end_time - time.time())
@@ -170,7 +615,16 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
                                  self.node.name, host,
                                  error.__class__.__name__, error, remaining))
                 self._ssh = None
-                time.sleep(2.5)
+                if self.health:
+                    # race all the addresses again on the next attempt
+                    self.health.preferred.pop(self.node.name, None)
+
+                time.sleep(min(rcontrol.backoff_delay(attempt), remaining))
+                attempt += 1
+
+        if self.health:
+            self.health.failed(host, "%s: %s" % (error.__class__.__name__,
+                                                 error), self.max_failures)
 
         raise errors.RemoteError("%s: ssh connect failed: %s: %s" % (
                 self.node.name, error.__class__.__name__, error))
@@ -189,7 +643,6 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
         if pseudo_tty:
             channel.get_pty()
 
-        channel.set_combine_stderr(True) # TODO: separate stdout/stderr?
         BS = 2**16
         rx_time = time.time()
         log_name = "%s (%s): %r" % (self.node.name, self.node.get("host"), cmd)
@@ -197,16 +650,29 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
         next_ping = time.time() + self.ping_interval
 
         def available_output():
-            """read all the output that is immediately available"""
-            while channel.recv_ready():
-                chunk = channel.recv(BS)
+            """read all the output that is immediately available, stdout and
+            stderr are kept separate"""
+            while True:
+                if channel.recv_ready():
+                    code, chunk = rcontrol.STDOUT, channel.recv(BS)
+                elif channel.recv_stderr_ready():
+                    code, chunk = rcontrol.STDERR, channel.recv_stderr(BS)
+                else:
+                    break
+
                 if chunk:
-                    yield rcontrol.STDOUT, chunk
+                    yield code, chunk
 
         channel.exec_command(cmd)
         channel.shutdown_write()
 
-        exit_code = None
+        # the channel fileno becomes readable when stdout or stderr data
+        # arrives and stays readable after EOF, the arrival of the exit
+        # status is not signaled and is polled at growing intervals while
+        # there is no output
+        status_poll = STATUS_POLL_MIN
+        exit_status = None
+        eof_deadline = None
         if epoll:
             poll = select.epoll()
             poll.register(channel.fileno(), select.EPOLLIN)
@@ -215,25 +681,32 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
 
         try:
             while True:
-                if (exit_code is None) and channel.exit_status_ready():
-                    # process has finished executing, but there still may be
-                    # output to read from stdout or stderr
-                    exit_code = channel.recv_exit_status()
-
-                # wait for input, note that the results are not used for anything
-                if poll:
-                    poll.poll(timeout=1.0)  # just poll, not interested in the fileno
-                else:
-                    select.select([channel], [], [], 1.0)
-
                 for output in available_output():
                     rx_time = time.time()
-                    next_warn = time.time() + self.warn_timeout
+                    next_warn = rx_time + self.warn_timeout
+                    status_poll = STATUS_POLL_MIN
+                    if exit_status is not None:
+                        eof_deadline = rx_time + EOF_GRACE
                     yield output
 
-                if (exit_code is not None):
-                    yield rcontrol.DONE, exit_code
-                    break # everything done!
+                if (exit_status is None) and channel.exit_status_ready():
+                    # the exit status may arrive before the rest of the
+                    # output, keep reading until EOF
+                    exit_status = channel.recv_exit_status()
+                    eof_deadline = time.time() + EOF_GRACE
+
+                if exit_status is not None:
+                    eof = channel.eof_received or channel.closed
+                    if eof or (time.time() > eof_deadline):
+                        if not eof:
+                            # a background process keeps the output open
+                            self.log.debug("%s: no EOF in %.1fs after exit",
+                                           log_name, EOF_GRACE)
+                        for output in available_output():
+                            yield output
+
+                        yield rcontrol.DONE, exit_status
+                        break # everything done!
 
                 now = time.time()
                 if now > (rx_time + self.terminate_timeout):
@@ -243,18 +716,44 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
                             log_name, self.terminate_timeout))
 
                 if now > next_warn:
-                    elapsed_since = time.time() - rx_time
+                    elapsed_since = now - rx_time
                     self.log.warning("%s: no output in %.1fs", log_name,
                                      elapsed_since)
-                    next_warn = time.time() + self.warn_timeout
+                    next_warn = now + self.warn_timeout
 
                 if now > next_ping:
                     channel.transport.send_ignore()
-                    next_ping = time.time() + self.ping_interval
+                    next_ping = now + self.ping_interval
+
+                # sleep until there is something to do: output, the exit
+                # status or the next keepalive/warning/termination deadline
+                if exit_status is None:
+                    deadline = now + status_poll
+                    status_poll = min(status_poll * 2, STATUS_POLL_MAX)
+                else:
+                    deadline = eof_deadline
+
+                wait_time = max(0.0, min(next_ping, next_warn,
+                                         rx_time + self.terminate_timeout,
+                                         deadline) - time.time())
+                if channel.eof_received or channel.closed:
+                    # the fileno stays readable, only the status is missing
+                    time.sleep(wait_time)
+                elif poll:
+                    poll.poll(timeout=wait_time)
+                else:
+                    select.select([channel], [], [], wait_time)
         finally:
             if poll:
                 poll.close()
 
+    @convert_paramiko_errors
+    def open_session(self):
+        channel = self.get_ssh(lambda ssh: ssh.get_transport().open_session())
+        channel.exec_command("exec /bin/sh")
+        return ParamikoShellSession(self.node.name, channel,
+                                    self.ping_interval)
+
     @convert_paramiko_errors
     def execute_shell(self):
         def invoke_shell(ssh):
@@ -278,10 +777,24 @@ class ParamikoRemoteControl(rcontrol.SshRemoteControl):
         source_path = str(source_path)
         dest_path = str(dest_path)
         sftp = self.get_sftp()
+        if self.limiter:
+            sent = [0]
+            progress = callback
+            def callback(transferred, total):
+                self.limiter.consume(transferred - sent[0])
+                sent[0] = transferred
+                if progress:
+                    progress(transferred, total)
+
         sftp.put(source_path, dest_path, callback=callback)
 
     @convert_paramiko_errors
     def makedirs(self, dir_path):
+        helper = self.get_helper()
+        if helper:
+            helper.call("makedirs", dir_path)
+            return
+
         dir_path = path(dir_path)
         sftp = self.get_sftp()
         create_dirs = []
@@ -0,0 +1,198 @@
+"""
+Remote file operation helper: uploaded to and run on the remote host by
+poni, serves batches of file operations over stdin/stdout
+
+Self-contained, runs on Python 2.6+ and 3.x. Each request and response is a
+frame: the payload length as a decimal number and a newline followed by a
+JSON payload. A request is a list of operations '[name, arg1, arg2, ...]',
+the response is a list with one '{"ok": result}' or
+'{"error": message, "errno": errno}' dict per operation.
+
+Copyright (c) 2010-2012 Mika Eloranta
+See LICENSE for details.
+
+"""
+
+import base64
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+VERSION = 1
+
+
+def stat_list(st):
+    return [st.st_size, int(st.st_mtime), int(st.st_atime), st.st_mode,
+            st.st_uid, st.st_gid]
+
+
+def op_ping():
+    return VERSION
+
+
+def op_stat(file_path):
+    return stat_list(os.stat(file_path))
+
+
+def op_read(file_path):
+    with open(file_path, "rb") as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+
+    return {"data": base64.b64encode(data).decode("ascii"),
+            "stat": stat_list(st)}
+
+
+def op_sha1(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(2**16)
+            if not chunk:
+                break
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def op_makedirs(dir_path):
+    try:
+        os.makedirs(dir_path)
+    except OSError:
+        if not os.path.isdir(dir_path):
+            raise
+
+
+def op_write(file_path, data, mode=None, owner=None, group=None):
+    """
+    write a file atomically: to a temp file that is renamed in place, the
+    mode and ownership of an existing file are kept unless given
+    """
+    file_path = os.path.realpath(file_path) # do not replace symlinks
+    data = base64.b64decode(data)
+    try:
+        old = os.stat(file_path)
+    except OSError:
+        old = None
+
+    if mode is None:
+        if old:
+            mode = old.st_mode & int("7777", 8)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = int("666", 8) & ~umask
+
+    try:
+        fd, temp_path = tempfile.mkstemp(prefix=".poni-",
+                                         dir=os.path.dirname(file_path))
+    except OSError:
+        # no permission to create files in the directory, write in place
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+        if (owner is not None) or (group is not None):
+            os.chown(file_path, -1 if owner is None else owner,
+                     -1 if group is None else group)
+
+        return
+
+    try:
+        pos = 0
+        while pos < len(data):
+            # os.write() may write less than asked for
+            pos += os.write(fd, data[pos:])
+
+        os.fchmod(fd, mode)
+        if (owner is not None) or (group is not None):
+            os.fchown(fd, -1 if owner is None else owner,
+                      -1 if group is None else group)
+        elif old and ((old.st_uid, old.st_gid) != (os.getuid(),
+                                                   os.getgid())):
+            try:
+                os.fchown(fd, old.st_uid, old.st_gid)
+            except OSError:
+                pass # not permitted, the file gets the writer's ownership
+
+        os.close(fd)
+        fd = None
+        os.rename(temp_path, file_path)
+    except:
+        if fd is not None:
+            os.close(fd)
+
+        os.unlink(temp_path)
+        raise
+
+
+def op_utime(file_path, atime, mtime):
+    os.utime(file_path, (atime, mtime))
+
+
+def op_walk(dir_path):
+    """list a tree: [relative path, size, mtime, is_dir] for every entry"""
+    out = []
+    for root, dirs, files in os.walk(dir_path):
+        for name in dirs + files:
+            full_path = os.path.join(root, name)
+            st = os.lstat(full_path)
+            out.append([os.path.relpath(full_path, dir_path), st.st_size,
+                        int(st.st_mtime), name in dirs])
+
+    return out
+
+
+OPS = {
+    "ping": op_ping,
+    "stat": op_stat,
+    "read": op_read,
+    "sha1": op_sha1,
+    "makedirs": op_makedirs,
+    "write": op_write,
+    "utime": op_utime,
+    "walk": op_walk,
+    }
+
+
+def run_op(op):
+    try:
+        return {"ok": OPS[op[0]](*op[1:])}
+    except (OSError, IOError):
+        error = sys.exc_info()[1]
+        return {"error": str(error), "errno": error.errno}
+    except Exception:
+        error = sys.exc_info()[1]
+        return {"error": "%s: %s" % (error.__class__.__name__, error),
+                "errno": None}
+
+
+def read_frame(in_file):
+    length = in_file.readline()
+    if not length:
+        return None
+
+    return json.loads(in_file.read(int(length)).decode("utf-8"))
+
+
+def write_frame(out_file, payload):
+    data = json.dumps(payload).encode("utf-8")
+    out_file.write(("%d\n" % len(data)).encode("ascii") + data)
+    out_file.flush()
+
+
+def main():
+    in_file = getattr(sys.stdin, "buffer", sys.stdin)
+    out_file = getattr(sys.stdout, "buffer", sys.stdout)
+    while True:
+        request = read_frame(in_file)
+        if request is None:
+            break
+
+        write_frame(out_file, [run_op(op) for op in request])
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,22 @@ class Times:
         self.entry.append(dict(task_id=task_id, name=name, start=start,
                                stop=stop, args=args))
 
+    def control_durations(self, samples=3):
+        """
+        return {(task name, control op name): seconds} from the control
+        tasks of earlier runs, the average of the latest 'samples' runs
+        """
+        history = {}
+        for entry in self.entry:
+            args = entry.get("args")
+            op_name = args.get("control") if isinstance(args, dict) else None
+            if op_name:
+                history.setdefault((entry["name"], op_name), []).append(
+                    entry["stop"] - entry["start"])
+
+        return dict((key, sum(values[-samples:]) / len(values[-samples:]))
+                    for key, values in history.iteritems())
+
     def positions(self, prop, start, stop):
         span = stop - start
         if not span:
@@ -6,15 +6,20 @@ See LICENSE for details.
 
 """
 
+from __future__ import with_statement
+
 import os
 import re
 import sys
+import hashlib
 import itertools
 import logging
 import shlex
 import argh
 import glob
 import shutil
+import tempfile
+import threading
 import time
 from distutils.version import LooseVersion
 import argparse
@@ -32,12 +37,15 @@ from . import colors
 from . import version
 from . import work
 from . import times
+from . import plan
+from . import agent
 
 
 import Cheetah.Template
 from Cheetah.Template import Template as CheetahTemplate
 
 TOOL_NAME = "poni"
+PREFLIGHT_JOBS = 32 # max concurrent connection attempts in pre-flight
 
 def arg_flag(*args, **kwargs):
     return argh.arg(*args, default=False, action="store_true", **kwargs)
@@ -70,21 +78,43 @@ arg_output_dir = argh.arg("-o", "--output-dir", metavar="DIR", type=path,
                           help="write command output to files in DIR")
 arg_config_pattern = argh.arg("-c", "--config", metavar="PATTERN", type=str, nargs="*",
                               help='apply to only configs matching pattern')
+arg_no_preflight = arg_flag("--no-preflight", dest="no_preflight",
+                            help="do not connect to all hosts before starting")
+arg_adaptive = arg_flag("--adaptive", dest="adaptive",
+                        help="tune the number of concurrent tasks "
+                        "automatically, up to --jobs")
 arg_tag = argh.arg("-t", "--tag", metavar="TAG", type=str,
                    help='apply to only files that are labeled with the specified tag')
 
 
+def parse_limits(specs):
+    """parse '--limit KEY=N' arguments into a {key: n} dict"""
+    limits = {}
+    for spec in specs or []:
+        key, sep, value = spec.partition("=")
+        if not (key and sep and value.isdigit() and int(value)):
+            raise errors.UserError(
+                "invalid limit %r, expected KEY=N with N > 0" % spec)
+
+        limits[key] = int(value)
+
+    return limits
+
+
 class ControlTask(work.Task):
     def __init__(self, op, args, verbose=False, method=None, quiet=False,
-                 output_dir=None, color="auto"):
+                 output_dir=None, color="auto", limits=None, journal=None):
         work.Task.__init__(self)
         self.op = op
+        self.journal = journal
         self.args = args
         self.verbose = verbose
         self.method = method
         self.quiet = quiet
         self.output_dir = output_dir
         self.color = color
+        self.limits = dict(limits or {})
+        self.host_jobs = self.limits.pop("host", 1)
 
     def __repr__(self):
         return "%s/%s [%s]" % (self.op["node"].name, self.op["config"].name,
@@ -94,20 +124,18 @@ class ControlTask(work.Task):
         # TODO: label each output line
         self.log.info("%s: %s", self, msg)
 
-    def can_start(self):
-        """return True when it is ok to start this task"""
-        host = self.op["node"].get("host")
-        for running_task in self.runner.started:
-            if running_task.op["node"].get("host") == host:
-                # another task is already running on the same host
-                return False
+    def get_host(self):
+        # one task per host at a time unless the "host" limit is raised,
+        # nodes without a host count as one
+        return self.op["node"].get("host") or ""
 
-        for dep_op in self.op.get("depends", []):
-            if not "result" in dep_op:
-                # dependency task has not finished yet
-                return False
+    def get_latency_key(self):
+        return self.op["name"]
 
-        return True
+    def get_limits(self):
+        return dict(((("global", self.op["name"]) if key == "global"
+                      else ("limit", key)), value)
+                    for key, value in self.limits.iteritems())
 
     def check_dependencies(self):
         for dep_op in self.op.get("depends", []):
@@ -121,8 +149,14 @@ class ControlTask(work.Task):
                         dep_name))
 
     def execute(self):
+        key = config.control_key(self.op["node"], self.op["config"],
+                                 self.op["name"])
         try:
             self.op["start_time"] = time.time()
+            if self.journal:
+                self.journal.write(event="start", task=key,
+                                   time=self.op["start_time"])
+
             self.check_dependencies()
             handler_func = self.op["callback"]
             ret = handler_func(self.op["name"], self.args,
@@ -136,6 +170,7 @@ class ControlTask(work.Task):
             self.log.debug("op %s returns: %r", self.op["name"], ret)
             self.op["result"] = ret
         except errors.Error, error:
+            self.remote_error = isinstance(error, errors.RemoteError)
             self.log.error("%s/%s [%s] failed: %s: %s" % (
                     self.op["node"].name, self.op["config"].name,
                     self.op["name"], error.__class__.__name__, error))
@@ -150,6 +185,98 @@ class ControlTask(work.Task):
             raise
         finally:
             self.op["stop_time"] = time.time()
+            if self.journal:
+                self.journal.write(event="finish", task=key,
+                                   result=self.op.get("result"),
+                                   time=self.op["stop_time"])
+
+
+class RemoteOpTask(work.Task):
+    """runs a remote_op() operation on a single node"""
+    def __init__(self, index, op, arg, node, remote, host_jobs=1,
+                 output=None):
+        work.Task.__init__(self)
+        self.index = index
+        self.op = op
+        self.arg = arg
+        self.node = node
+        self.remote = remote
+        self.host_jobs = host_jobs
+        self.output = output
+        self.exit_code = -1
+
+    def __repr__(self):
+        return self.node.name
+
+    def get_host(self):
+        return self.node.get("host")
+
+    def execute(self):
+        out_file = None
+        try:
+            if self.output:
+                out_file = self.output.open(self.index)
+                exit_code = self.op(self.arg, self.node, self.remote,
+                                    output_file=out_file)
+            else:
+                exit_code = self.op(self.arg, self.node, self.remote,
+                                    prefix=True)
+
+            self.exit_code = exit_code
+        except errors.RemoteError, error:
+            self.remote_error = True
+            self.log.error("failed: %s", error)
+        finally:
+            if out_file:
+                self.output.finish(self.index, out_file)
+
+
+class OrderedOutput:
+    """
+    writes the output of concurrent operations to 'out_file' in operation
+    order, output of operations finishing early is kept in temp files
+    """
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.next_index = 0
+
+    def open(self, index):
+        return tempfile.NamedTemporaryFile(prefix="poni-output-",
+                                           delete=False)
+
+    def finish(self, index, temp_file):
+        temp_file.close()
+        with self.lock:
+            self.finished[index] = temp_file.name
+            while self.next_index in self.finished:
+                temp_path = self.finished.pop(self.next_index)
+                with file(temp_path, "rb") as temp_file:
+                    shutil.copyfileobj(temp_file, self.out_file)
+
+                os.unlink(temp_path)
+                self.next_index += 1
+
+            self.out_file.flush()
+
+
+class ConnectTask(work.Task):
+    """opens the remote connection of a single node"""
+    def __init__(self, node, remote):
+        work.Task.__init__(self)
+        self.node = node
+        self.remote = remote
+        self.error = None
+
+    def __repr__(self):
+        return self.node.name
+
+    def execute(self):
+        try:
+            self.remote.connect()
+        except errors.RemoteError, error:
+            self.error = error
 
 
 class Tool:
@@ -445,7 +572,32 @@ class Tool:
     @arg_flag("-t", "--clock-tasks", dest="show_times",
               help="show timeline of execution for each tasks")
     @argh.arg("-j", "--jobs", metavar="N", type=int,
-              help="max concurrent tasks (default: unlimited)")
+              help="max concurrent tasks (default: %d, "
+              "$PONI_MAX_WORKERS)" % work.MAX_WORKERS)
+    @argh.arg("--processes", metavar="N", type=int,
+              help="worker processes for CPU-heavy plugin work "
+              "(work.run_in_process(), default: none)")
+    @arg_adaptive
+    @argh.arg("--limit", metavar="KEY=N", action="append", dest="limits",
+              help="concurrency limit for all operations, overrides the "
+              "plugin and 'control_limits' property limits: host=N, "
+              "global=N or a named limit, can be repeated")
+    @arg_flag("--preflight", dest="preflight",
+              help="connect to all hosts before starting any tasks")
+    @arg_flag("-f", "--force",
+              help="run operations even if their inputs have not changed "
+              "since they last succeeded")
+    @argh.arg("--journal", metavar="FILE", type=path,
+              help="record task starts and results in journal FILE for "
+              "--resume")
+    @argh.arg("--resume", metavar="FILE", type=path,
+              help="resume the run recorded in journal FILE, skip the tasks "
+              "that have already succeeded")
+    @arg_flag("--plan", dest="plan",
+              help="show the tasks, their critical path and estimated time "
+              "without running anything")
+    @argh.arg("--plan-format", choices=["text", "json", "dot"],
+              default="text", help="--plan output format (default: text)")
     @argh.arg('pattern', type=str, help='config search pattern')
     @arg_host_access_method
     @argh.arg('operation', type=str, help='operation to execute')
@@ -541,25 +693,147 @@ class Tool:
                     if not dep_op.get("run"):
                         depends.remove(dep_op)
 
+        # ops with declared inputs are skipped if they have succeeded
+        # before with the same inputs, including those of the dependencies
+        digests = config.ControlDigests(
+            confman.state_dir / "control-digests.json")
+        op_digests = {} # id(op): digest
+        def input_digest(op):
+            if id(op) not in op_digests:
+                op_digests[id(op)] = None
+                if op["inputs"]:
+                    parts = [op["plugin"].control_digest(op["inputs"])]
+                    parts.extend(sorted((input_digest(dep_op) or "")
+                                        for dep_op in op.get("depends", [])))
+                    op_digests[id(op)] = hashlib.sha1(
+                        " ".join(parts)).hexdigest()
+
+            return op_digests[id(op)]
+
+        # journal, when resuming skip the tasks that have already succeeded
+        journal = None
+        if arg.resume or arg.journal:
+            journal = config.ControlJournal(arg.resume or arg.journal)
+
+        completed = set()
+        if arg.resume:
+            if not arg.resume.isfile():
+                raise errors.UserError("journal %r does not exist" % (
+                        str(arg.resume)))
+
+            records = journal.read()[0]
+            run = records[0] if records else {}
+            if ((run.get("event") != "run")
+                or (run.get("pattern") != arg.pattern)
+                or (run.get("operation") != arg.operation)
+                or ((run.get("extras") or []) != (arg.extras or []))):
+                raise errors.UserError(
+                    "journal %r is not for 'control %s %s%s'" % (
+                        str(arg.resume), arg.pattern, arg.operation,
+                        "".join(" %s" % extra
+                                for extra in (arg.extras or []))))
+
+            completed = journal.completed(records)
+
         # assign tasks
-        runner = work.Runner(max_jobs=arg.jobs)
+        cli_limits = parse_limits(arg.limits)
+        # worker processes are forked here, before any threads are started
+        runner = work.Runner(max_jobs=arg.jobs,
+                             processes=(None if arg.plan else arg.processes),
+                             adaptive=arg.adaptive)
         logger = self.log.info if arg.verbose else self.log.debug
+        op_tasks = {} # id(op): task
         for op_id, op in tasks.iteritems():
             run = op.get("run") or (not arg.no_deps)
             op["run"] = run
             if not run:
                 continue
 
+            if config.control_key(op["node"], op["config"],
+                                  op["name"]) in completed:
+                logger("already done, skipped: %s/%s [%s]", op["node"].name,
+                       op["config"].name, op["name"])
+                op["run"] = False
+                op["result"] = None
+                continue
+
+            digest = input_digest(op)
+            if digest and (not arg.force) and (
+                digest == digests.get(op["node"], op["config"], op["name"])):
+                logger("inputs unchanged, skipped: %s/%s [%s]",
+                       op["node"].name, op["config"].name, op["name"])
+                op["run"] = False
+                op["result"] = None # dependents see a satisfied dependency
+                continue
+
             plugin = op["plugin"]
             logger("scheduled to run: %s/%s [%s]", op["node"].name,
                    op["config"].name, op["name"])
+            limits = dict(op.get("limits") or {})
+            node_limits = op["node"].get_tree_property("control_limits",
+                                                       None) or {}
+            limits.update(node_limits.get(op["name"]) or {})
+            limits.update(cli_limits)
+            for key, value in limits.iteritems():
+                if not (isinstance(value, int) and (value > 0)):
+                    raise errors.UserError(
+                        "%s/%s [%s]: invalid limit %s=%r" % (
+                            op["node"].name, op["config"].name, op["name"],
+                            key, value))
+
             task = ControlTask(op, arg.extras, verbose=arg.verbose,
                                quiet=arg.quiet, output_dir=arg.output_dir,
-                               method=arg.method, color=arg.color)
+                               method=arg.method, color=arg.color,
+                               limits=limits, journal=journal)
             runner.add_task(task)
+            op_tasks[id(op)] = task
+
+        for task in op_tasks.itervalues():
+            task.depends = [op_tasks[id(dep_op)]
+                            for dep_op in task.op.get("depends", [])
+                            if id(dep_op) in op_tasks]
+
+        self.prioritize_control_tasks(op_tasks.values())
+
+        if arg.plan:
+            skipped_count = sum(1 for op in tasks.itervalues()
+                                if not op["run"])
+            control_plan = plan.ControlPlan(
+                op_tasks.values(), duration=self.get_control_duration(),
+                max_jobs=runner.workers.size, skipped=skipped_count)
+            if arg.plan_format == "json":
+                sys.stdout.write(control_plan.as_json())
+            elif arg.plan_format == "dot":
+                sys.stdout.writelines(control_plan.iter_dot())
+            else:
+                sys.stdout.writelines(control_plan.iter_report(
+                        verbose=arg.verbose))
+
+            sys.stdout.flush()
+            return
+
+        if arg.preflight:
+            # nodes without a host yet are typically created by the tasks
+            nodes = []
+            for task in runner.not_started:
+                node = task.op["node"]
+                if node.get("host") and (node not in nodes):
+                    nodes.append(node)
+
+            self.preflight(nodes, method=arg.method, abort=True)
 
         # execute tasks
-        runner.run_all()
+        if journal:
+            journal.open(resume=bool(arg.resume))
+            journal.write(event="run", pattern=arg.pattern,
+                          operation=arg.operation, extras=arg.extras,
+                          resume=bool(arg.resume), time=time.time())
+
+        try:
+            runner.run_all()
+        finally:
+            if journal:
+                journal.close()
 
         # collect results
         results = [task.op.get("result") for task in runner.stopped]
@@ -568,12 +842,24 @@ class Tool:
         ran_count = len(tasks) - skipped_count
         assert len(results) == ran_count
 
+        if op_digests:
+            for task in runner.stopped:
+                op = task.op
+                digests.set(op["node"], op["config"], op["name"],
+                            None if op.get("result") else
+                            op_digests.get(id(op)))
+
+            digests.save()
+
         # add task times to report
         for i, task in enumerate(runner.stopped):
             task_name = "%s/%s" % (task.op["node"].name,
                                    task.op["config"].name)
             self.task_times.add_task(i, task_name, task.op["start_time"],
-                                     task.op["stop_time"])
+                                     task.op["stop_time"],
+                                     args=dict(control=task.op["name"]))
+
+        self.add_concurrency_times(runner)
 
         if arg.verbose:
             for task in runner.stopped:
@@ -585,6 +871,13 @@ class Tool:
                                    task.op["result"])
 
         self.log.debug("all tasks finished: %r", results)
+        if failed and journal:
+            self.log.info("to run the failed and remaining tasks again: "
+                          "poni control --resume %s %s %s%s",
+                          journal.file_path, arg.pattern, arg.operation,
+                          "".join(" " + a for a in (["--"] + arg.extras
+                                                    if arg.extras else [])))
+
         if failed:
             raise errors.ControlError(
                 "[%d/%d] control tasks failed (%d skipped)" % (
@@ -594,6 +887,45 @@ class Tool:
                 "all [%d] control tasks finished successfully (%d skipped)" % (
                     ran_count, skipped_count))
 
+    def prioritize_control_tasks(self, tasks):
+        """
+        start the tasks on the longest remaining path first, using the
+        durations of earlier runs recorded with '--time-log'
+        """
+        duration = self.get_control_duration()
+        if duration:
+            work.set_critical_path(tasks, duration)
+
+    def get_control_duration(self):
+        """
+        return a function giving the expected duration of a ControlTask
+        based on the earlier runs recorded with '--time-log', None if there
+        are no recorded runs
+        """
+        durations = self.task_times.control_durations()
+        if not durations:
+            return None
+
+        # ops not seen on this node: the average of the op on other nodes
+        op_durations = {}
+        for (task_name, op_name), duration in durations.iteritems():
+            op_durations.setdefault(op_name, []).append(duration)
+
+        default = sum(durations.itervalues()) / len(durations)
+        def duration(task):
+            op_name = task.op["name"]
+            key = ("%s/%s" % (task.op["node"].name, task.op["config"].name),
+                   op_name)
+            if key in durations:
+                return durations[key]
+            elif op_name in op_durations:
+                return (sum(op_durations[op_name]) /
+                        len(op_durations[op_name]))
+
+            return default
+
+        return duration
+
     @argh.alias("exec")
     @arg_verbose
     @arg_quiet
@@ -601,24 +933,41 @@ class Tool:
     @arg_full_match
     @arg_target_nodes
     @arg_host_access_method
+    @argh.arg("-j", "--jobs", metavar="N", type=int,
+              help="max nodes to run the command on concurrently (default: 1)")
+    @argh.arg("--host-jobs", metavar="N", type=int, default=1,
+              help="max concurrent commands per host (default: 1)")
+    @arg_flag("--interleave",
+              help="with --jobs: stream output lines prefixed with the node "
+              "name instead of showing each node's output in node order")
+    @arg_adaptive
+    @arg_no_preflight
     @argh.arg('cmd', type=str, help='command to execute')
     def handle_remote_exec(self, arg):
         """run a shell-command"""
         confman = self.get_confman(arg.root_dir, reset_cache=False)
-        def rexec(arg, node, remote):
+        def rexec(arg, node, remote, output_file=None, prefix=False):
             color = colors.Output(sys.stdout, color=arg.color).color
+            verbose = arg.verbose
             if arg.output_dir:
                 output_file_path = arg.output_dir / ("%s.log" % node.name.replace("/", "_"))
                 output_file = output_file_path.open("wt")
-            else:
+            elif arg.quiet:
                 output_file = None
+            elif output_file:
+                # buffered for ordered output, tag lines go to the buffer
+                verbose = False
 
-            return remote.execute(arg.cmd, verbose=arg.verbose, color=color,
+            return remote.execute(arg.cmd, verbose=verbose, color=color,
                                   quiet=arg.quiet,
-                                  output_file=output_file)
+                                  output_file=output_file, prefix=prefix)
 
         rexec.doc = "exec: %r" % arg.cmd
-        result = self.remote_op(confman, arg, rexec, exclude=arg.exclude)
+        result = self.remote_op(confman, arg, rexec, exclude=arg.exclude,
+                                jobs=arg.jobs, host_jobs=arg.host_jobs,
+                                interleave=arg.interleave,
+                                adaptive=arg.adaptive,
+                                preflight=(not arg.no_preflight))
         if result:
             raise errors.RemoteError("remote exec failed with code: %r" % (
                     result,))
@@ -638,30 +987,147 @@ class Tool:
         rshell.doc = "shell"
         self.remote_op(confman, arg, rshell)
 
-    def remote_op(self, confman, arg, op, exclude=None):
+    def preflight(self, nodes, method=None, abort=False):
+        """
+        connect to all 'nodes' concurrently before any work is started,
+        returns the nodes that could not be reached or, with 'abort' set,
+        raises RemoteError listing them
+        """
+        runner = work.Runner(max_jobs=PREFLIGHT_JOBS)
+        tasks = []
+        for node in nodes:
+            if node.get_tree_property("template"):
+                continue
+
+            # remotes are created here as the remote cache is not thread-safe
+            task = ConnectTask(node, node.get_remote(override=method))
+            runner.add_task(task)
+            tasks.append(task)
+
+        if not tasks:
+            return []
+
+        start = time.time()
+        runner.run_all()
+        failed = [task for task in tasks if task.error]
+        for task in failed:
+            self.log.error("pre-flight: %s (%s): %s", task.node.name,
+                           task.node.get("host"), task.error)
+
+        self.log.debug("pre-flight: %d/%d nodes connected in %.1fs",
+                       len(tasks) - len(failed), len(tasks),
+                       time.time() - start)
+        if failed and abort:
+            raise errors.RemoteError(
+                "pre-flight: [%d/%d] nodes unreachable: %s" % (
+                    len(failed), len(tasks),
+                    ", ".join(task.node.name for task in failed)))
+        elif failed:
+            self.log.error("pre-flight: [%d/%d] nodes unreachable, skipped: %s",
+                           len(failed), len(tasks),
+                           ", ".join(task.node.name for task in failed))
+
+        return [task.node for task in failed]
+
+    def remote_op(self, confman, arg, op, exclude=None, jobs=None,
+                  host_jobs=1, interleave=False, preflight=False,
+                  adaptive=False):
+        """
+        run 'op' on all matching nodes, one node at a time or, if 'jobs' is
+        given, on up to 'jobs' nodes concurrently
+
+        Concurrent ops are called with either an 'output_file' to write to
+        (output is shown in node order) or with 'prefix=True' (output lines
+        are interleaved and labeled with the node name).
+        """
         ret = 0
         nodes = list(confman.find(arg.nodes, full_match=arg.full_match,
                                   exclude=exclude))
         if not nodes:
             raise errors.UserError("%r does not match any nodes" % (arg.nodes))
 
-        for node in nodes:
-            if node.get_tree_property("template"):
-                # don't try to run anything on template nodes
-                continue
+        # don't try to run anything on template nodes
+        nodes = [node for node in nodes
+                 if not node.get_tree_property("template")]
+        unreachable = []
+        if preflight:
+            unreachable = self.preflight(nodes, method=arg.method)
+            nodes = [node for node in nodes if node not in unreachable]
+
+        if (jobs and (jobs > 1)) or adaptive:
+            results = self.remote_op_concurrent(nodes, arg, op, jobs,
+                                                host_jobs, interleave,
+                                                adaptive=adaptive)
+        else:
+            results = []
+            for node in nodes:
+                remote = node.get_remote(override=arg.method)
+                start = time.time()
+                try:
+                    # TODO: pass color arg
+                    exit_code = op(arg, node, remote)
+                except errors.RemoteError, error:
+                    self.log.error("failed: %s", error)
+                    exit_code = -1
+
+                results.append((node, exit_code, start, time.time()))
+
+        now = time.time()
+        results.extend((node, -1, now, now) for node in unreachable)
+        for i, (node, exit_code, start, stop) in enumerate(results):
+            self.task_times.add_task(i, node.name, start, stop,
+                                     args=dict(exit_code=exit_code))
+            if (not ret) and exit_code:
+                ret = exit_code
 
-            remote = node.get_remote(override=arg.method)
+        return ret
 
-            try:
-                # TODO: pass color arg
-                exit_code = op(arg, node, remote)
-                if (not ret) and exit_code:
-                    ret = exit_code
-            except errors.RemoteError, error:
-                self.log.error("failed: %s", error)
-                ret = -1
+    def remote_op_concurrent(self, nodes, arg, op, jobs, host_jobs,
+                             interleave, adaptive=False):
+        output = None if interleave else OrderedOutput(sys.stdout)
+        runner = work.Runner(max_jobs=jobs, adaptive=adaptive)
+        tasks = []
+        for i, node in enumerate(nodes):
+            # remotes are created here as the remote cache is not thread-safe
+            remote = node.get_remote(override=arg.method)
+            task = RemoteOpTask(i, op, arg, node, remote, host_jobs=host_jobs,
+                                output=output)
+            runner.add_task(task)
+            tasks.append(task)
 
-        return ret
+        runner.run_all()
+        self.add_concurrency_times(runner)
+        return [(task.node, task.exit_code, task.start_time, task.stop_time)
+                for task in tasks]
+
+    def add_concurrency_times(self, runner):
+        """add the concurrency changes of an adaptive runner to the report"""
+        if not runner.adaptive:
+            return
+
+        for i, (when, old, new, reason) in enumerate(
+            runner.adaptive.decisions):
+            name = "concurrency %d -> %d: %s" % (old, new, reason)
+            self.task_times.add_task("A%d" % (i + 1), name, when, when,
+                                     args=dict(concurrency=new))
+
+    @argh.alias("agent")
+    @argh.arg("-s", "--socket", metavar="FILE", type=str, dest="socket_path",
+              help="unix socket path (default: $%s or "
+              "$HOME/.poni/agent.sock)" % agent.SOCKET_ENV)
+    @argh.arg("--max-connections", metavar="N", type=int, default=256,
+              help="max pooled connections (default: 256)")
+    @argh.arg("--idle-timeout", metavar="SECONDS", type=float, default=300.0,
+              help="close connections idle for longer (default: 300)")
+    def handle_agent(self, arg):
+        """
+        run a connection agent that keeps SSH connections open, use it
+        by setting $PONI_AGENT_SOCKET to its socket path or with '-m agent'
+        """
+        pool = agent.ConnectionPool(max_size=arg.max_connections,
+                                    idle_timeout=arg.idle_timeout)
+        server = agent.AgentServer(arg.socket_path, pool)
+        server.run()
 
     @argh.alias("init")
     def handle_vc_init(self, arg):
@@ -952,27 +1418,44 @@ class Tool:
         if items:
             return items
 
+        items = self.collect_nodes(manager, lambda name: True)
+        self.collect_cache[manager] = items
+
+        return items
+
+    def collect_nodes(self, manager, node_filter):
+        """collect the plugins of the nodes whose name passes 'node_filter'"""
         items = []
         for item in manager.confman.find("."):
-            item.collect(manager)
-            items.append(item)
+            if node_filter(item.name):
+                item.collect(manager)
+                items.append(item)
 
         # parents need to be collected _after_ all nodes have been collected,
         # so that every parent node is loaded and available with full props
         for item in items:
             item.collect_parents(manager)
 
-        self.collect_cache[manager] = items
-
         return items
 
+    def get_collect_scope(self, confman, node_filter, fingerprint):
+        """
+        return the names of the nodes whose plugins are needed to verify the
+        nodes passing 'node_filter': those nodes and the nodes adding to the
+        buckets they read according to the bucket graph recorded by the last
+        verify of all nodes, None if the repository has changed since
+        """
+        graph = config.BucketGraph(
+            confman.state_dir / "buckets.json")
+        if graph.fingerprint != fingerprint:
+            return None
+
+        return graph.scope(node.name for node in confman.find(".")
+                           if node_filter(node.name))
+
     def verify_op(self, confman, target, full_match=False, exclude=None,
-                  **verify_options):
+                  preflight=False, **verify_options):
         manager = self.get_manager(confman)
-        self.collect_all(manager)
-        self.log.debug("verify_op %r: confman cache=%r, manager files=%r, buckets=%r",
-                       target, confman.dump_stats(), len(manager.files), dict((k, len(v)) for k, v in manager.buckets.iteritems()))
-
         if target:
             if exclude:
                 exclude = re.compile(exclude).search
@@ -984,13 +1467,68 @@ class Tool:
             else:
                 search_op = re.compile(target).search
 
-            def target_filter(item):
-                return (search_op(item["node"].name)
-                        and not exclude(item["node"].name))
+            def node_filter(name):
+                return search_op(name) and not exclude(name)
+        else:
+            node_filter = lambda name: True
+
+        target_filter = lambda item: node_filter(item["node"].name)
+
+        # with a target collect only the plugins the target nodes need, the
+        # bucket graph is recorded by the first targeted run that has to
+        # collect all nodes
+        scope = None
+        fingerprint = None
+        if target and (manager not in self.collect_cache):
+            fingerprint = confman.fingerprint()
+            scope = self.get_collect_scope(confman, node_filter, fingerprint)
+
+        if scope is None:
+            self.collect_all(manager)
         else:
-            target_filter = lambda item: True
+            self.log.debug("collecting %d nodes: %s", len(scope),
+                           ", ".join(sorted(scope)))
+            self.collect_nodes(manager, scope.__contains__)
+
+        self.log.debug("verify_op %r: confman cache=%r, manager files=%r, buckets=%r",
+                       target, confman.dump_stats(), len(manager.files), dict((k, len(v)) for k, v in manager.buckets.iteritems()))
+
+        skipped = []
+        if preflight:
+            nodes = []
+            for entry in manager.files:
+                node = entry["node"]
+                if ((node not in nodes) and node.verify_enabled()
+                    and not entry.get("report") and target_filter(entry)):
+                    nodes.append(node)
+
+            unreachable = self.preflight(
+                nodes, method=verify_options.get("access_method"))
+            if unreachable:
+                # files of unreachable nodes are only rendered (their bucket
+                # records are still needed) and are counted as errors
+                reachable_filter = target_filter
+                def target_filter(item):
+                    if item["node"] not in unreachable:
+                        return reachable_filter(item)
+                    elif item["type"] != "dir":
+                        skipped.append(item)
+
+                    return False
 
         stats = manager.verify(callback=target_filter, **verify_options)
+        stats["error_count"] += len(skipped)
+        # writers of configs filtered out by --config are never recorded
+        if fingerprint and (scope is None) \
+                and not verify_options.get("config_patterns"):
+            try:
+                config.BucketGraph(
+                    confman.state_dir / "buckets.json").save(
+                    fingerprint, manager)
+            except (OSError, IOError), error:
+                self.log.debug("bucket graph not saved: %s: %s",
+                               error.__class__.__name__, error)
+
         return manager, stats
 
     @argh.alias("show")
@@ -1036,14 +1574,26 @@ class Tool:
     @arg_host_access_method
     @arg_config_pattern
     @arg_tag
+    @arg_flag("--plan", dest="plan",
+              help="show what would be deployed without writing anything")
+    @arg_no_preflight
     def handle_deploy(self, arg):
         """deploy node configs"""
         confman = self.get_confman(arg.root_dir, reset_cache=False)
+        deploy_plan = plan.DeployPlan() if arg.plan else None
         manager, stats = self.verify_op(
-            confman, arg.nodes, show=False, deploy=True, verbose=arg.verbose,
-            full_match=arg.full_match, path_prefix=arg.path_prefix,
-            access_method=arg.method, color=arg.color,
-            exclude=arg.exclude, config_patterns=arg.config, tag=arg.tag)
+            confman, arg.nodes, show=False, deploy=(not arg.plan),
+            verbose=arg.verbose, full_match=arg.full_match,
+            path_prefix=arg.path_prefix, access_method=arg.method,
+            color=arg.color, exclude=arg.exclude, config_patterns=arg.config,
+            tag=arg.tag, plan=deploy_plan,
+            preflight=(not arg.no_preflight))
+        if deploy_plan:
+            for chunk in deploy_plan.iter_report(verbose=arg.verbose):
+                sys.stdout.write(chunk)
+
+            sys.stdout.flush()
+
         if stats.error_count:
             raise errors.VerifyError("failed: files with errors: [%d/%d]" % (
                            stats.error_count, stats.file_count))
@@ -1061,6 +1611,7 @@ class Tool:
     @arg_flag("-d", "--diff", dest="show_diff", help="show config diffs")
     @arg_config_pattern
     @arg_tag
+    @arg_no_preflight
     def handle_audit(self, arg):
         """audit active node configs"""
         confman = self.get_confman(arg.root_dir, reset_cache=False)
@@ -1069,7 +1620,8 @@ class Tool:
             show_diff=arg.show_diff, full_match=arg.full_match,
             path_prefix=arg.path_prefix, access_method=arg.method,
             color=arg.color, verbose=arg.verbose,
-            exclude=arg.exclude, config_patterns=arg.config, tag=arg.tag)
+            exclude=arg.exclude, config_patterns=arg.config, tag=arg.tag,
+            preflight=(not arg.no_preflight))
 
         if stats.error_count:
             raise errors.VerifyError("failed: files with errors: [%d/%d]" % (
@@ -1178,8 +1730,13 @@ class Tool:
         """list systems and nodes"""
         confman = self.get_confman(arg.root_dir, reset_cache=False)
 
-        manager = self.get_manager(confman)
-        self.collect_all(manager) # TODO: needed by "list -C"
+        if arg.show_controls:
+            # only the listed nodes' plugins are needed for their controls
+            manager = self.get_manager(confman)
+            names = set(node.name for node in confman.find(
+                    arg.pattern, full_match=arg.full_match,
+                    exclude=arg.exclude))
+            self.collect_nodes(manager, names.__contains__)
 
         list_output = listout.ListOutput(self, confman, **arg.__dict__)
         for output in list_output.output():
@@ -1309,7 +1866,7 @@ class Tool:
             self.handle_control, self.handle_require, self.handle_add_library,
             self.handle_set, self.handle_show, self.handle_deploy,
             self.handle_audit, self.handle_verify, self.handle_add_node,
-            self.handle_report,
+            self.handle_report, self.handle_agent,
             ]
         commands.sort(key=lambda func: func.__name__)
         parser.add_commands(commands)
@@ -1422,6 +1979,11 @@ class Tool:
             if namespace.time_log:
                 self.task_times.save(namespace.time_log)
 
+            tripped = rcontrol_all.manager.health.tripped
+            if tripped:
+                self.log.error("unreachable, operations skipped: %s",
+                               ", ".join(sorted(tripped)))
+
             rcontrol_all.manager.cleanup()
 
         return exit_code
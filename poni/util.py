@@ -127,6 +127,23 @@ def parse_count(count_str):
     raise errors.InvalidRange("invalid range: %r" % (count_str,))
 
 
+def parse_size(size):
+    """
+    parse a byte count given as a number or a string with an optional
+    'k', 'M' or 'G' suffix (powers of 1024)
+    """
+    if isinstance(size, (int, long, float)):
+        return int(size)
+
+    size_str = str(size).strip()
+    multiplier = 1024 ** ("kMG".find(size_str[-1:]) + 1) \
+        if size_str[-1:] in ("k", "M", "G") else 1
+    try:
+        return int(float(size_str.rstrip("kMG")) * multiplier)
+    except ValueError:
+        raise errors.InvalidProperty("invalid size: %r" % (size,))
+
+
 def format_error(error):
     return "ERROR: %s: %s" % (error.__class__.__name__, error)
 
@@ -6,13 +6,29 @@ See LICENSE for details.
 
 """
 
+import heapq
+import itertools
+import multiprocessing
+import os
 import time
 import logging
 import threading
 import Queue as queue
+from . import errors
+
+# concurrent tasks when the runner has no 'max_jobs' limit
+MAX_WORKERS = int(os.environ.get("PONI_MAX_WORKERS", 64))
+
+_local = threading.local()
 
 
 class Task(threading.Thread):
+    """
+    a unit of work run by a Runner
+
+    Tasks are run by the runner's worker threads calling run(), the thread
+    of the task itself is never started.
+    """
     def __init__(self, target=None):
         threading.Thread.__init__(self, target=target)
         self.log = logging.getLogger("task")
@@ -20,8 +36,38 @@ class Task(threading.Thread):
         self.runner = None
         self.start_time = None
         self.stop_time = None
+        self.depends = [] # tasks that must finish before this one starts
+        self.host_jobs = 1 # max tasks running on the same host
+        self.priority = 0 # ready tasks with a higher priority start first
+        self.remote_error = False # set when failed to a connection error
+
+    def get_host(self):
+        """
+        return the host this task runs on, at most 'host_jobs' tasks of the
+        same host run concurrently, None means no limit
+        """
+        return None
+
+    def get_limits(self):
+        """
+        return {key: max} of further limits: the task is started only while
+        fewer than 'max' tasks with the same key are running
+        """
+        return {}
+
+    def get_latency_key(self):
+        """
+        return a key for tasks expected to take about as long as each other,
+        an adaptive limit compares the latency of a task only to the tasks
+        with the same key
+        """
+        return None
 
     def can_start(self):
+        """
+        override to decide when the task can start: such tasks are polled
+        whenever a task finishes, 'depends' and get_host() are indexed
+        """
         return True
 
     def execute(self):
@@ -36,14 +82,224 @@ class Task(threading.Thread):
             self.runner.task_finished(self)
 
 
+def is_polled(task):
+    return task.can_start.im_func is not Task.can_start.im_func
+
+
+def set_critical_path(tasks, duration):
+    """
+    set the priority of each task to the longest path from its start to the
+    end of the run: its own 'duration(task)' plus the longest path of the
+    tasks depending on it, so the tasks holding up the most work start first
+    """
+    dependents = dict((task, []) for task in tasks)
+    pending = dict((task, 0) for task in tasks)
+    for task in tasks:
+        for dep in set(task.depends):
+            if dep in dependents:
+                dependents[dep].append(task)
+                pending[dep] += 1
+
+    # from the last tasks backwards
+    order = [task for task in tasks if not pending[task]]
+    for task in order:
+        task.priority = duration(task) + max(
+            [dependent.priority for dependent in dependents[task]] or [0])
+        for dep in set(task.depends):
+            if dep in pending:
+                pending[dep] -= 1
+                if not pending[dep]:
+                    order.append(dep)
+
+
+def run_in_process(func, *args):
+    """
+    call func(*args) in a worker process of the current runner if it has
+    any (CPU-heavy work), otherwise in the calling thread
+
+    'func', the arguments and the return value must be picklable.
+    """
+    runner = getattr(_local, "runner", None)
+    if runner and runner.processes:
+        return runner.processes.call(func, *args)
+
+    return func(*args)
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit: grows by one after a window of 'limit' tasks
+    finishes without remote errors while the average task latency stays
+    within 'latency_factor' times the lowest seen, halves on a remote error
+    or a latency rise, at most one change per window
+
+    Latencies are averaged per key given to update(), so that slow kinds of
+    tasks are not compared to fast ones.
+
+    The changes are kept in 'decisions' as (time, old, new, reason).
+    """
+    def __init__(self, maximum, initial=2, minimum=1, latency_factor=2.0,
+                 smoothing=0.3):
+        self.log = logging.getLogger("runner")
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = max(minimum, min(initial, maximum))
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+        self.averages = {} # key: smoothed latency
+        self.baselines = {} # key: lowest smoothed latency
+        self.window = 0 # tasks finished since the last change
+        self.errors = 0 # remote errors since the last change
+        self.decisions = []
+
+    def update(self, latency, error=False, key=None):
+        average = self.averages.get(key)
+        if average is None:
+            average = latency
+        else:
+            average += self.smoothing * (latency - average)
+
+        self.averages[key] = average
+        if (key not in self.baselines) or (average < self.baselines[key]):
+            self.baselines[key] = average
+
+        self.window += 1
+        if error:
+            self.errors += 1
+
+        if self.window < self.limit:
+            return
+
+        risen = [k for k, avg in self.averages.iteritems()
+                 if avg > (self.baselines[k] * self.latency_factor)]
+        if self.errors:
+            self.change(self.limit // 2, "%d remote errors" % self.errors)
+        elif risen:
+            self.change(self.limit // 2, ", ".join(
+                    "latency %.1fs, lowest %.1fs" % (
+                        self.averages[k], self.baselines[k])
+                    for k in risen))
+            # latencies are compared to the new level from now on
+            for k in risen:
+                self.baselines[k] = self.averages[k]
+        else:
+            self.change(self.limit + 1, "latency %.1fs" % average)
+
+    def change(self, limit, reason):
+        limit = max(self.minimum, min(limit, self.maximum))
+        self.window = 0
+        self.errors = 0
+        if limit == self.limit:
+            return
+
+        self.log.debug("concurrency %d -> %d: %s", self.limit, limit, reason)
+        self.decisions.append((time.time(), self.limit, limit, reason))
+        self.limit = limit
+
+
+class ThreadPool:
+    """
+    up to 'size' worker threads running submitted callables, threads are
+    started as needed
+    """
+    def __init__(self, size):
+        self.size = size
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.idle = 0
+
+    def submit(self, func, *args):
+        with self.lock:
+            if (not self.idle) and (len(self.threads) < self.size):
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            else:
+                self.idle -= 1
+
+        self.jobs.put((func, args))
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            func, args = job
+            try:
+                func(*args)
+            except Exception:
+                # keep the worker alive, tasks report their own failures
+                logging.getLogger("runner").exception("worker job failed")
+
+            with self.lock:
+                self.idle += 1
+
+    def close(self, wait=True):
+        for thread in self.threads:
+            self.jobs.put(None)
+
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+        self.threads = []
+
+
+class ProcessPool:
+    """
+    worker processes for run_in_process(), forked right away: forking later
+    from a process running threads could copy locks held by them (e.g.
+    Paramiko's) into the workers
+    """
+    def __init__(self, size):
+        self.size = size
+        self.pool = multiprocessing.Pool(self.size)
+
+    def call(self, func, *args):
+        return self.pool.apply(func, args)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
 class Runner:
-    def __init__(self, max_jobs=None):
+    """
+    runs tasks in threads as their dependencies finish
+
+    Tasks whose dependencies have finished wait in a ready queue ordered by
+    'priority', or in a queue of their own per host or limit key while the
+    host or key is busy, so a finished task releases the tasks waiting for
+    it without scanning the others. At most
+    'max_jobs' (default: MAX_WORKERS) tasks run at a time in a pool of
+    worker threads, with 'processes' set run_in_process() uses a pool of
+    that many worker processes, started when the runner is created, before
+    any threads. With 'adaptive' set the number of tasks
+    running at a time is tuned by an AdaptiveLimit up to 'max_jobs'.
+    """
+    def __init__(self, max_jobs=None, processes=None, adaptive=False):
         self.log = logging.getLogger("runner")
         self.not_started = set()
         self.started = set()
         self.stopped = set()
         self.finished_queue = queue.Queue()
         self.max_jobs = max_jobs
+        self.workers = ThreadPool(max_jobs or MAX_WORKERS)
+        self.processes = ProcessPool(processes) if processes else None
+        self.adaptive = AdaptiveLimit(self.workers.size) if adaptive else None
+        self.waiting = {} # task: number of unfinished dependencies
+        self.dependents = {} # task: tasks depending on it
+        self.ready = [] # heap of (-priority, seq, task)
+        self.seq = itertools.count()
+        self.polled = set() # ready tasks with their own can_start()
+        self.running = {} # limit key: number of running tasks
+        self.blocked = {} # limit key: heap of ready tasks
+        self.task_limits = {} # running task: its limit keys
 
     def add_task(self, task):
         task.runner = self
@@ -52,17 +308,136 @@ class Runner:
     def task_finished(self, task):
         self.finished_queue.put(task)
 
-    def check(self):
-        for task in list(self.not_started):
-            if self.max_jobs and (len(self.started) > self.max_jobs):
+    def index(self):
+        """build the dependency counters of tasks not indexed yet"""
+        tasks = self.not_started | self.started | self.stopped
+        for task in self.not_started:
+            if task in self.waiting:
                 continue
 
-            if not task.can_start():
-                continue
+            depends = set(dep for dep in task.depends
+                          if (dep in tasks) and (dep not in self.stopped))
+            self.waiting[task] = len(depends)
+            for dep in depends:
+                self.dependents.setdefault(dep, []).append(task)
+
+            if not depends:
+                self.release(task)
+
+    def release(self, task):
+        """all dependencies of 'task' have finished"""
+        if is_polled(task):
+            self.polled.add(task)
+        else:
+            self.push(self.ready, task)
+
+    def push(self, heap, task):
+        heapq.heappush(heap, (-task.priority, self.seq.next(), task))
+
+    def full(self):
+        if self.adaptive:
+            return len(self.started) >= self.adaptive.limit
+
+        return len(self.started) >= self.workers.size
+
+    def get_limits(self, task):
+        limits = dict(task.get_limits())
+        host = task.get_host()
+        if host is not None:
+            limits[("host", host)] = task.host_jobs
+
+        return limits
+
+    def start_task(self, task, limits=None):
+        self.started.add(task)
+        self.not_started.remove(task)
+        if limits:
+            for key in limits:
+                self.running[key] = self.running.get(key, 0) + 1
+
+            self.task_limits[task] = limits
+
+        self.workers.submit(self.run_task, task)
+
+    def run_task(self, task):
+        _local.runner = self
+        try:
+            task.run()
+        finally:
+            _local.runner = None
+
+    def check(self):
+        for task in list(self.polled):
+            if self.full():
+                return
+
+            if task.can_start():
+                self.polled.remove(task)
+                self.start_task(task)
 
-            self.started.add(task)
-            self.not_started.remove(task)
-            task.start()
+        while self.ready and not self.full():
+            task = heapq.heappop(self.ready)[-1]
+            limits = self.get_limits(task)
+            key = self.busy_key(limits)
+            if key is None:
+                self.start_task(task, limits)
+            else:
+                # woken up when a task with the same key finishes
+                self.push(self.blocked.setdefault(key, []), task)
+
+    def busy_key(self, limits):
+        """return a limit key that has no room for another task, if any"""
+        for key, max_running in limits.iteritems():
+            if self.running.get(key, 0) >= max_running:
+                return key
+
+        return None
+
+    def finish_task(self, task):
+        self.started.remove(task)
+        self.stopped.add(task)
+        if self.adaptive:
+            self.adaptive.update(task.stop_time - task.start_time,
+                                 task.remote_error,
+                                 key=task.get_latency_key())
+        for key in self.task_limits.pop(task, ()):
+            self.running[key] -= 1
+            self.wake(key)
+
+        for dependent in self.dependents.pop(task, []):
+            self.waiting[dependent] -= 1
+            if not self.waiting[dependent]:
+                self.release(dependent)
+
+    def wake(self, key):
+        """
+        make a task blocked on 'key' ready now that the key has room, the
+        tasks still blocked on another key move to wait for that key
+        """
+        blocked = self.blocked.get(key)
+        deferred = [] # tasks with a lower limit for the same key
+        while blocked:
+            task = heapq.heappop(blocked)[-1]
+            busy = self.busy_key(self.get_limits(task))
+            if busy is None:
+                self.push(self.ready, task)
+                break
+            elif busy == key:
+                deferred.append(task)
+            else:
+                self.push(self.blocked.setdefault(busy, []), task)
+
+        for task in deferred:
+            self.push(blocked, task)
+
+    def validate_limits(self):
+        """a limit below one would keep its tasks waiting forever"""
+        for task in self.not_started:
+            for key, max_running in self.get_limits(task).iteritems():
+                if max_running < 1:
+                    raise errors.UserError(
+                        "%s: limit %r must be at least 1, got %r" % (
+                            task, key, max_running))
 
     def wait_task_to_finish(self):
         try:
@@ -76,12 +451,28 @@ class Runner:
 
         self.log.debug("task %s finished, took %.2f seconds", task,
                        (task.stop_time - task.start_time))
-        self.started.remove(task)
-        self.stopped.add(task)
+        self.finish_task(task)
         self.finished_queue.task_done()
 
     def run_all(self):
-        while self.not_started or self.started:
-            self.check()
-            self.wait_task_to_finish()
+        self.validate_limits()
+        self.index()
+        done = False
+        try:
+            while self.not_started or self.started:
+                self.check()
+                if not self.started and not self.polled:
+                    # nothing running, nothing ready: the rest wait for each
+                    # other
+                    raise errors.ControlError(
+                        "dependency cycle between tasks: %s" % ", ".join(
+                            sorted(str(task) for task in self.not_started)))
 
+                self.wait_task_to_finish()
+
+            done = True
+        finally:
+            # running tasks are not waited for if interrupted
+            self.workers.close(wait=done)
+            if self.processes:
+                self.processes.close()
@@ -33,6 +33,8 @@ class Helper:
 
     def init_repo(self):
         repo = self.temp_file()
+        # keep the run state of test repos out of $HOME
+        os.environ["PONI_STATE_DIR"] = self.temp_dir()
         poni = tool.Tool(default_repo_path=repo)
         assert not poni.run(["init"])
         config = json.load(file(repo / "repo.json"))
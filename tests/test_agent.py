@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from poni import agent
+from poni import errors
+from poni import rcontrol
+from poni import rcontrol_agent
+from helper import *
+
+
+class DroppingControl(rcontrol.LocalControl):
+    alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+class TestAgent(Helper):
+    def setup(self):
+        Helper.setup(self)
+        self.socket_path = self.temp_dir() / "agent.sock"
+        pool = agent.ConnectionPool(max_size=2,
+                                    remote_class=DroppingControl)
+        self.server = agent.AgentServer(self.socket_path, pool)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        Helper.teardown(self)
+
+    def get_remote(self, host):
+        node = agent.AgentNode("node", {"host": host, "user": "root"})
+        return rcontrol_agent.AgentRemoteControl(
+            node, socket_path=self.socket_path)
+
+    def test_file_ops(self):
+        remote = self.get_remote("host1")
+        target = self.temp_dir() / "sub" / "file.txt"
+        remote.makedirs(target.dirname())
+        remote.write_file(target, "hello\x00world")
+        assert target.bytes() == "hello\x00world"
+        assert remote.read_file(target) == "hello\x00world"
+        assert remote.stat(target).st_size == 11
+        try:
+            remote.read_file(target + ".missing")
+            assert False, "expected RemoteFileDoesNotExist"
+        except errors.RemoteFileDoesNotExist:
+            pass
+
+    def test_exec(self):
+        remote = self.get_remote("host1")
+        assert list(remote.execute_command(["true"]))[-1] == (rcontrol.DONE, 0)
+        assert list(remote.execute_command(["false"]))[-1] == (rcontrol.DONE, 1)
+
+    def test_concurrent_exec(self):
+        started = self.temp_file()
+        done = self.temp_file()
+        results = []
+        wait = threading.Thread(target=lambda: results.extend(
+                self.get_remote("host1").execute_command(
+                    ["sh", "-c", "touch %s; for i in $(seq 50); do "
+                     "[ -e %s ] && exit 0; sleep 0.05; done; exit 1" % (
+                            started, done)])))
+        wait.start()
+        while not started.exists():
+            time.sleep(0.01)
+
+        # runs while the first command is still running on the connection
+        assert list(self.get_remote("host1").execute_command(
+                ["touch", done]))[-1] == (rcontrol.DONE, 0)
+        wait.join()
+        assert results[-1] == (rcontrol.DONE, 0)
+
+    def test_pool_bound(self):
+        for host in ["host1", "host2", "host3", "host1"]:
+            self.get_remote(host).stat(self.socket_path)
+
+        assert len(self.server.pool.entries) == 2
+
+    def test_socket_private(self):
+        assert not (os.stat(self.socket_path).st_mode & 077)
+
+    def test_unexpected_error(self):
+        remote = self.get_remote("host1")
+        try:
+            # not base64
+            remote.request("write_file", file_path=self.temp_file(),
+                           contents="x")
+            assert False, "expected RemoteError"
+        except errors.RemoteError, error:
+            assert "TypeError" in str(error)
+
+        assert remote.stat(self.socket_path)
+
+    def test_lost_connection(self):
+        self.get_remote("host1").stat(self.socket_path)
+        entry = self.server.pool.entries.values()[0]
+        entry.remote.alive = False
+        self.get_remote("host1").stat(self.socket_path)
+        assert self.server.pool.entries.values()[0] is not entry
+        assert len(self.server.pool.entries) == 1
@@ -1,5 +1,8 @@
 import json
+import StringIO
+import sys
 from poni import tool
+from poni import rcontrol_all
 from helper import *
 
 single_file_plugin_text = """
@@ -10,6 +13,15 @@ class PlugIn(config.PlugIn):
         self.add_file("%(source)s", dest_path="%(dest)s", auto_override=%(override)s)
 """
 
+node_file_plugin_text = """
+from poni import config
+
+class PlugIn(config.PlugIn):
+    def add_actions(self):
+        self.add_file("node", dest_path=self.node["out"],
+                      source_text="$node.name")
+"""
+
 class TestCommands(Helper):
     def test_add_node(self):
         poni, repo = self.init_repo()
@@ -160,6 +172,119 @@ class TestCommands(Helper):
         poni.run(["deploy"])
         assert output_file.bytes() == new_template_text
 
+    def test_deploy_plan(self):
+        template_text = "hello"
+        output_file = self.temp_file()
+        poni = self._make_inherited_config("tnode", "tconf", "inode", "iconf",
+                                           "test.txt", template_text, output_file,
+                                           auto_override=True)
+        new_template_text = "world"
+        tmpfile = self.temp_dir() / "test.txt"
+        tmpfile.write_bytes(new_template_text)
+        assert not poni.run(["update-config", "inode/iconf", tmpfile])
+        # plan must not change the deployed file
+        stdout = sys.stdout
+        sys.stdout = report = StringIO.StringIO()
+        try:
+            assert not poni.run(["deploy", "--plan", "-v"])
+        finally:
+            sys.stdout = stdout
+
+        assert output_file.bytes() == template_text
+        rows = dict((line.split()[0], line.split()[1:])
+                    for line in report.getvalue().splitlines()
+                    if line.startswith(("inode ", "TOTAL ")))
+        # files, bytes, dirs, hooks, latency, estimate
+        files, size, dirs, hooks, latency, estimate = rows["inode"]
+        assert (files, size, dirs, hooks) == ("1", "5", "0", "0")
+        assert float(estimate.rstrip("s")) >= 0.0
+        assert rows["TOTAL"][2:6] == ["1", "5", "0", "0"]
+        assert "write %s" % output_file in report.getvalue()
+        assert not poni.run(["deploy"])
+        assert output_file.bytes() == new_template_text
+
+    def test_remote_exec_jobs(self):
+        poni, repo = self.init_repo()
+        for i in range(5):
+            assert not poni.run(["add-node", "node%d" % i])
+
+        assert not poni.run(["set", "node", "deploy=local"])
+        time_log = self.temp_file()
+        for mode in [[], ["-j", "3"], ["-j", "3", "--interleave"],
+                     ["-j", "3", "--host-jobs", "2"], ["--adaptive"]]:
+            assert not poni.run(["remote", "exec", "node", "true"] + mode)
+            assert poni.run(["remote", "exec", "node", "false"] + mode) == -1
+
+        assert not poni.run(["-L", time_log, "remote", "exec", "node", "true",
+                             "-j", "2"])
+        entries = json.load(file(time_log))[-5:]
+        assert sorted(e["name"] for e in entries) == [
+            "node%d" % i for i in range(5)]
+        assert all(e["args"]["exit_code"] == 0 for e in entries)
+
+    def test_remote_exec_preflight(self):
+        poni, repo = self.init_repo()
+        assert not poni.run(["add-node", "node0"])
+        assert not poni.run(["add-node", "node1"])
+        assert not poni.run(["set", "node0", "deploy=local"])
+        assert not poni.run(["set", "node1", "deploy=ssh",
+                             "host=unknown.invalid", "user=x",
+                             "ssh-timeout:float=0.1"])
+        touched = self.temp_file()
+        cmd = self.temp_file()
+        cmd.write_text("#!/bin/sh\ntouch %s\n" % touched)
+        cmd.chmod(0755)
+        # the unreachable host is reported and skipped, the command still
+        # runs on the reachable ones
+        time_log = self.temp_file()
+        assert poni.run(["-L", time_log, "remote", "exec", "node", cmd]) == -1
+        assert touched.exists()
+        entries = json.load(file(time_log))[-2:]
+        assert sorted((e["name"], e["args"]["exit_code"])
+                      for e in entries) == [("node0", 0), ("node1", -1)]
+        touched.remove()
+        assert poni.run(["remote", "exec", "node", cmd,
+                         "--no-preflight"]) == -1
+        assert touched.exists()
+
+    def test_deploy_preflight(self):
+        poni = self.repo_and_config("node0", "conf", node_file_plugin_text)
+        assert not poni.run(["add-node", "node1"])
+        assert not poni.run(["add-config", "node1", "conf",
+                             "--inherit", "node0/conf"])
+        outputs = [self.temp_file(), self.temp_file()]
+        assert not poni.run(["set", "node0", "deploy=local",
+                             "out=%s" % outputs[0]])
+        assert not poni.run(["set", "node1", "deploy=ssh",
+                             "host=unknown.invalid", "user=x",
+                             "ssh-timeout:float=0.1", "out=%s" % outputs[1]])
+        # files of the unreachable node are counted as errors, the reachable
+        # nodes are deployed
+        assert poni.run(["deploy"]) == -1
+        assert outputs[0].bytes() == "node0"
+        assert not outputs[1].exists()
+        assert poni.run(["audit"]) == -1
+
+    def test_remote_exec_unreachable_host(self):
+        poni, repo = self.init_repo()
+        for i in range(3):
+            assert not poni.run(["add-node", "node%d" % i])
+
+        assert not poni.run(["set", "node", "deploy=ssh",
+                             "host=unknown.invalid", "user=x",
+                             "ssh-timeout:float=1.0"])
+        time_log = self.temp_file()
+        assert poni.run(["-L", time_log, "remote", "exec", "node", "true",
+                         "--no-preflight"]) == -1
+        entries = json.load(file(time_log))[-3:]
+        assert all(e["args"]["exit_code"] == -1 for e in entries)
+        # only the first node waits for the connect retries
+        assert (entries[0]["stop"] - entries[0]["start"]) > 0.5
+        assert all((e["stop"] - e["start"]) < 0.5 for e in entries[1:])
+
+        # failures are not remembered from one run to the next
+        assert not rcontrol_all.manager.health.tripped
+
     def test_require(self):
         poni, repo = self.init_repo()
         assert not poni.run(["require", "poni_version>='0.1'"])
@@ -1,4 +1,9 @@
 import json
+import StringIO
+import sys
+from poni import config
+from poni import core
+from poni import errors
 from poni import tool
 from helper import *
 
@@ -29,6 +34,104 @@ class PlugIn(config.PlugIn):
 
 """
 
+exec_plugin_text = """
+import argh
+from poni import config
+
+from poni import errors
+
+class PlugIn(config.PlugIn):
+    @config.control()
+    @argh.arg("script")
+    @argh.arg("output")
+    def lines(self, arg):
+        out = file(arg.output, "w")
+        for line in self.remote_gen_execute(arg, arg.script,
+                                            yield_stdout=True):
+            out.write("<%s>" % line)
+            out.flush()
+
+    @config.control()
+    @argh.arg("script")
+    @argh.arg("output")
+    def spill(self, arg):
+        for line in self.remote_gen_execute(arg, arg.script,
+                                            spill_path=arg.output):
+            assert False, "lines are not yielded unless asked for"
+
+    @config.control()
+    @argh.arg("script")
+    @argh.arg("output")
+    def run(self, arg):
+        try:
+            self.remote_execute(arg, arg.script)
+        except errors.ControlError, error:
+            file(arg.output, "w").write(str(error))
+"""
+
+limit_plugin_text = """
+import argh
+import time
+from poni import config
+
+class PlugIn(config.PlugIn):
+    @config.control(limits={"host": 2})
+    @argh.arg("output")
+    def slow(self, arg):
+        file(arg.output, "a").write("+")
+        time.sleep(0.2)
+        file(arg.output, "a").write("-")
+"""
+
+inputs_plugin_text = """
+import argh
+from poni import config
+
+class PlugIn(config.PlugIn):
+    @config.control(provides=["base"], inputs=["file:plugin.py",
+                                               "prop:version"])
+    @argh.arg("output")
+    def base(self, arg):
+        file(arg.output, "a").write("base")
+
+    @config.control(requires=["base"], inputs=["prop:port"])
+    @argh.arg("output")
+    def app(self, arg):
+        file(arg.output, "a").write("app")
+"""
+
+resume_plugin_text = """
+import argh
+import os
+from poni import config
+from poni import core
+from poni import errors
+
+class PlugIn(config.PlugIn):
+    @config.control(provides=["first"])
+    @argh.arg("output")
+    def first(self, arg):
+        file(arg.output, "a").write("first")
+
+    @config.control(requires=["first"])
+    @argh.arg("output")
+    def second(self, arg):
+        if os.path.exists(arg.output + ".fail"):
+            raise errors.ControlError("failed")
+
+        file(arg.output, "a").write("second")
+"""
+
+def max_running(events):
+    running = 0
+    most = 0
+    for event in events:
+        running += 1 if event == "+" else -1
+        most = max(most, running)
+
+    return most
+
+
 class TestControls(Helper):
     def test_basic_controls(self):
         poni = self.repo_and_config("node", "conf", plugin_text)
@@ -43,3 +146,166 @@ class TestControls(Helper):
         cmd_output("bar", "foobar")
         cmd_output("baz", "foobaz")
         cmd_output("bax", "bax")
+
+    def test_plan(self):
+        poni = self.repo_and_config("node", "conf", plugin_text)
+        temp = self.temp_file()
+        for plan_format in ("text", "json", "dot"):
+            assert not poni.run(["control", "--plan", "--plan-format",
+                                 plan_format, ".", "bar", "--", temp])
+            assert not temp.exists()
+
+    def test_remote_gen_execute(self):
+        poni = self.repo_and_config("node", "conf", exec_plugin_text)
+        assert not poni.run(["set", "node", "deploy=local"])
+        script = self.temp_file()
+        output = self.temp_file()
+        script.write_text("#!/bin/sh\necho a\necho b\nprintf c\n")
+        script.chmod(0755)
+        assert not poni.run(["control", ".", "lines", "--", script, output])
+        assert output.bytes() == "<a><b><c>"
+
+        script.write_text("#!/bin/sh\necho a\necho b\nexit 3\n")
+        assert poni.run(["control", ".", "lines", "--", script, output]) == -1
+        assert output.bytes() == "<a><b>"
+
+        script.write_text("#!/bin/sh\necho a\necho b\n")
+        assert not poni.run(["control", ".", "spill", "--", script, output])
+        assert output.bytes() == "a\nb\n"
+
+        # the output of a failed command is in the error message and is
+        # shown as it arrives
+        script.write_text("#!/bin/sh\necho a\necho b >&2\nexit 3\n")
+        output.remove()
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            assert not poni.run(["control", ".", "run", "--", script, output])
+            shown = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        assert "a\n" in shown
+        assert output.bytes().endswith("exit code 3\n    a\n    b")
+
+    def test_limits(self):
+        poni = self.repo_and_config("node", "c1", limit_plugin_text)
+        plugin_py = self.temp_dir() / "plugin.py"
+        plugin_py.write_bytes(limit_plugin_text)
+        for conf in ("c2", "c3"):
+            assert not poni.run(["add-config", "node", conf])
+            assert not poni.run(["update-config", "node/" + conf, plugin_py])
+
+        def run(*extra):
+            output = self.temp_file()
+            assert not poni.run(["control"] + list(extra) +
+                                [".", "slow", "--", output])
+            events = output.bytes()
+            assert len(events) == 6
+            return max_running(events)
+
+        assert run() == 2
+        assert run("--limit", "host=1") == 1
+        assert not poni.run(["set", "node",
+                             'control_limits:-json={"slow": {"host": 3}}'])
+        assert run() == 3
+        assert run("--limit", "global=1") == 1
+        assert tool.parse_limits(["host=2", "mirror=4"]) == dict(host=2,
+                                                                 mirror=4)
+        for spec in ("host", "host=0", "=1", "host=x"):
+            try:
+                tool.parse_limits([spec])
+                assert False, "expected UserError"
+            except errors.UserError:
+                pass
+
+    def test_inputs(self):
+        poni = self.repo_and_config("node", "conf", inputs_plugin_text)
+
+        def run(*extra):
+            output = self.temp_file()
+            assert not poni.run(["control"] + list(extra) +
+                                [".", "app", "--", output])
+            return output.bytes() if output.exists() else ""
+
+        assert run() == "baseapp"
+        assert run() == ""
+        assert run("--force") == "baseapp"
+        assert not poni.run(["set", "node", "port:int=80"])
+        assert run() == "app"
+        # a changed dependency runs its dependents, too
+        assert not poni.run(["set", "node", "version=2"])
+        assert run() == "baseapp"
+        plugin_py = self.temp_dir() / "plugin.py"
+        plugin_py.write_bytes(inputs_plugin_text + "\n")
+        assert not poni.run(["update-config", "node/conf", plugin_py])
+        assert run() == "baseapp"
+        assert run() == ""
+
+    def test_resume(self):
+        poni = self.repo_and_config("node", "conf", resume_plugin_text)
+        journal = self.temp_file()
+        output = self.temp_file()
+        fail = path(output + ".fail")
+        fail.write_bytes("")
+        self.temp_files.append(fail)
+
+        def run(*extra):
+            return poni.run(["control"] + list(extra) +
+                            [".", "second", "--", output])
+
+        assert run("--journal", journal) == -1
+        assert output.bytes() == "first"
+        fail.remove()
+        assert not run("--resume", journal)
+        assert output.bytes() == "firstsecond"
+
+        # a partial record from an interrupted write is ignored
+        journal.write_bytes('{"event": "finish", "result": "x", "ta',
+                           append=True)
+        assert not run("--resume", journal)
+        assert output.bytes() == "firstsecond"
+        records, length = config.ControlJournal(journal).read()
+        assert length == len(journal.bytes())
+        assert [r["event"] for r in records] == ["run", "start", "finish",
+                                                 "start", "finish", "run",
+                                                 "start", "finish", "run"]
+
+        assert run("--resume", journal + ".missing") == -1
+        assert poni.run(["control", "--resume", journal, ".", "first", "--",
+                         output]) == -1
+        # the control arguments must match, too
+        assert poni.run(["control", "--resume", journal, ".", "second", "--",
+                         output + ".other"]) == -1
+
+        # results that are not JSON serializable are recorded as text
+        other = config.ControlJournal(self.temp_file())
+        other.open()
+        other.write(event="finish", task="x", result=set())
+        other.close()
+        assert other.read()[0] == [dict(event="finish", task="x",
+                                        result="set([])")]
+
+        # no journal is written unless asked for
+        assert not run()
+        state_dir = core.get_state_dir(poni.default_repo_path)
+        assert not [name for name in state_dir.listdir()
+                    if name.endswith(".journal")]
+
+    def test_plugin_cache(self):
+        poni = self.repo_and_config("node", "conf", plugin_text)
+        cache_dir = core.get_state_dir(poni.default_repo_path) / \
+            "plugin-cache"
+        temp = self.temp_file()
+        assert not poni.run(["control", ".", "foo", "--", temp])
+        cached = cache_dir.files("*.code")
+        assert len(cached) == 1
+
+        # a damaged cache entry is compiled again
+        cached[0].write_bytes("garbage")
+        core.g_plugin_module_cache.clear()
+        poni = tool.Tool(default_repo_path=poni.default_repo_path)
+        assert not poni.run(["control", ".", "bar", "--", temp])
+        assert file(temp).read() == "foofoobar"
+        assert cache_dir.files("*.code") == cached
+        assert cached[0].bytes() != "garbage"
@@ -0,0 +1,108 @@
+import json
+from poni import errors
+from poni import plan
+from poni import work
+
+
+class PlanTask(work.Task):
+    def __init__(self, name, host=None, duration=1.0, depends=()):
+        work.Task.__init__(self)
+        self.name = name
+        self.host = host
+        self.duration = duration
+        self.depends = list(depends)
+
+    def __repr__(self):
+        return self.name
+
+    def get_host(self):
+        return self.host
+
+
+class Node(dict):
+    def __init__(self, name, **props):
+        dict.__init__(self, props)
+        self.name = name
+
+
+def test_deploy_plan():
+    deploy_plan = plan.DeployPlan()
+    node = Node("n1", host="h1")
+    for name in ("a", "b", "c"):
+        # read + stat of each checked file
+        deploy_plan.add_latency(node, 0.2, op_count=2)
+
+    assert not deploy_plan.dir_checked(node, "/etc")
+    assert deploy_plan.dir_checked(node, "/etc")
+    deploy_plan.add_latency(node, 0.1)
+    deploy_plan.add_dir(node, "/etc/app")
+    deploy_plan.add_file(node, "/etc/app/a", 100)
+    deploy_plan.add_file(node, "/etc/app/b", 20)
+    deploy_plan.add_hook(node, "/etc/app/a")
+    node_plan = deploy_plan.nodes["n1"]
+    assert deploy_plan.latency(node_plan) == 0.1
+    # 7 checks, 2 writes, 1 mkdir, 1 hook
+    assert abs(deploy_plan.estimate(node_plan) - 1.1) < 1e-9
+    totals = deploy_plan.totals()
+    assert (totals.nodes, totals.files, totals.bytes, totals.dirs,
+            totals.hooks) == (1, 2, 120, 1, 1)
+    assert "TOTAL (1 nodes)" in "".join(deploy_plan.iter_report())
+
+
+def test_control_plan():
+    a = PlanTask("a", host="h1", duration=2.0)
+    b = PlanTask("b", host="h1", duration=1.0)
+    c = PlanTask("c", host="h2", duration=5.0, depends=[a])
+    d = PlanTask("d", host="h3", duration=1.0, depends=[a, b])
+    e = PlanTask("e", host="h3", duration=1.0, depends=[c, d])
+    tasks = [e, d, c, b, a]
+    work.set_critical_path(tasks, lambda t: t.duration)
+    control_plan = plan.ControlPlan(tasks, duration=lambda t: t.duration,
+                                    max_jobs=4, skipped=1)
+    totals = control_plan.totals()
+    assert totals.tasks == 5
+    assert totals.hosts == 3
+    assert totals.depth == 3
+    assert totals.width == 2
+    # a and b share a host
+    assert totals.max_running == 2
+    assert control_plan.critical_path == [a, c, e]
+    assert totals.critical_time == 8.0
+    assert totals.serial_time == 10.0
+    assert totals.estimate == 8.0
+    assert control_plan.schedule[b] == (2.0, 3.0)
+    assert control_plan.waits == {("host", "h1"): set([b])}
+
+    out = json.loads(control_plan.as_json())
+    assert out["critical_path"] == ["a", "c", "e"]
+    assert out["estimate"] == 8.0
+    assert out["tasks"] == 5
+    assert [t["name"] for t in out["task_list"]][-1] == "e"
+    dot = "".join(control_plan.iter_dot())
+    assert '"a" -> "c" [color=red];' in dot
+    assert '"b" -> "d";' in dot
+    assert "".join(control_plan.iter_report())
+
+    # one job at a time, no durations: every task is a time unit
+    for task in tasks:
+        task.priority = 0
+
+    control_plan = plan.ControlPlan(tasks, max_jobs=1)
+    assert control_plan.totals().max_running == 1
+    assert control_plan.totals().estimate == 5.0
+    assert json.loads(control_plan.as_json())["estimate"] is None
+
+    # nodes without a host are not counted as a host
+    hostless = [PlanTask("x", host=""), PlanTask("y", host=None)]
+    assert plan.ControlPlan(tasks + hostless).totals().hosts == 3
+
+
+def test_control_plan_cycle():
+    a = PlanTask("a")
+    b = PlanTask("b", depends=[a])
+    a.depends = [b]
+    try:
+        plan.ControlPlan([a, b])
+        assert False, "expected ControlError"
+    except errors.ControlError:
+        pass
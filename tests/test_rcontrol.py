@@ -0,0 +1,374 @@
+import os
+import socket
+import threading
+import time
+from poni import core
+from poni import errors
+from poni import rcontrol
+from poni import rcontrol_paramiko
+from poni import util
+from helper import *
+
+
+class Node(dict):
+    name = "node"
+
+    def get_tree_property(self, name, default=None):
+        return self.get(name, default)
+
+
+def test_line_splitter():
+    splitter = rcontrol.LineSplitter(max_line=4)
+    assert splitter.feed("a") == []
+    assert splitter.feed("b\r\ncd\n\nef") == ["ab", "cd", ""]
+    assert splitter.feed("ghijk") == ["efgh"]
+    assert splitter.flush() == ["ijk"]
+    assert splitter.flush() == []
+
+
+class TestLocalExecute(Helper):
+    def test_iter_execute(self):
+        script = self.temp_file()
+        script.write_text("#!/bin/sh\necho out1\necho err >&2\necho out2\n"
+                          "exit 2\n")
+        script.chmod(0755)
+        remote = rcontrol.LocalControl(Node())
+        items = list(remote.iter_execute(script, quiet=True, capture=True))
+        assert items[-1] == (rcontrol.DONE, 2)
+        assert [line for code, line in items if code == rcontrol.STDOUT] == [
+            "out1", "out2"]
+        assert (rcontrol.STDERR, "err") in items
+
+        lines = []
+        assert remote.execute(script, quiet=True, output_lines=lines) == 2
+        assert lines == ["out1", "out2"]
+
+        # long lines are kept whole
+        script.write_text("#!/bin/sh\nhead -c 100000 /dev/zero | tr '\\0' x\n")
+        lines = []
+        assert remote.execute(script, quiet=True, output_lines=lines) == 0
+        assert lines == ["x" * 100000]
+
+
+class SessionControl(rcontrol.LocalControl):
+    def open_session(self):
+        return rcontrol.ProcessShellSession(self.node.name, ["/bin/sh"])
+
+
+def session_output(items):
+    out = {}
+    for code, data in items:
+        out[code] = out.get(code, "") + str(data)
+    return out
+
+
+def test_shell_session():
+    session = rcontrol.ProcessShellSession("node", ["/bin/sh"])
+    try:
+        out = session_output(session.run("echo a; echo b >&2; exit 3", 5, 5))
+        assert out == {rcontrol.STDOUT: "a\n", rcontrol.STDERR: "b\n",
+                       rcontrol.DONE: "3"}
+
+        # no trailing newline, output larger than a single read
+        out = session_output(session.run("printf x; head -c 200000 "
+                                         "/dev/zero", 5, 5))
+        assert out[rcontrol.STDOUT] == "x" + "\0" * 200000
+        assert out[rcontrol.DONE] == "0"
+
+        # commands do not read the session's stdin
+        out = session_output(session.run("cat; echo $PPID", 5, 5))
+        pid = out[rcontrol.STDOUT]
+        out = session_output(session.run("echo $PPID", 5, 5))
+        assert out[rcontrol.STDOUT] == pid
+        assert session.commands == 4
+    finally:
+        session.close()
+
+    assert session.closed
+
+
+def test_shell_session_timeout():
+    session = rcontrol.ProcessShellSession("node", ["/bin/sh"])
+    try:
+        list(session.run("sleep 5", 0.2, 0.1))
+        assert False, "expected RemoteError"
+    except errors.RemoteError:
+        pass
+
+    assert session.closed
+
+
+class TestSessionExecute(Helper):
+    def test_iter_execute_session(self):
+        remote = SessionControl(Node(persistent_shell=True))
+        try:
+            for i in range(3):
+                items = list(remote.iter_execute("echo %d; exit %d" % (i, i),
+                                                 quiet=True, capture=True,
+                                                 session=True))
+                assert items == [(rcontrol.STDOUT, str(i)), (rcontrol.DONE, i)]
+
+            assert remote.sessions_opened == 1
+            assert remote.session_commands == 3
+
+            # an abandoned command closes the session, the next one starts
+            # a new session
+            for item in remote.iter_execute("echo 1; echo 2", quiet=True,
+                                            capture=True, session=True):
+                break
+
+            assert remote.execute("true", quiet=True) == 0
+            items = list(remote.iter_execute("echo ok", quiet=True,
+                                             capture=True, session=True))
+            assert items[0] == (rcontrol.STDOUT, "ok")
+            assert remote.sessions_opened == 2
+        finally:
+            remote.close()
+
+        remote = SessionControl(Node()) # sessions are opt-in
+        items = list(remote.iter_execute(["echo", "plain"], quiet=True,
+                                         capture=True, session=True))
+        assert items[0] == (rcontrol.STDOUT, "plain")
+        assert remote.sessions_opened == 0
+
+    def test_concurrent_sessions(self):
+        remote = SessionControl(Node(persistent_shell=True))
+        results = {}
+        def run(i):
+            results[i] = list(remote.iter_execute(
+                    "echo %d; sleep 0.2; echo %d; exit %d" % (i, i, i),
+                    quiet=True, capture=True, session=True))
+
+        try:
+            for rounds in range(2):
+                threads = [threading.Thread(target=run, args=(i,))
+                           for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                for i in range(4):
+                    assert results[i] == [(rcontrol.STDOUT, str(i)),
+                                          (rcontrol.STDOUT, str(i)),
+                                          (rcontrol.DONE, i)]
+
+            # each concurrent command ran in a session of its own, idle
+            # sessions are reused
+            assert 2 <= remote.sessions_opened <= 4
+            assert remote.session_commands == 8
+        finally:
+            remote.close()
+
+
+def test_parse_size():
+    assert util.parse_size(100) == 100
+    assert util.parse_size("100") == 100
+    assert util.parse_size("1.5k") == 1536
+    assert util.parse_size("2M") == 2 * 1024 ** 2
+    try:
+        util.parse_size("fast")
+        assert False, "expected InvalidProperty"
+    except errors.InvalidProperty:
+        pass
+
+
+def test_token_bucket():
+    bucket = rcontrol.TokenBucket(1000)
+    start = time.time()
+    bucket.consume(1000) # the initial burst is free
+    assert (time.time() - start) < 0.1
+    bucket.consume(300)
+    bucket.consume(200)
+    assert 0.4 < (time.time() - start) < 0.7
+
+
+def test_parse_jump_host():
+    parse = rcontrol_paramiko.parse_jump_host
+    assert parse("gw", "root") == ("gw", 22, "root")
+    assert parse("admin@gw:2222", "root") == ("gw", 2222, "admin")
+
+
+class Transport:
+    def open_channel(self, kind, dest, src):
+        return (kind, dest)
+
+
+def test_bastion_channel_limit():
+    bastion = rcontrol_paramiko.Bastion("gw", 22, "root", max_channels=1)
+    assert bastion.open_channel(Transport(), "node", 22, 0.1) == (
+        "direct-tcpip", ("node", 22))
+    try:
+        bastion.open_channel(Transport(), "node", 22, 0.1)
+        assert False, "expected RemoteError"
+    except errors.RemoteError:
+        pass
+
+    bastion.release()
+    assert bastion.open_channel(Transport(), "node", 22, 0.1)
+
+
+def test_race_connect():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    try:
+        # nothing listens on 127.0.0.2, the next address is tried right away
+        addr, sock = rcontrol_paramiko.race_connect(
+            ["127.0.0.2", "127.0.0.1"], port, 5.0, stagger=5.0)
+        assert addr == "127.0.0.1"
+        sock.close()
+    finally:
+        server.close()
+
+
+def test_race_connect_closes_losers():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(2)
+    server.settimeout(5.0)
+    port = server.getsockname()[1]
+    create_connection = socket.create_connection
+    connected = []
+    both = threading.Event()
+    def connect_together(*args):
+        # both attempts connect, neither finishes before the other
+        sock = create_connection(*args)
+        connected.append(sock)
+        if len(connected) == 2:
+            both.set()
+
+        both.wait(5.0)
+        return sock
+
+    socket.create_connection = connect_together
+    try:
+        addr, sock = rcontrol_paramiko.race_connect(
+            ["127.0.0.1", "127.0.0.1"], port, 5.0, stagger=0.0)
+        peers = [server.accept()[0] for i in range(2)]
+        winner = sock.getsockname()
+        loser = [peer for peer in peers if peer.getpeername() != winner][0]
+        loser.settimeout(5.0)
+        assert loser.recv(1) == "" # closed
+        for peer in peers:
+            peer.close()
+
+        sock.close()
+
+        # connects only after the race has timed out
+        def connect_late(*args):
+            time.sleep(0.5)
+            return create_connection(*args)
+
+        socket.create_connection = connect_late
+        try:
+            rcontrol_paramiko.race_connect(["127.0.0.1"], port, 0.1)
+            assert False, "expected socket.timeout"
+        except socket.timeout:
+            pass
+
+        peer = server.accept()[0]
+        peer.settimeout(5.0)
+        assert peer.recv(1) == ""
+        peer.close()
+    finally:
+        socket.create_connection = create_connection
+        server.close()
+
+
+class TestAddrCandidates(Helper):
+    def test_addr_candidates(self):
+        poni, repo = self.init_repo()
+        assert not poni.run(["add-node", "node"])
+        assert not poni.run(["set", "node", "host=h", "private.ip=10.0.0.1",
+                             "private.dns=h", "public.ip=1.2.3.4",
+                             "vpn.ip=10.8.0.1"])
+        node = list(core.ConfigMan(repo).find("node"))[0]
+        assert node.addr_candidates() == ["h", "10.0.0.1", "1.2.3.4"]
+        assert not poni.run(["set", "node",
+                             "addr_map.vpn:-json=[\"vpn.ip\"]"])
+        node = list(core.ConfigMan(repo).find("node"))[0]
+        assert node.addr_candidates() == ["h", "10.0.0.1", "1.2.3.4",
+                                          "10.8.0.1"]
+
+
+class Channel:
+    """a channel whose command exits while a background process keeps its
+    output open"""
+    def __init__(self):
+        self.pipe = os.pipe()
+        self.output = ["out"]
+        self.eof_received = False
+        self.closed = False
+        self.polls = 0
+
+    def exec_command(self, cmd):
+        pass
+
+    def shutdown_write(self):
+        pass
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def recv_ready(self):
+        return bool(self.output)
+
+    def recv(self, size):
+        return self.output.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        self.polls += 1
+        return self.polls > 2
+
+    def recv_exit_status(self):
+        return 0
+
+
+class ChannelControl(rcontrol_paramiko.ParamikoRemoteControl):
+    def get_ssh(self, action=None):
+        return self.channel
+
+
+class TrailingChannel(Channel):
+    """a channel whose exit status arrives before the end of the output"""
+    def __init__(self):
+        Channel.__init__(self)
+        self.output = []
+        self.timer = threading.Timer(0.1, self.finish)
+        self.timer.start()
+
+    def finish(self):
+        self.output.append("tail")
+        self.eof_received = True
+        os.write(self.pipe[1], "x")
+
+    def exit_status_ready(self):
+        return True
+
+
+def test_exec_without_eof():
+    remote = ChannelControl(Node())
+    remote.channel = Channel()
+    start = time.time()
+    assert list(remote.execute_command("daemon")) == [
+        (rcontrol.STDOUT, "out"), (rcontrol.DONE, 0)]
+    assert (time.time() - start) < (rcontrol_paramiko.EOF_GRACE + 1.0)
+    for fd in remote.channel.pipe:
+        os.close(fd)
+
+
+def test_exec_output_after_exit_status():
+    remote = ChannelControl(Node())
+    remote.channel = TrailingChannel()
+    start = time.time()
+    assert list(remote.execute_command("echo tail")) == [
+        (rcontrol.STDOUT, "tail"), (rcontrol.DONE, 0)]
+    assert (time.time() - start) < rcontrol_paramiko.EOF_GRACE
+    remote.channel.timer.join()
+    for fd in remote.channel.pipe:
+        os.close(fd)
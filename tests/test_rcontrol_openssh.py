@@ -0,0 +1,102 @@
+import time
+from poni import agent
+from poni import errors
+from poni import rcontrol
+from poni import rcontrol_async
+from poni import rcontrol_openssh
+from helper import *
+
+
+def local_ssh_command(self, remote_args, pseudo_tty=False):
+    """runs the remote side with a local shell instead of ssh"""
+    return ["sh", "-c", " ".join(remote_args)]
+
+
+class LocalOpenSshControl(rcontrol_openssh.OpenSshRemoteControl):
+    ssh_command = local_ssh_command
+
+
+class LocalAsyncControl(rcontrol_async.AsyncSshRemoteControl):
+    ssh_command = local_ssh_command
+
+
+class ShellControlChecks(Helper):
+    control_class = None
+
+    def get_remote(self):
+        node = agent.AgentNode("node", {"host": "localhost", "user": "root"})
+        return self.control_class(node)
+
+    def test_file_ops(self):
+        remote = self.get_remote()
+        target = self.temp_dir() / "a b" / "file.txt"
+        remote.makedirs(target.dirname())
+        contents = "x" * 300000
+        remote.write_file(target, contents, mode=0640)
+        assert target.bytes() == contents
+        assert remote.read_file(target) == contents
+        st = remote.stat(target)
+        assert st.st_size == len(contents)
+        assert st.st_mode & 0777 == 0640
+        remote.utime(target, (1000000000, 1000000000))
+        assert remote.stat(target).st_mtime == 1000000000
+        copy = target.dirname() / "copy.txt"
+        remote.put_file(target, copy)
+        assert copy.bytes() == contents
+        for op in [remote.read_file, remote.stat]:
+            try:
+                op(target + ".missing")
+                assert False, "expected RemoteFileDoesNotExist"
+            except errors.RemoteFileDoesNotExist:
+                pass
+
+    def test_exec(self):
+        remote = self.get_remote()
+        output = list(remote.execute_command("echo out; echo err >&2; exit 3"))
+        assert output[-1] == (rcontrol.DONE, 3)
+        assert (rcontrol.STDOUT, "out\n") in output
+        assert (rcontrol.STDERR, "err\n") in output
+
+
+class TestOpenSshControl(ShellControlChecks):
+    control_class = LocalOpenSshControl
+
+
+class TestAsyncControl(ShellControlChecks):
+    control_class = LocalAsyncControl
+
+    def test_many_sessions(self):
+        remote = self.get_remote()
+        sessions = [remote.start_session(["echo %d; exit %d" % (i, i % 3)])
+                    for i in range(200)]
+        for i, session in enumerate(sessions):
+            output = list(remote.iter_output(session, "test"))
+            assert output[-1] == (rcontrol.DONE, i % 3)
+            assert "".join(data for code, data in output
+                           if code == rcontrol.STDOUT) == "%d\n" % i
+
+    def test_exit_after_eof(self):
+        remote = self.get_remote()
+        # closes its output long before exiting, the loop keeps serving
+        # other sessions meanwhile
+        slow = remote.start_session(["exec >/dev/null 2>&1; sleep 1"])
+        time.sleep(0.2)
+        start = time.time()
+        output = list(remote.execute_command("echo fast"))
+        assert output[-1] == (rcontrol.DONE, 0)
+        assert (time.time() - start) < 0.8
+        assert list(remote.iter_output(slow, "slow")) == [(rcontrol.DONE, 0)]
+
+    def test_abandoned_command(self):
+        remote = self.get_remote()
+        session = remote.start_session(["echo start; sleep 30"])
+        output = remote.iter_output(session, "test")
+        assert output.next() == (rcontrol.STDOUT, "start\n")
+        output.close()
+        for i in range(50):
+            if session.process.poll() is not None:
+                break
+
+            time.sleep(0.1)
+
+        assert session.process.returncode is not None
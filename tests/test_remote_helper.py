@@ -0,0 +1,108 @@
+import base64
+import os
+import subprocess
+import sys
+from poni import errors
+from poni import rcontrol
+from poni import remote_helper
+from helper import *
+
+
+class HelperChecks(Helper):
+    python = sys.executable
+
+    def start(self):
+        script_path, source = rcontrol.helper_script()
+        script = self.temp_file()
+        script.write_bytes(source)
+        process = subprocess.Popen([self.python, script],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        return rcontrol.HelperClient("node", process.stdout, process.stdin)
+
+    def test_file_ops(self):
+        helper = self.start()
+        try:
+            work_dir = self.temp_dir()
+            file_path = work_dir / "a" / "b" / "file"
+            try:
+                helper.call("stat", file_path)
+                assert False, "expected RemoteFileDoesNotExist"
+            except errors.RemoteFileDoesNotExist:
+                pass
+
+            helper.call("makedirs", file_path.dirname())
+            helper.call("makedirs", file_path.dirname())
+            helper.call("write", file_path, base64.b64encode("hello"), 0640)
+            result = helper.call("read", file_path)
+            assert base64.b64decode(result["data"]) == "hello"
+            stat = rcontrol.helper_stat(result["stat"])
+            assert stat.st_size == 5
+            assert (stat.st_mode & 0777) == 0640
+
+            # mode is kept when rewriting
+            helper.call("write", file_path, base64.b64encode("bye"))
+            assert (os.stat(file_path).st_mode & 0777) == 0640
+            assert file_path.bytes() == "bye"
+            assert sorted(entry[0] for entry in helper.call("walk", work_dir)
+                          ) == ["a", "a/b", "a/b/file"]
+
+            helper.call("utime", file_path, 1000, 2000)
+            assert int(os.stat(file_path).st_mtime) == 2000
+        finally:
+            helper.close()
+
+    def test_batch(self):
+        helper = self.start()
+        try:
+            work_dir = self.temp_dir()
+            (work_dir / "exists").write_bytes("x")
+            names = ["exists" if (i % 2) else "missing"
+                     for i in range(rcontrol.HELPER_BATCH * 2 + 1)]
+            results = helper.request([["stat", work_dir / name]
+                                      for name in names])
+            assert len(results) == len(names)
+            assert [("ok" in result) for result in results] == [
+                name == "exists" for name in names]
+        finally:
+            helper.close()
+
+    def test_rate_limit(self):
+        class Limiter:
+            amounts = []
+            def consume(self, amount):
+                self.amounts.append(amount)
+
+        helper = self.start()
+        helper.limiter = Limiter()
+        try:
+            file_path = self.temp_dir() / "file"
+            data = "x" * (rcontrol.HELPER_CHUNK * 3)
+            helper.call("write", file_path, base64.b64encode(data))
+            assert file_path.bytes() == data
+            # large writes are sent in rate limited pieces
+            assert len(Limiter.amounts) > 3
+            assert max(Limiter.amounts) == rcontrol.HELPER_CHUNK
+        finally:
+            helper.close()
+
+
+class TestHelper(HelperChecks):
+    def test_partial_write(self):
+        file_path = self.temp_dir() / "file"
+        write = os.write
+        os.write = lambda fd, data: write(fd, data[:3])
+        try:
+            remote_helper.op_write(file_path, base64.b64encode("hello world"))
+        finally:
+            os.write = write
+
+        assert file_path.bytes() == "hello world"
+
+
+for python3 in ("/usr/bin/python3", "/usr/local/bin/python3"):
+    if os.path.exists(python3):
+        class TestHelperPython3(HelperChecks):
+            python = python3
+
+        break
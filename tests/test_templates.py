@@ -50,3 +50,74 @@ class TestTemplates(Helper):
         output = output_file.bytes()
         print output
         assert "<foo>baz</foo>" in output
+
+scope_plugin_text = """
+from poni import config
+
+class PlugIn(config.PlugIn):
+    def add_actions(self):
+        file(self.node["collect_log"], "a").write(self.node.name + " ")
+        if self.node.get("backend"):
+            self.add_file("backend", source_text=
+                          "#silent $record('backends', name=$node.name)")
+
+        if self.node.get("out"):
+            self.add_file("lb", dest_path=self.node["out"], report=True,
+                          source_text="$len($bucket('backends'))")
+
+        if self.node.get("direct_out"):
+            # read without going through the plugin's bucket()
+            self.add_file("mon", dest_path=self.node["direct_out"],
+                          report=True, source_text=
+                          "$len($plugin.manager.get_bucket('backends'))")
+"""
+
+class TestCollectScope(Helper):
+    def test_collect_scope(self):
+        poni, repo = self.init_repo()
+        plugin_py = self.temp_dir() / "plugin.py"
+        plugin_py.write_bytes(scope_plugin_text)
+        collect_log = self.temp_file()
+        output = self.temp_file()
+        direct_output = self.temp_file()
+        for node in ("web1", "web2", "lb", "mon", "other"):
+            assert not poni.run(["add-node", node])
+            assert not poni.run(["add-config", node, "conf"])
+            assert not poni.run(["update-config", node + "/conf", plugin_py])
+
+        assert not poni.run(["set", ".", "deploy=local",
+                             "collect_log=%s" % collect_log])
+        assert not poni.run(["set", "web", "backend:bool=on"])
+        assert not poni.run(["set", "lb", "out=%s" % output])
+        assert not poni.run(["set", "mon", "direct_out=%s" % direct_output])
+
+        def deploy(*args):
+            if collect_log.exists():
+                collect_log.remove()
+
+            assert not tool.Tool(default_repo_path=repo).run(
+                ["deploy"] + list(args))
+            assert output.bytes() == "2"
+            assert direct_output.bytes() == "2"
+            return sorted(collect_log.bytes().split())
+
+        all_nodes = ["lb", "mon", "other", "web1", "web2"]
+        assert deploy() == all_nodes
+        # the first targeted run records the bucket graph
+        assert deploy("lb") == all_nodes
+        # only the target and the nodes feeding its buckets
+        assert deploy("lb") == ["lb", "web1", "web2"]
+        # readers of manager.get_bucket() are not known, the writers of the
+        # bucket are always collected
+        assert deploy("mon") == ["mon", "web1", "web2"]
+        assert deploy("web1") == ["web1", "web2"]
+        # the recorded bucket graph is not used after repository changes
+        assert not poni.run(["set", "other", "foo=bar"])
+        assert deploy("lb") == all_nodes
+        assert deploy("lb") == ["lb", "web1", "web2"]
+        # runs filtered by --config do not record the bucket writers
+        assert not poni.run(["set", "other", "foo=baz"])
+        assert not tool.Tool(default_repo_path=repo).run(
+            ["deploy", "lb", "-c", "nomatch"])
+        assert deploy("lb") == all_nodes
+        assert deploy("lb") == ["lb", "web1", "web2"]
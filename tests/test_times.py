@@ -20,6 +20,18 @@ def test_times():
 
 
 
+def test_control_durations():
+    tasks = times.Times()
+    tasks.add_task("C", "control", 0, 100, args=["control", "x", "y"])
+    for i, duration in enumerate([10, 20, 30, 40]):
+        tasks.add_task(0, "n/c", 1000 * i, 1000 * i + duration,
+                       args=dict(control="install"))
+
+    tasks.add_task(1, "n/c", 0, 5)
+    assert tasks.control_durations() == {("n/c", "install"): 30}
+    assert tasks.control_durations(samples=1) == {("n/c", "install"): 40}
+
+
 plugin_text = """
 from poni import config
 import time
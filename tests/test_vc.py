@@ -1,7 +1,19 @@
+from poni import core
 from poni import tool
 from helper import *
 import subprocess
 
+control_plugin_text = """
+import argh
+from poni import config
+
+class PlugIn(config.PlugIn):
+    @config.control(inputs=["prop:host"])
+    @argh.arg("output")
+    def touch(self, arg):
+        file(arg.output, "a").write("touch")
+"""
+
 class TestVersionControl(Helper):
     def git(self, repo, cmd):
         full_cmd = ["git",
@@ -40,3 +52,23 @@ class TestVersionControl(Helper):
         assert self.git(repo, ["status", "-s"]) == ""
         assert "checkpoint changes" in self.git(repo, ["log"])
 
+
+    def test_checkpoint_after_control(self):
+        poni, repo = self.vc_init()
+        plugin_py = self.temp_dir() / "plugin.py"
+        plugin_py.write_bytes(control_plugin_text)
+        assert not poni.run(["update-config", "foo/bar/baz", plugin_py])
+        output = self.temp_file()
+        assert not poni.run(["control", ".", "touch", "--", output])
+        assert not poni.run(["vc", "checkpoint", "control run"])
+        assert self.git(repo, ["status", "-s"]) == ""
+
+        # the run state is kept outside of the repository
+        state_dir = core.get_state_dir(repo)
+        assert (state_dir / "control-digests.json").exists()
+        tracked = self.git(repo, ["ls-files"]).split()
+        assert "foo/bar/config/baz/plugin.py" in " ".join(tracked)
+        assert not [name for name in tracked
+                    if name.endswith((".json", ".code", ".journal"))
+                    and not name.endswith(("node.json", "config.json",
+                                           "system.json", "repo.json"))]
@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+from poni import errors
+from poni import work
+
+
+class RecordTask(work.Task):
+    lock = threading.Lock()
+
+    def __init__(self, name, log, host=None, delay=0.0):
+        work.Task.__init__(self)
+        self.name = name
+        self.log_list = log
+        self.host = host
+        self.delay = delay
+
+    def __repr__(self):
+        return self.name
+
+    def get_host(self):
+        return self.host
+
+    def execute(self):
+        with self.lock:
+            self.log_list.append(("start", self.name))
+
+        time.sleep(self.delay)
+        with self.lock:
+            self.log_list.append(("stop", self.name))
+
+
+def max_running(log):
+    running = 0
+    most = 0
+    for event, name in log:
+        running += 1 if event == "start" else -1
+        most = max(most, running)
+
+    return most
+
+
+def test_dependencies():
+    log = []
+    runner = work.Runner()
+    a = RecordTask("a", log, delay=0.05)
+    b = RecordTask("b", log)
+    c = RecordTask("c", log)
+    b.depends = [a]
+    c.depends = [a, b, b]
+    for task in (c, b, a):
+        runner.add_task(task)
+
+    runner.run_all()
+    assert log == [("start", "a"), ("stop", "a"), ("start", "b"),
+                   ("stop", "b"), ("start", "c"), ("stop", "c")]
+    assert runner.stopped == set([a, b, c])
+
+
+def test_host_limit():
+    log = []
+    runner = work.Runner()
+    tasks = [RecordTask(str(i), log, host="h", delay=0.02) for i in range(4)]
+    tasks[0].host_jobs = tasks[1].host_jobs = 2
+    tasks.append(RecordTask("other", log, host="x", delay=0.02))
+    for task in tasks:
+        runner.add_task(task)
+
+    runner.run_all()
+    running = set()
+    most = {}
+    for event, name in log:
+        if event == "start":
+            running.add(name)
+        else:
+            running.remove(name)
+
+        host_running = len([n for n in running if n != "other"])
+        most["h"] = max(most.get("h", 0), host_running)
+
+    assert most["h"] <= 2
+    assert len(log) == 10
+
+
+class LimitTask(RecordTask):
+    def __init__(self, name, log, limits, delay=0.0, priority=0):
+        RecordTask.__init__(self, name, log, delay=delay)
+        self.limits = limits
+        self.priority = priority
+
+    def get_limits(self):
+        return self.limits
+
+
+def test_wake_blocked():
+    log = []
+    runner = work.Runner()
+    tasks = [LimitTask("x", log, {"a": 1}, delay=0.05, priority=100),
+             LimitTask("y", log, {"b": 1}, delay=0.5, priority=100),
+             # blocked on "a", then on "b" when "a" is released
+             LimitTask("t1", log, {"a": 1, "b": 1}, priority=10),
+             LimitTask("t2", log, {"a": 1}, priority=5)]
+    for task in tasks:
+        runner.add_task(task)
+
+    runner.run_all()
+    # "a" does not stay idle while "t1" waits for "b"
+    assert log.index(("start", "t2")) < log.index(("stop", "y"))
+    assert log.index(("start", "t1")) > log.index(("stop", "y"))
+
+
+def test_invalid_limit():
+    for limits, host_jobs in (({}, 0), ({"a": 0}, 1)):
+        runner = work.Runner()
+        task = LimitTask("t", [], limits)
+        task.host = "h"
+        task.host_jobs = host_jobs
+        runner.add_task(task)
+        try:
+            runner.run_all()
+            assert False, "expected UserError"
+        except errors.UserError:
+            pass
+
+
+class PolledTask(RecordTask):
+    def can_start(self):
+        return self.depends[0] in self.runner.stopped
+
+
+def test_polled_task():
+    log = []
+    runner = work.Runner()
+    a = RecordTask("a", log, delay=0.02)
+    b = PolledTask("b", log)
+    b.depends = [a]
+    runner.add_task(b)
+    runner.add_task(a)
+    runner.run_all()
+    assert log == [("start", "a"), ("stop", "a"), ("start", "b"),
+                   ("stop", "b")]
+
+
+def test_dependency_cycle():
+    runner = work.Runner()
+    a = RecordTask("a", [])
+    b = RecordTask("b", [])
+    a.depends = [b]
+    b.depends = [a]
+    runner.add_task(a)
+    runner.add_task(b)
+    try:
+        runner.run_all()
+        assert False, "expected ControlError"
+    except errors.ControlError:
+        pass
+
+
+def test_max_jobs():
+    log = []
+    runner = work.Runner(max_jobs=2)
+    for i in range(6):
+        runner.add_task(RecordTask(str(i), log, delay=0.02))
+
+    runner.run_all()
+    assert max_running(log) == 2
+    assert len(runner.workers.threads) == 0 # closed after the run
+
+
+class ProcessTask(work.Task):
+    def execute(self):
+        self.pid = work.run_in_process(os.getpid)
+
+
+def test_run_in_process():
+    for processes, same_process in ((None, True), (2, False)):
+        runner = work.Runner(processes=processes)
+        task = ProcessTask()
+        runner.add_task(task)
+        runner.run_all()
+        assert (task.pid == os.getpid()) == same_process
+
+    assert work.run_in_process(os.getpid) == os.getpid()
+
+
+def test_critical_path():
+    log = []
+    a, b, c, d = [RecordTask(name, log) for name in "abcd"]
+    b.depends = [a]
+    c.depends = [a]
+    d.depends = [c]
+    durations = dict(a=1, b=5, c=2, d=4)
+    work.set_critical_path([a, b, c, d], lambda task: durations[task.name])
+    assert (a.priority, b.priority, c.priority, d.priority) == (7, 5, 6, 4)
+
+    # one job at a time: ready tasks start in priority order
+    runner = work.Runner(max_jobs=1)
+    e = RecordTask("e", log)
+    for task in (e, b, d, c, a):
+        runner.add_task(task)
+
+    runner.run_all()
+    assert [name for event, name in log if event == "start"] == [
+        "a", "c", "b", "d", "e"]
+
+
+def test_adaptive_limit():
+    limit = work.AdaptiveLimit(8, initial=2)
+    for i in range(2 + 3 + 4):
+        limit.update(1.0)
+
+    # a window of steady latency grows the limit by one
+    assert limit.limit == 5
+    for i in range(5):
+        limit.update(1.0, error=(i == 0))
+
+    assert limit.limit == 2
+    for i in range(2):
+        limit.update(10.0)
+
+    assert limit.limit == 1 # latency rise
+    for i in range(30):
+        limit.update(1.0)
+
+    assert limit.limit == 8 # capped
+    assert [new for when, old, new, reason in limit.decisions] == [
+        3, 4, 5, 2, 1, 2, 3, 4, 5, 6, 7, 8]
+
+    # slow and fast kinds of tasks are not compared to each other
+    limit = work.AdaptiveLimit(8, initial=2)
+    for i in range(20):
+        limit.update(1.0, key="fast")
+        limit.update(30.0, key="slow")
+
+    assert limit.limit == 8
+    changes = len(limit.decisions)
+    for i in range(8):
+        limit.update(10.0, key="fast")
+
+    assert limit.decisions[changes][1:3] == (8, 4) # latency rise
+
+
+def test_adaptive_runner():
+    log = []
+    runner = work.Runner(max_jobs=4, adaptive=True)
+    for i in range(12):
+        runner.add_task(RecordTask(str(i), log, delay=0.01))
+
+    runner.run_all()
+    assert len(log) == 24
+    assert max_running(log) <= 4
+    assert runner.adaptive.decisions